@@ -3,70 +3,43 @@
 Анализ цен и рейтингов 5ka.ru
 """
 
-import sqlite3
 import pandas as pd
 import os
-import json
 from datetime import datetime
-import numpy as np
 
+from fiveka_scrapy.database import connect, ensure_schema
+from fiveka_scrapy.stores import DEFAULT_STORE
 
-def clean_rating(rating_str):
-    """Очищает рейтинг от запятых и преобразует в float"""
-    if pd.isna(rating_str):
-        return np.nan
 
-    try:
-        # Если это уже число
-        if isinstance(rating_str, (int, float)):
-            return float(rating_str)
+def store_label(store_id):
+    return 'магазин по умолчанию' if store_id == DEFAULT_STORE else f'магазин {store_id}'
 
-        # Если строка
-        rating_str = str(rating_str).strip()
-        if not rating_str:
-            return np.nan
 
-        # Заменяем запятую на точку
-        rating_str = rating_str.replace(',', '.')
+def print_stats(df):
+    """Статистика цен одного магазина"""
+    print(f"   Всего товаров: {len(df)}")
 
-        # Убираем все не-цифры и не точки
-        import re
-        rating_str = re.sub(r'[^\d\.]', '', rating_str)
-
-        if rating_str:
-            return float(rating_str)
-        else:
-            return np.nan
-    except:
-        return np.nan
-
-
-def clean_price(price_str):
-    """Очищает цену"""
-    if pd.isna(price_str):
-        return np.nan
-
-    try:
-        if isinstance(price_str, (int, float)):
-            return float(price_str)
-
-        price_str = str(price_str).strip()
-        if not price_str:
-            return np.nan
-
-        # Убираем пробелы и заменяем запятые
-        price_str = price_str.replace(' ', '').replace(',', '.')
+    # Товары с рейтингом
+    rated = df[df['rating_clean'].notna()]
+    print(f"   Товаров с рейтингом: {len(rated)} ({len(rated) / len(df) * 100:.1f}%)")
+    if len(rated) > 0:
+        print(f"   Средний рейтинг: {rated['rating_clean'].mean():.2f}")
+        print(f"   Максимальный рейтинг: {rated['rating_clean'].max():.2f}")
+        print(f"   Минимальный рейтинг: {rated['rating_clean'].min():.2f}")
 
-        # Убираем все кроме цифр и точки
-        import re
-        price_str = re.sub(r'[^\d\.]', '', price_str)
+    # Товары со скидкой
+    discounted = df[df['discount_percent'].notna()]
+    print(f"   Товаров со скидкой: {len(discounted)} ({len(discounted) / len(df) * 100:.1f}%)")
+    if len(discounted) > 0:
+        print(f"   Средняя скидка: {discounted['discount_percent'].mean():.1f}%")
+        print(f"   Максимальная скидка: {discounted['discount_percent'].max():.1f}%")
 
-        if price_str:
-            return float(price_str)
-        else:
-            return np.nan
-    except:
-        return np.nan
+    # Цены
+    priced = df[df['price_clean'].notna()]
+    if len(priced) > 0:
+        print(f"   Средняя цена: {priced['price_clean'].mean():.2f} руб.")
+        print(f"   Максимальная цена: {priced['price_clean'].max():.2f} руб.")
+        print(f"   Минимальная цена: {priced['price_clean'].min():.2f} руб.")
 
 
 def main():
@@ -82,108 +55,93 @@ def main():
         print("❌ База данных не найдена")
         return
 
-    conn = sqlite3.connect(db_path)
+    # База старого формата переводится на текущую схему
+    conn = connect(db_path)
+    ensure_schema(conn)
 
-    # Получаем все записи
+    # Текущий каталог: последнее наблюдение по каждому товару в каждом магазине.
+    # Цены, рейтинг и отзывы уже числовые (нормализуются при сборе),
+    # поэтому скидка считается прямо в SQL, без очистки строк в Python
     query = '''
     SELECT 
-        name,
-        price,
-        old_price,
-        article,
-        url,
-        category,
-        rating,
-        reviews_count,
-        date_scraped
-    FROM products
-    ORDER BY date_scraped DESC
+        o.product_id,
+        o.store_id,
+        p.name,
+        o.price_kopecks / 100.0 as price_clean,
+        o.old_price_kopecks / 100.0 as old_price_clean,
+        p.article,
+        p.url,
+        p.category,
+        o.rating as rating_clean,
+        o.reviews_count,
+        CASE WHEN o.old_price_kopecks > 0 AND o.price_kopecks IS NOT NULL
+             THEN (o.old_price_kopecks - o.price_kopecks) * 100.0 / o.old_price_kopecks
+        END as discount_percent,
+        o.observed_at as date_scraped
+    FROM latest_products o
+    JOIN products p ON p.product_id = o.product_id
+    ORDER BY o.observed_at DESC
     '''
 
-    df = pd.read_sql_query(query, conn)
+    df_clean = pd.read_sql_query(query, conn)
     conn.close()
 
-    if df.empty:
+    if df_clean.empty:
         print("📭 Нет данных")
         return
 
-    print(f"📊 Всего записей в базе: {len(df)}")
-
-    # Очищаем данные
-    df_clean = df.copy()
-
-    # Очищаем рейтинги
-    print("🔄 Очистка рейтингов...")
-    df_clean['rating_clean'] = df_clean['rating'].apply(clean_rating)
+    # Строка на товар в каждом магазине; для каталога - одна строка на товар
+    products = df_clean.drop_duplicates('product_id')
+    stores = sorted(df_clean['store_id'].unique())
+    multi_store = len(stores) > 1
+    print(f"📊 Товаров в каталоге: {len(products)}, магазинов: {len(stores)}")
 
-    # Очищаем цены
-    print("🔄 Очистка цен...")
-    df_clean['price_clean'] = df_clean['price'].apply(clean_price)
-    df_clean['old_price_clean'] = df_clean['old_price'].apply(clean_price)
-
-    # Рассчитываем скидки - используем float
-    df_clean['discount_percent'] = np.nan
-    mask = (df_clean['old_price_clean'].notna()) & (df_clean['price_clean'].notna())
-    df_clean.loc[mask, 'discount_percent'] = ((df_clean.loc[mask, 'old_price_clean'] -
-                                               df_clean.loc[mask, 'price_clean']) /
-                                              df_clean.loc[mask, 'old_price_clean'] * 100)
-
-    # Преобразуем в числовой тип
-    df_clean['discount_percent'] = pd.to_numeric(df_clean['discount_percent'], errors='coerce')
-
-    # Статистика
-    print("\n📈 СТАТИСТИКА:")
-    print(f"   Всего товаров: {len(df_clean)}")
-
-    # Товары с рейтингом
-    rated = df_clean[df_clean['rating_clean'].notna()]
-    print(f"   Товаров с рейтингом: {len(rated)} ({len(rated) / len(df_clean) * 100:.1f}%)")
-    if len(rated) > 0:
-        print(f"   Средний рейтинг: {rated['rating_clean'].mean():.2f}")
-        print(f"   Максимальный рейтинг: {rated['rating_clean'].max():.2f}")
-        print(f"   Минимальный рейтинг: {rated['rating_clean'].min():.2f}")
-
-    # Товары со скидкой
-    discounted = df_clean[df_clean['discount_percent'].notna()]
-    print(f"   Товаров со скидкой: {len(discounted)} ({len(discounted) / len(df_clean) * 100:.1f}%)")
-    if len(discounted) > 0:
-        print(f"   Средняя скидка: {discounted['discount_percent'].mean():.1f}%")
-        print(f"   Максимальная скидка: {discounted['discount_percent'].max():.1f}%")
-
-    # Цены
-    priced = df_clean[df_clean['price_clean'].notna()]
-    if len(priced) > 0:
-        print(f"   Средняя цена: {priced['price_clean'].mean():.2f} руб.")
-        print(f"   Максимальная цена: {priced['price_clean'].max():.2f} руб.")
-        print(f"   Минимальная цена: {priced['price_clean'].min():.2f} руб.")
+    # Статистика по магазинам: цены и скидки у каждого магазина свои
+    for store_id in stores:
+        title = f" ({store_label(store_id)})" if multi_store else ''
+        print(f"\n📈 СТАТИСТИКА{title}:")
+        print_stats(df_clean[df_clean['store_id'] == store_id])
 
     # Топ категорий
     print(f"\n🏷️  ТОП КАТЕГОРИЙ (по количеству товаров):")
-    top_categories = df_clean['category'].value_counts().head(10)
+    top_categories = products['category'].value_counts().head(10)
     for cat, count in top_categories.items():
         print(f"   {cat}: {count} товаров")
 
-    # Топ товаров по рейтингу
+    # Топ товаров по рейтингу (рейтинг у товара один на все магазины)
+    rated = products[products['rating_clean'].notna()]
     if len(rated) > 0:
         print(f"\n🏆 ТОП ТОВАРОВ ПО РЕЙТИНГУ:")
-        top_rated = rated.nlargest(10, 'rating_clean')[['name', 'rating_clean', 'price_clean', 'category']]
+        # Цена в разных магазинах разная: показываем диапазон
+        price_range = df_clean.groupby('product_id')['price_clean'].agg(['min', 'max'])
+        top_rated = rated.nlargest(10, 'rating_clean')[['product_id', 'name', 'rating_clean', 'category']]
         for idx, row in top_rated.iterrows():
-            price = f"{row['price_clean']:.2f} руб." if pd.notna(row['price_clean']) else "Нет цены"
+            low, high = price_range.loc[row['product_id']]
+            if pd.isna(low):
+                price = "Нет цены"
+            elif high > low:
+                price = f"{low:.2f}–{high:.2f} руб."
+            else:
+                price = f"{low:.2f} руб."
             print(f"   {row['name'][:50]}... - {row['rating_clean']:.2f} ⭐ ({price})")
 
     # Топ товаров по скидке (с проверкой)
+    discounted = df_clean[df_clean['discount_percent'].notna()]
     if len(discounted) > 0:
         print(f"\n💰 ТОП ТОВАРОВ ПО СКИДКЕ:")
         # Убедимся, что discount_percent числовой
         discounted_sorted = discounted.sort_values('discount_percent', ascending=False)
-        top_discounts = discounted_sorted.head(10)[['name', 'discount_percent', 'old_price_clean', 'price_clean']]
+        top_discounts = discounted_sorted.head(10)[
+            ['name', 'store_id', 'discount_percent', 'old_price_clean', 'price_clean']
+        ]
 
         for idx, row in top_discounts.iterrows():
             old_price = f"{row['old_price_clean']:.2f}" if pd.notna(row['old_price_clean']) else "?"
             new_price = f"{row['price_clean']:.2f}" if pd.notna(row['price_clean']) else "?"
             discount_val = row['discount_percent']
+            store = f", {store_label(row['store_id'])}" if multi_store else ''
             if pd.notna(discount_val):
-                print(f"   {row['name'][:50]}... - {discount_val:.1f}% ({old_price} → {new_price} руб.)")
+                print(f"   {row['name'][:50]}... - {discount_val:.1f}% ({old_price} → {new_price} руб.{store})")
 
     # Сохраняем очищенные данные
     current_date = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -191,13 +149,13 @@ def main():
 
     # Готовим данные для экспорта
     export_df = df_clean[[
-        'name', 'category', 'article', 'price_clean',
+        'name', 'store_id', 'category', 'article', 'price_clean',
         'old_price_clean', 'discount_percent', 'rating_clean',
         'reviews_count', 'url', 'date_scraped'
     ]].copy()
 
     export_df.columns = [
-        'Название', 'Категория', 'Артикул', 'Цена',
+        'Название', 'Магазин', 'Категория', 'Артикул', 'Цена',
         'Старая цена', 'Скидка %', 'Рейтинг',
         'Количество отзывов', 'Ссылка', 'Дата сбора'
     ]
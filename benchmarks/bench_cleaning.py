@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Сравнение старой (apply) и векторной очистки цен и рейтингов
+
+    python benchmarks/bench_cleaning.py [--rows 1000000] [--seed 42]
+
+Строит синтетический набор в формате базы (числа, строки с запятыми,
+пробелами и символом рубля, пустые значения), проверяет, что результаты
+совпадают, и печатает время обоих вариантов.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from cleaning import clean_numeric, clean_price, clean_rating, compute_discount
+
+
+def make_dataset(rows, seed):
+    """Синтетические цены, старые цены и рейтинги"""
+    rng = np.random.default_rng(seed)
+    prices = rng.uniform(5, 5000, rows).round(2)
+    ratings = rng.uniform(1, 5, rows).round(2)
+
+    price_formats = [
+        lambda v: v,
+        lambda v: f"{v:.2f}",
+        lambda v: f"{v:.2f}".replace('.', ','),
+        lambda v: f"{v:,.2f} ₽".replace(',', ' '),
+        lambda v: None,
+        lambda v: '',
+    ]
+    rating_formats = [
+        lambda v: v,
+        lambda v: f"{v:.2f}".replace('.', ','),
+        lambda v: f" {v:.1f} ",
+        lambda v: None,
+        lambda v: 'нет оценок',
+    ]
+
+    price_choice = rng.integers(0, len(price_formats), rows)
+    old_choice = rng.integers(0, len(price_formats), rows)
+    rating_choice = rng.integers(0, len(rating_formats), rows)
+
+    return pd.DataFrame({
+        'price': pd.Series([price_formats[c](v) for c, v in zip(price_choice, prices)], dtype=object),
+        'old_price': pd.Series(
+            [price_formats[c](v * 1.2) for c, v in zip(old_choice, prices)], dtype=object
+        ),
+        'rating': pd.Series([rating_formats[c](v) for c, v in zip(rating_choice, ratings)], dtype=object),
+    })
+
+
+def old_path(df):
+    price = df['price'].apply(clean_price)
+    old_price = df['old_price'].apply(clean_price)
+    rating = df['rating'].apply(clean_rating)
+
+    discount = pd.Series(np.nan, index=df.index)
+    mask = old_price.notna() & price.notna()
+    discount[mask] = (old_price[mask] - price[mask]) / old_price[mask] * 100
+    return price, old_price, rating, discount
+
+
+def new_path(df):
+    price = clean_numeric(df['price'])
+    old_price = clean_numeric(df['old_price'])
+    rating = clean_numeric(df['rating'])
+    return price, old_price, rating, compute_discount(price, old_price)
+
+
+def timed(func, df):
+    started = time.perf_counter()
+    result = func(df)
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"Генерация {args.rows} строк...")
+    df = make_dataset(args.rows, args.seed)
+
+    old_result, old_time = timed(old_path, df)
+    new_result, new_time = timed(new_path, df)
+
+    for name, old, new in zip(['price', 'old_price', 'rating', 'discount'], old_result, new_result):
+        pd.testing.assert_series_equal(
+            old.astype(float), new.astype(float), check_names=False, rtol=1e-12,
+        )
+        print(f"  {name}: совпадает")
+
+    print(f"apply:     {old_time:.3f} с ({args.rows / old_time:,.0f} строк/с)")
+    print(f"векторно:  {new_time:.3f} с ({args.rows / new_time:,.0f} строк/с)")
+    print(f"ускорение: x{old_time / new_time:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк колбэков паука на сохраненных снимках страниц
+
+    python benchmarks/bench_replay.py [--snapshot-dir data/snapshots] [--repeat 5]
+
+Берет страницы из хранилища снимков (python run.py --snapshots record), а
+если оно пустое - синтетический корпус из каталога, категории и товара.
+Для parse, parse_category и parse_product печатает страниц в секунду,
+а для каждого поля реестра селекторов - время извлечения на страницу.
+Сеть и браузер не нужны, поэтому числа сравнимы между версиями парсера.
+"""
+
+import argparse
+import collections
+import functools
+import os
+import sys
+import time
+
+from scrapy.http import HtmlResponse, Request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_selectors import synthetic_page  # noqa: E402
+from fiveka_scrapy.extraction import PageIndex, SelectorEngine  # noqa: E402
+from fiveka_scrapy.snapshots import SnapshotStore  # noqa: E402
+from fiveka_scrapy.spiders.fiveka_spider import FivekaSpider  # noqa: E402
+
+CALLBACKS = ['parse', 'parse_category', 'parse_product']
+
+
+def synthetic_catalog():
+    links = ''.join(
+        f'<a class="chakra-link css-1mjqhey" href="/catalog/{i}/">'
+        f'<p class="css-54eu44">Категория {i}</p></a>'
+        for i in range(60)
+    )
+    return f'<html><body><nav>{links}</nav></body></html>'
+
+
+def synthetic_category():
+    cards = ''.join(
+        f'<div data-qa="product-card-{i}">'
+        f'<a data-qa="product-card-link" href="/product/tovar--{1000 + i}/">'
+        f'<img src="https://5ka.ru/img/{i}.jpg" alt="Товар {i}"></a>'
+        f'<p data-qa="product-card-name">Товар {i}</p>'
+        f'<p data-qa="product-card-price">{99 + i},99 ₽</p></div>'
+        for i in range(40)
+    )
+    return (
+        f'<html><body><div class="catalog">{cards}</div>'
+        f'<a rel="next" href="/catalog/1/?page=2">Дальше</a></body></html>'
+    )
+
+
+def load_corpus(snapshot_dir):
+    """callback -> [(url, body)]"""
+    corpus = collections.defaultdict(list)
+    if os.path.isdir(snapshot_dir):
+        store = SnapshotStore(snapshot_dir)
+        try:
+            for url, callback, digest, codec in store.entries(CALLBACKS):
+                corpus[callback].append((url, store.read(digest, codec)))
+        finally:
+            store.close()
+
+    if not corpus:
+        corpus['parse'].append(('https://5ka.ru/catalog', synthetic_catalog().encode('utf-8')))
+        corpus['parse_category'].append(
+            ('https://5ka.ru/catalog/1/', synthetic_category().encode('utf-8'))
+        )
+        corpus['parse_product'].append(
+            ('https://5ka.ru/product/benchmark--1/', synthetic_page().encode('utf-8'))
+        )
+    return corpus
+
+
+class FieldTimer:
+    """Время извлечения по полям: оборачивает методы движка селекторов"""
+
+    def __init__(self):
+        self.total = collections.Counter()
+        self.calls = collections.Counter()
+        self.patched = []
+
+    def wrap(self, owner, name, field_arg):
+        original = getattr(owner, name)
+        timer = self
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                field = args[field_arg] if field_arg is not None else '<индекс страницы>'
+                timer.total[field] += time.perf_counter() - started
+                timer.calls[field] += 1
+
+        setattr(owner, name, timed)
+        self.patched.append((owner, name, original))
+
+    def __enter__(self):
+        for owner in (SelectorEngine, PageIndex):
+            for name in ('get', 'getall', 'select'):
+                self.wrap(owner, name, 1)
+        self.wrap(PageIndex, '__init__', None)
+        return self
+
+    def __exit__(self, *exc):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+
+
+def run_callback(spider, callback, pages):
+    """Прогоняет колбэк по страницам, возвращает число результатов"""
+    method = getattr(spider, callback)
+    results = 0
+    for url, body in pages:
+        request = Request(url, callback=method, meta={'category_name': 'Бенчмарк'})
+        response = HtmlResponse(url=url, body=body, encoding='utf-8', request=request)
+        results += sum(1 for _ in method(response))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--snapshot-dir', default='data/snapshots')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.snapshot_dir)
+    print("Страниц: " + ", ".join(f"{cb} {len(corpus[cb])}" for cb in CALLBACKS if corpus[cb]))
+
+    for callback in CALLBACKS:
+        pages = corpus[callback]
+        if not pages:
+            continue
+
+        spider = FivekaSpider()
+        results = 0
+        with FieldTimer() as timer:
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                # Каждый проход с чистой дедупликацией, чтобы работа не менялась
+                spider.categories_parsed = set()
+                spider.product_urls_parsed = set()
+                results = run_callback(spider, callback, pages)
+            elapsed = time.perf_counter() - started
+
+        count = len(pages) * args.repeat
+        print(f"\n{callback}: {count / elapsed:.1f} стр/с, "
+              f"{elapsed / count * 1000:.2f} мс/страница, результатов за проход {results}")
+        for field, total in timer.total.most_common():
+            print(f"  {field:<22} {total / count * 1000:8.3f} мс/страница  "
+                  f"({timer.calls[field] / count:.1f} вызовов)")
+
+
+if __name__ == '__main__':
+    main()
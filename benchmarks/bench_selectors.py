@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Сравнение извлечения полей товара через response.css и прекомпилированные селекторы
+
+    python benchmarks/bench_selectors.py [--html-dir data/html] [--repeat 200]
+
+Берет сохраненные страницы товаров (*.html) из каталога, а если их нет -
+синтетическую страницу в разметке 5ka.ru. Проверяет, что оба варианта
+дают одинаковые товары, и печатает время на страницу.
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+from scrapy.http import HtmlResponse, Request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fiveka_scrapy.spiders.fiveka_spider import FivekaSpider  # noqa: E402
+
+SYNTHETIC_PAGE = '''
+<html><head>
+<script type="application/ld+json">{"@context": "https://schema.org", "@type": "Product"}</script>
+</head><body>
+<h1 data-qa="product-card-title">Молоко Простоквашино 3,2%% 930 мл</h1>
+<div itemprop="offers"><meta itemprop="price" content="99.99"></div>
+<div data-qa="product-price">129,99 ₽</div>
+<span>Артикул</span><span>4012345</span>
+<img itemprop="image" src="https://5ka.ru/img/main.jpg">
+%(images)s
+<div class="css-19ps4ew">Пастеризованное молоко</div>
+%(characteristics)s
+%(nutrition)s
+<h2 class="css-16706lo">4,8</h2>
+<h2 class="css-w9opm3">1 234 отзыва</h2>
+%(noise)s
+</body></html>
+'''
+
+
+def synthetic_page():
+    """Страница товара с характеристиками, КБЖУ и лишней разметкой"""
+    images = ''.join(
+        f'<img class="chakra-image css-1epf5lq" src="https://5ka.ru/img/{i}.jpg">' for i in range(6)
+    )
+    characteristics = ''.join(
+        f'<div class="chakra-stack css-o0cdb2"><p class="css-8696l">{key}</p>'
+        f'<p class="css-1vhi7o2">{value}</p></div>'
+        for key, value in [
+            ('Бренд', 'Простоквашино'), ('Вес', '930 мл'), ('Страна производства', 'Россия'),
+            ('Состав', 'молоко нормализованное'), ('Срок хранения', '10 дней'),
+        ]
+    )
+    nutrition = ''.join(
+        f'<div class="chakra-stack css-iicxse"><h2 class="css-1j4x839">{value}</h2>'
+        f'<p class="css-sdw6z7">{label}</p></div>'
+        for label, value in [('белки', '3,0'), ('жиры', '3,2'), ('углеводы', '4,7'), ('ккал', '58')]
+    )
+    noise = ''.join(
+        f'<div class="css-x{i}"><a href="/catalog/{i}/">Раздел {i}</a><p>Текст {i}</p></div>'
+        for i in range(400)
+    )
+    return SYNTHETIC_PAGE % {
+        'images': images, 'characteristics': characteristics,
+        'nutrition': nutrition, 'noise': noise,
+    }
+
+
+def legacy_parse_product(spider, response):
+    """parse_product до прекомпиляции селекторов (response.css на каждое поле)"""
+    item = {'url': response.url, 'category': response.meta.get('category_name', 'Без категории')}
+    item['product_id'] = None
+
+    article = None
+    for script in response.xpath('//script[@type="application/ld+json"]/text()').getall():
+        try:
+            data = json.loads(script)
+            if isinstance(data, dict) and 'sku' in data:
+                article = str(data['sku'])
+                break
+        except ValueError:
+            continue
+    if article is None:
+        for selector in ['[itemprop="sku"]::text', '[data-qa="product-sku"]::text',
+                         'span:contains("Артикул") + span::text', 'div:contains("Артикул")::text']:
+            value = response.css(selector).get()
+            if value:
+                article = value.strip()
+                break
+    item['article'] = article
+
+    item['name'] = response.css('h1[data-qa="product-card-title"]::text').get() or \
+        response.css('h1::text').get() or \
+        response.css('[itemprop="name"]::text').get()
+
+    prices = []
+    for selector in ['meta[itemprop="price"]::attr(content)',
+                     '[itemprop="priceSpecification"] meta[itemprop="price"]::attr(content)',
+                     '.product-price::text', '.price::text', '[data-qa="product-price"]::text']:
+        prices.extend(response.css(selector).getall())
+    price, old_price = spider.split_prices(spider.extract_prices(prices))
+    if price:
+        item['price'] = price
+    if old_price:
+        item['old_price'] = old_price
+
+    images = []
+    main_img = response.css('img[itemprop="image"]::attr(src)').get()
+    if main_img:
+        images.append(main_img)
+    for img in response.css('img.chakra-image.css-1epf5lq::attr(src)').getall():
+        if img and img not in images:
+            images.append(img)
+    item['image_url'] = images or None
+
+    item['description'] = response.css('div.css-19ps4ew::text, div.css-6ua3wa::text').get()
+
+    characteristics = {}
+    for section in response.css('.chakra-stack.css-o0cdb2, .css-o0cdb2'):
+        key = section.css('.css-8696l::text, .css-11ze7cv span::text').get()
+        value = section.css('.css-1vhi7o2::text, .css-gai91n span::text').get()
+        if key and value:
+            characteristics[key.strip()] = value.strip()
+    characteristics = characteristics or None
+    item['characteristics'] = characteristics
+    item['composition'] = spider.extract_composition(characteristics)
+
+    nutritional_info = {}
+    for block in response.css('.chakra-stack.css-iicxse'):
+        value = block.css('h2.css-1j4x839::text').get()
+        label = block.css('p.css-sdw6z7::text').get()
+        if value and label:
+            nutritional_info[label.strip()] = value.strip().replace(',', '.')
+    item['nutritional_info'] = nutritional_info or None
+
+    if characteristics:
+        item['brand'] = characteristics.get('Бренд')
+        item['weight'] = characteristics.get('Вес')
+        item['country'] = characteristics.get('Страна производства') or characteristics.get('Страна')
+
+    item['rating'] = response.css('h2.css-16706lo::text').get()
+    reviews_text = response.css('h2.css-w9opm3::text').get()
+    if reviews_text:
+        numbers = re.findall(r'\d+', reviews_text)
+        item['reviews_count'] = numbers[0] if numbers else reviews_text
+    return item
+
+
+def current_parse_product(spider, response):
+    item = dict(next(spider.parse_product(response)))
+    item.pop('timestamp', None)
+    item['product_id'] = None
+    return item
+
+
+def load_pages(html_dir):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(html_dir, '*.html'))):
+        with open(path, 'rb') as f:
+            pages.append((path, f.read()))
+    if not pages:
+        pages.append(('synthetic', synthetic_page().encode('utf-8')))
+    return pages
+
+
+def make_response(name, body):
+    url = 'https://5ka.ru/product/benchmark--1/'
+    return HtmlResponse(url=url, body=body, encoding='utf-8', request=Request(url))
+
+
+def timed(func, spider, bodies, repeat):
+    """Секунд на страницу; каждый раз новый ответ, чтобы дерево разбиралось заново"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for name, body in bodies:
+            func(spider, make_response(name, body))
+    return (time.perf_counter() - started) / (repeat * len(bodies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--html-dir', default='data/html')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    spider = FivekaSpider()
+    pages = load_pages(args.html_dir)
+    print(f"Страниц: {len(pages)}, повторов: {args.repeat}")
+
+    for name, body in pages:
+        response = make_response(name, body)
+        legacy = legacy_parse_product(spider, response)
+        current = current_parse_product(spider, response)
+        assert legacy == current, f"{name}: результаты различаются\n{legacy}\n{current}"
+    print("  результаты совпадают")
+
+    legacy_time = timed(legacy_parse_product, spider, pages, args.repeat)
+    current_time = timed(current_parse_product, spider, pages, args.repeat)
+
+    print(f"response.css:      {legacy_time * 1000:.3f} мс/страница")
+    print(f"прекомпилированные: {current_time * 1000:.3f} мс/страница")
+    print(f"ускорение: x{legacy_time / current_time:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Очистка строковых цен и рейтингов для бенчмарка bench_cleaning.py
+
+clean_price/clean_rating - прежняя построчная очистка (через apply),
+clean_numeric - ее векторный вариант. Сбор данных нормализует цены и
+рейтинги сам (fiveka_scrapy/normalize.py), поэтому в анализе эти функции
+не нужны.
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_object_dtype, is_string_dtype
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+# Все, кроме цифр и точки (подряд идущие символы - одной заменой)
+NON_NUMERIC_RE = re.compile(r'[^\d.]+')
+# Строка из цифр и точки, которую разберет float()
+NUMBER_PATTERN = r'^(?:\d+\.?\d*|\.\d+)$'
+
+
+def clean_rating(rating_str):
+    """Очищает рейтинг от запятых и преобразует в float"""
+    if pd.isna(rating_str):
+        return np.nan
+
+    try:
+        # Если это уже число
+        if isinstance(rating_str, (int, float)):
+            return float(rating_str)
+
+        # Если строка
+        rating_str = str(rating_str).strip()
+        if not rating_str:
+            return np.nan
+
+        # Заменяем запятую на точку
+        rating_str = rating_str.replace(',', '.')
+
+        # Убираем все не-цифры и не точки
+        rating_str = re.sub(r'[^\d\.]', '', rating_str)
+
+        if rating_str:
+            return float(rating_str)
+        else:
+            return np.nan
+    except:
+        return np.nan
+
+
+def clean_price(price_str):
+    """Очищает цену"""
+    if pd.isna(price_str):
+        return np.nan
+
+    try:
+        if isinstance(price_str, (int, float)):
+            return float(price_str)
+
+        price_str = str(price_str).strip()
+        if not price_str:
+            return np.nan
+
+        # Убираем пробелы и заменяем запятые
+        price_str = price_str.replace(' ', '').replace(',', '.')
+
+        # Убираем все кроме цифр и точки
+        price_str = re.sub(r'[^\d\.]', '', price_str)
+
+        if price_str:
+            return float(price_str)
+        else:
+            return np.nan
+    except:
+        return np.nan
+
+
+def clean_numeric(series):
+    """Векторная очистка цен и рейтингов.
+
+    Дает те же значения, что clean_price/clean_rating. Числа переводятся во
+    float без разбора строк, а строки чистятся ядрами pyarrow: строковые
+    методы pandas на object-столбце - тот же поэлементный цикл Python.
+    Анализ ее не использует: в базе значения уже числовые, и скидка
+    считается в SQL.
+    """
+    if not (is_object_dtype(series) or is_string_dtype(series)):
+        return series.astype(float)
+
+    values = series.to_numpy(dtype=object)
+    is_text = np.fromiter((type(value) is str for value in values), bool, len(values))
+    result = pd.to_numeric(
+        pd.Series(np.where(is_text, None, values)), errors='coerce'
+    ).to_numpy(dtype=float, copy=True)
+    if is_text.any():
+        result[is_text] = clean_text(values[is_text])
+    return pd.Series(result, index=series.index, name=series.name)
+
+
+def clean_text(values):
+    """Массив строк -> float: запятая в точку, все кроме цифр и точки убирается"""
+    if pa is None:
+        text = (
+            pd.Series(values, dtype=object)
+            .str.replace(',', '.', regex=False)
+            .str.replace(NON_NUMERIC_RE, '', regex=True)
+        )
+        return pd.to_numeric(text.where(text != ''), errors='coerce').to_numpy(dtype=float)
+
+    text = pc.replace_substring(pa.array(values, type=pa.string()), ',', '.')
+    # Регулярная замена дорогая, поэтому только для строк с лишними символами
+    dirty = pc.invert(pc.match_substring_regex(text, r'^[\d.]*$'))
+    if pc.any(dirty).as_py():
+        cleaned = pc.replace_substring_regex(pc.filter(text, dirty), NON_NUMERIC_RE.pattern, '')
+        text = pc.replace_with_mask(text, dirty, cleaned)
+    valid = pc.match_substring_regex(text, NUMBER_PATTERN)
+    return pc.cast(pc.if_else(valid, text, None), pa.float64()).to_numpy(zero_copy_only=False)
+
+
+def compute_discount(price, old_price):
+    """Скидка в процентах; NaN, если одной из цен нет"""
+    return (old_price - price) / old_price * 100
@@ -0,0 +1,442 @@
+"""
+Общая очередь запросов для обхода несколькими машинами.
+
+``BrokerScheduler`` заменяет планировщик Scrapy: запросы паука кладутся в
+брокер, а следующий запрос берется из брокера в аренду (lease) на
+``BROKER_VISIBILITY_TIMEOUT`` секунд. Пока страница загружается, аренда
+продлевается; после того как колбэк отработал, запрос подтверждается
+(ack). Запрос, который не загрузился (``BrokerFailMiddleware``), отсеян
+``HttpErrorMiddleware`` или уронил колбэк, помечается сбойным (fail),
+отброшенный через ``IgnoreRequest`` - подтверждается. Если узел упал,
+аренда истекает и запрос достается другому узлу.
+Запрос, выданный ``BROKER_MAX_DELIVERIES`` раз без подтверждения,
+считается сбойным и больше не выдается.
+
+Брокер подключаемый (``BROKER_CLASS``): ``SqliteBroker`` держит очередь в
+файле SQLite и подходит для нескольких процессов на одной машине и для
+отладки; для нескольких машин нужен брокер с тем же интерфейсом поверх
+сетевого хранилища.
+"""
+
+import logging
+import os
+import pickle
+import socket
+import time
+from datetime import datetime
+
+from scrapy import signals
+from scrapy.core.scheduler import BaseScheduler
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.spidermiddlewares.httperror import HttpError
+from scrapy.utils.misc import load_object
+from scrapy.utils.request import request_from_dict
+from twisted.internet import task
+
+from fiveka_scrapy.database import connect
+
+logger = logging.getLogger(__name__)
+
+# Сигнал: колбэк ответа отработал, запрос можно подтвердить
+request_processed = object()
+# Сигнал: обработка запроса завершилась ошибкой (request, exception)
+request_failed = object()
+
+QUEUED = 'queued'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Broker:
+    """Интерфейс брокера: очередь с приоритетами, арендой и подтверждением"""
+
+    @classmethod
+    def from_settings(cls, settings):
+        raise NotImplementedError
+
+    def push(self, fp, url, priority, payload, owner=None):
+        """Добавляет запрос; False, если он уже есть.
+
+        С ``owner`` запрос, арендованный этим узлом, возвращается в очередь
+        (повтор своего запроса).
+        """
+        raise NotImplementedError
+
+    def lease(self, owner):
+        """(fp, payload) запроса с наибольшим приоритетом или None"""
+        raise NotImplementedError
+
+    def ack(self, fp, owner):
+        raise NotImplementedError
+
+    def fail(self, fp, owner):
+        """Помечает арендованный запрос сбойным, он больше не выдается"""
+        raise NotImplementedError
+
+    def extend(self, owner, fps):
+        """Продлевает аренду запросов узла"""
+        raise NotImplementedError
+
+    def release(self, owner):
+        """Возвращает в очередь все запросы узла (при остановке)"""
+        raise NotImplementedError
+
+    def pending(self, exclude_owner=None):
+        """Число запросов в очереди и в аренде (кроме аренды узла ``exclude_owner``)"""
+        raise NotImplementedError
+
+    def counts(self):
+        raise NotImplementedError
+
+    def reset(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SqliteBroker(Broker):
+    """Брокер в файле SQLite (WAL, блокировки между процессами)"""
+
+    def __init__(self, path, visibility_timeout=300.0, max_deliveries=5, reclaim_interval=5.0):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_deliveries = max_deliveries
+        self.reclaim_interval = reclaim_interval
+        self.last_reclaim = 0.0
+        self.conn = connect(path)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS queue (
+                fp TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                request BLOB,
+                state TEXT NOT NULL,
+                owner TEXT,
+                lease_expires REAL,
+                deliveries INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT
+            )
+        ''')
+        # Внутри состояния: приоритет по убыванию, затем rowid (порядок добавления)
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_queue_next ON queue(state, priority DESC)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_queue_lease ON queue(state, lease_expires)')
+        self.conn.commit()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            settings.get('BROKER_PATH', 'data/broker.db'),
+            visibility_timeout=settings.getfloat('BROKER_VISIBILITY_TIMEOUT', 300.0),
+            max_deliveries=settings.getint('BROKER_MAX_DELIVERIES', 5),
+        )
+
+    def push(self, fp, url, priority, payload, owner=None):
+        now = datetime.now().isoformat()
+        with self.conn:
+            cursor = self.conn.execute(
+                'INSERT OR IGNORE INTO queue (fp, url, priority, request, state, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (fp, url, priority, payload, QUEUED, now),
+            )
+            if cursor.rowcount or owner is None:
+                return bool(cursor.rowcount)
+            cursor = self.conn.execute(
+                'UPDATE queue SET state = ?, priority = ?, request = ?, owner = NULL, '
+                'lease_expires = NULL, updated_at = ? WHERE fp = ? AND state = ? AND owner = ?',
+                (QUEUED, priority, payload, now, fp, LEASED, owner),
+            )
+            return bool(cursor.rowcount)
+
+    def reclaim(self, now):
+        """Возвращает в очередь запросы с истекшей арендой"""
+        cursor = self.conn.execute(
+            'UPDATE queue SET state = ?, owner = NULL, lease_expires = NULL '
+            'WHERE state = ? AND lease_expires < ?',
+            (QUEUED, LEASED, now),
+        )
+        if cursor.rowcount:
+            logger.warning(f"Истекла аренда запросов: {cursor.rowcount}, возвращены в очередь")
+        self.last_reclaim = now
+
+    def lease(self, owner):
+        now = time.time()
+        # BEGIN IMMEDIATE: два узла не могут взять один и тот же запрос
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            if now - self.last_reclaim >= self.reclaim_interval:
+                self.reclaim(now)
+            while True:
+                row = self.conn.execute(
+                    'SELECT fp, request, deliveries FROM queue WHERE state = ? '
+                    'ORDER BY priority DESC, rowid LIMIT 1',
+                    (QUEUED,),
+                ).fetchone()
+                if row is None:
+                    self.conn.commit()
+                    return None
+
+                fp, payload, deliveries = row
+                if deliveries >= self.max_deliveries:
+                    self.conn.execute('UPDATE queue SET state = ? WHERE fp = ?', (FAILED, fp))
+                    logger.error(f"Запрос выдавался {deliveries} раз без подтверждения: {fp}")
+                    continue
+
+                self.conn.execute(
+                    'UPDATE queue SET state = ?, owner = ?, lease_expires = ?, '
+                    'deliveries = deliveries + 1, updated_at = ? WHERE fp = ?',
+                    (LEASED, owner, now + self.visibility_timeout, datetime.now().isoformat(), fp),
+                )
+                self.conn.commit()
+                return fp, payload
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def ack(self, fp, owner):
+        with self.conn:
+            self.conn.execute(
+                'UPDATE queue SET state = ?, request = NULL, owner = NULL, lease_expires = NULL, '
+                'updated_at = ? WHERE fp = ? AND state = ? AND owner = ?',
+                (DONE, datetime.now().isoformat(), fp, LEASED, owner),
+            )
+
+    def fail(self, fp, owner):
+        with self.conn:
+            self.conn.execute(
+                'UPDATE queue SET state = ?, owner = NULL, lease_expires = NULL, updated_at = ? '
+                'WHERE fp = ? AND state = ? AND owner = ?',
+                (FAILED, datetime.now().isoformat(), fp, LEASED, owner),
+            )
+
+    def extend(self, owner, fps):
+        fps = list(fps)
+        if not fps:
+            return
+        with self.conn:
+            self.conn.execute(
+                f'UPDATE queue SET lease_expires = ? WHERE state = ? AND owner = ? '
+                f'AND fp IN ({", ".join("?" * len(fps))})',
+                (time.time() + self.visibility_timeout, LEASED, owner, *fps),
+            )
+
+    def release(self, owner):
+        with self.conn:
+            self.conn.execute(
+                'UPDATE queue SET state = ?, owner = NULL, lease_expires = NULL '
+                'WHERE state = ? AND owner = ?',
+                (QUEUED, LEASED, owner),
+            )
+
+    def pending(self, exclude_owner=None):
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM queue WHERE state = ? OR (state = ? AND owner IS NOT ?)',
+            (QUEUED, LEASED, exclude_owner),
+        ).fetchone()[0]
+
+    def counts(self):
+        return dict(self.conn.execute('SELECT state, COUNT(*) FROM queue GROUP BY state'))
+
+    def reset(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM queue')
+
+    def close(self):
+        self.conn.close()
+
+
+def open_broker(settings):
+    return load_object(settings.get('BROKER_CLASS', 'fiveka_scrapy.broker.SqliteBroker')).from_settings(settings)
+
+
+class BrokerScheduler(BaseScheduler):
+    """Планировщик поверх брокера (SCHEDULER = 'fiveka_scrapy.broker.BrokerScheduler').
+
+    Дубликаты отсекает сам брокер по отпечатку запроса, поэтому общий для
+    всех узлов. Копия арендованного запроса (повтор) возвращает его в
+    очередь, копия с другим URL (редирект) заменяет исходный запрос.
+    """
+
+    def __init__(self, crawler, broker, worker_id, heartbeat=60.0, reset=False):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.broker = broker
+        self.worker_id = worker_id
+        self.heartbeat = heartbeat
+        self.reset = reset
+        self.leased = set()
+        self.spider = None
+        self.heartbeat_loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        broker = open_broker(settings)
+        worker_id = settings.get('BROKER_WORKER_ID') or f'{socket.gethostname()}-{os.getpid()}'
+        scheduler = cls(
+            crawler,
+            broker,
+            worker_id,
+            heartbeat=max(1.0, settings.getfloat('BROKER_VISIBILITY_TIMEOUT', 300.0) / 3),
+            reset=settings.getbool('BROKER_RESET', False),
+        )
+        crawler.signals.connect(scheduler.request_processed, signal=request_processed)
+        crawler.signals.connect(scheduler.request_failed, signal=request_failed)
+        crawler.signals.connect(scheduler.request_dropped, signal=signals.request_dropped)
+        return scheduler
+
+    def open(self, spider):
+        self.spider = spider
+        if self.reset:
+            self.broker.reset()
+            logger.info("Очередь брокера очищена")
+        self.heartbeat_loop = task.LoopingCall(self.extend_leases)
+        self.heartbeat_loop.start(self.heartbeat, now=False)
+        logger.info(f"Брокер {type(self.broker).__name__}, узел {self.worker_id}: {self.broker.counts()}")
+
+    def close(self, reason):
+        if self.heartbeat_loop and self.heartbeat_loop.running:
+            self.heartbeat_loop.stop()
+        # Недообработанные запросы сразу достаются другим узлам
+        self.broker.release(self.worker_id)
+        logger.info(f"Брокер при остановке: {self.broker.counts()}")
+        self.broker.close()
+
+    def fingerprint(self, request):
+        return self.crawler.request_fingerprinter.fingerprint(request).hex()
+
+    def has_pending_requests(self):
+        # Запросы в аренде у других узлов тоже ждем: они могут вернуться
+        # в очередь или породить новые. Свои арендованные запросы не
+        # считаем: те, что в работе, движок видит сам, а зависшие не должны
+        # держать обход
+        return self.broker.pending(exclude_owner=self.worker_id) > 0
+
+    def __len__(self):
+        return self.broker.pending()
+
+    def enqueue_request(self, request):
+        fp = self.fingerprint(request)
+        parent = request.meta.get('broker_fp')
+        owner = self.worker_id if fp in self.leased else None
+        payload = pickle.dumps(request.to_dict(spider=self.spider), protocol=pickle.HIGHEST_PROTOCOL)
+
+        if not self.broker.push(fp, request.url, request.priority, payload, owner):
+            self.stats.inc_value('fiveka/broker/duplicates')
+            return False
+
+        if owner is not None:
+            self.leased.discard(fp)
+        if parent and parent != fp and parent in self.leased:
+            self.ack(parent)
+        self.stats.inc_value('scheduler/enqueued/broker')
+        return True
+
+    def next_request(self):
+        leased = self.broker.lease(self.worker_id)
+        if leased is None:
+            return None
+        fp, payload = leased
+        self.leased.add(fp)
+        request = request_from_dict(pickle.loads(payload), spider=self.spider)
+        request.meta['broker_fp'] = fp
+        self.stats.inc_value('scheduler/dequeued/broker')
+        return request
+
+    def request_processed(self, request):
+        fp = request.meta.get('broker_fp')
+        if fp in self.leased:
+            self.ack(fp)
+
+    def request_failed(self, request, exception):
+        fp = request.meta.get('broker_fp')
+        if fp not in self.leased:
+            return
+        # HttpError тоже IgnoreRequest, но это сбой загрузки
+        if isinstance(exception, IgnoreRequest) and not isinstance(exception, HttpError):
+            self.ack(fp)
+        else:
+            self.fail(fp)
+
+    def request_dropped(self, request):
+        """Брокер не принял запрос: редирект на известный URL или чужая аренда"""
+        fp = request.meta.get('broker_fp')
+        if fp not in self.leased:
+            return
+        if self.fingerprint(request) != fp:
+            self.ack(fp)
+        else:
+            # Аренда истекла и запрос взял другой узел
+            self.leased.discard(fp)
+
+    def ack(self, fp):
+        self.broker.ack(fp, self.worker_id)
+        self.leased.discard(fp)
+        self.stats.inc_value('fiveka/broker/acked')
+
+    def fail(self, fp):
+        self.broker.fail(fp, self.worker_id)
+        self.leased.discard(fp)
+        self.stats.inc_value('fiveka/broker/failed')
+
+    def extend_leases(self):
+        self.broker.extend(self.worker_id, self.leased)
+
+
+class BrokerAckMiddleware:
+    """Spider middleware: подтверждает запрос, когда колбэк отработал.
+
+    Ответ, отсеянный ``HttpErrorMiddleware``, и ошибка колбэка помечают
+    запрос сбойным. Стоит после ``HttpErrorMiddleware`` (50), чтобы
+    увидеть ``HttpError`` раньше, чем тот его поглотит.
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('BROKER_ENABLED', False):
+            raise NotConfigured
+        return cls(crawler)
+
+    def process_spider_output(self, response, result, spider=None):
+        yield from result
+        self.processed(response)
+
+    async def process_spider_output_async(self, response, result, spider=None):
+        async for entry in result:
+            yield entry
+        self.processed(response)
+
+    def process_spider_exception(self, response, exception, spider=None):
+        self.crawler.signals.send_catch_log(
+            request_failed, request=response.request, exception=exception
+        )
+
+    def processed(self, response):
+        self.crawler.signals.send_catch_log(request_processed, request=response.request)
+
+
+class BrokerFailMiddleware:
+    """Downloader middleware: завершает аренду запроса, который не загрузился.
+
+    Стоит первым в цепочке, поэтому ``process_exception`` вызывается
+    последним: до него доходят только ошибки, которые никто не обработал,
+    в том числе отказ после всех повторов и ``IgnoreRequest``. Отложенный
+    повтор (``RetryScheduled``) сюда не доходит, аренда остается за узлом.
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('BROKER_ENABLED', False):
+            raise NotConfigured
+        return cls(crawler)
+
+    def process_exception(self, request, exception, spider=None):
+        self.crawler.signals.send_catch_log(request_failed, request=request, exception=exception)
+        return None
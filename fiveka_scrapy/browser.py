@@ -0,0 +1,370 @@
+import logging
+import os
+import queue
+import threading
+from typing import Dict, List, Optional
+
+from selenium.common.exceptions import (
+    InvalidSessionIdException,
+    NoSuchWindowException,
+    WebDriverException,
+)
+from undetected_chromedriver import Chrome
+from undetected_chromedriver.options import ChromeOptions as Options
+
+from fiveka_scrapy.stores import apply_store
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+# Признаки того, что браузер или вкладка умерли и драйвер надо заменить
+CRASH_MESSAGES = (
+    "invalid session id",
+    "chrome not reachable",
+    "disconnected",
+    "no such window",
+    "target window already closed",
+    "session deleted",
+    "tab crashed",
+    "max retries exceeded",
+    "connection refused",
+)
+
+# Тип ресурса -> шаблоны URL. Network.setBlockedURLs фильтрует только по URL,
+# поэтому тип определяется по расширению файла
+RESOURCE_TYPE_PATTERNS: Dict[str, List[str]] = {
+    "image": ["*.jpg*", "*.jpeg*", "*.png*", "*.gif*", "*.webp*", "*.avif*", "*.svg*", "*.ico*"],
+    "font": ["*.woff*", "*.woff2*", "*.ttf*", "*.otf*", "*.eot*"],
+    "media": ["*.mp4*", "*.webm*", "*.mp3*", "*.ogg*", "*.m3u8*"],
+    "stylesheet": ["*.css*"],
+}
+
+
+def blocked_url_patterns(settings) -> List[str]:
+    """Шаблоны URL для Network.setBlockedURLs по настройкам блокировки.
+
+    ``SELENIUM_BLOCKED_RESOURCES`` - тип ресурса -> домены, на которых он
+    блокируется (``*`` - на всех); ``SELENIUM_BLOCKED_DOMAINS`` - домены,
+    все запросы к которым блокируются (аналитика, реклама).
+    """
+    patterns = []
+    for resource_type, domains in settings.getdict("SELENIUM_BLOCKED_RESOURCES").items():
+        type_patterns = RESOURCE_TYPE_PATTERNS.get(resource_type)
+        if type_patterns is None:
+            logger.warning(f"Неизвестный тип ресурса для блокировки: {resource_type}")
+            continue
+        for domain in domains:
+            if domain == "*":
+                patterns.extend(type_patterns)
+            else:
+                patterns.extend(f"*{domain}/{pattern}" for pattern in type_patterns)
+
+    for domain in settings.getlist("SELENIUM_BLOCKED_DOMAINS"):
+        patterns.append(f"*://{domain}/*")
+        patterns.append(f"*://*.{domain}/*")
+    return patterns
+
+
+def profile_dir(settings, slot: Optional[int], store: Optional[dict] = None) -> Optional[str]:
+    """Постоянный каталог профиля Chrome для слота пула (кэш между запусками).
+
+    У пулов разных магазинов свои профили, чтобы не смешивались cookies.
+    """
+    base = settings.get("SELENIUM_PROFILE_DIR")
+    if not base or slot is None:
+        return None
+    if store is not None:
+        base = os.path.join(base, f"store-{store['id']}")
+    path = os.path.abspath(os.path.join(base, f"slot-{slot}"))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def create_driver(settings, slot: Optional[int] = None, store: Optional[dict] = None) -> Chrome:
+    """Создает и настраивает новый Chrome драйвер.
+
+    ``slot`` - номер места в пуле, у каждого места свой постоянный профиль
+    с дисковым кэшем. ``store`` - магазин, к которому привязывается браузер.
+    """
+    logger.info("🚀 Инициализация Chrome драйвера...")
+
+    options = Options()
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_argument("--disable-gpu")
+
+    window_size = settings.get("SELENIUM_WINDOW_SIZE", "1920,1080")
+    options.add_argument(f"--window-size={window_size}")
+
+    if settings.getbool("SELENIUM_HEADLESS", False):
+        options.add_argument("--headless=new")
+
+    cache_size = settings.getint("SELENIUM_DISK_CACHE_SIZE", 0)
+    if cache_size:
+        options.add_argument(f"--disk-cache-size={cache_size}")
+
+    user_data_dir = profile_dir(settings, slot, store)
+    if user_data_dir:
+        driver = Chrome(options=options, user_data_dir=user_data_dir)
+    else:
+        driver = Chrome(options=options)
+    driver.set_page_load_timeout(settings.getint("SELENIUM_PAGE_LOAD_TIMEOUT", 30))
+
+    if settings.getbool("SELENIUM_BLOCK_RESOURCES", False):
+        block_resources(driver, blocked_url_patterns(settings))
+
+    if store is not None:
+        try:
+            apply_store(driver, settings.get("BASE_URL", "https://5ka.ru"), store)
+        except Exception:
+            driver.quit()
+            raise
+
+    logger.info(f"Chrome драйвер инициализирован (профиль: {user_data_dir or 'временный'})")
+    return driver
+
+
+def block_resources(driver: Chrome, patterns: List[str]):
+    """Запрещает браузеру загружать ресурсы по шаблонам URL через CDP."""
+    if not patterns:
+        return
+    try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": patterns})
+        logger.info(f"Блокируется шаблонов URL: {len(patterns)}")
+    except Exception as e:
+        logger.error(f"Не удалось включить блокировку ресурсов: {e}")
+
+
+def is_driver_crash(error: Exception) -> bool:
+    """Ошибка означает, что браузер недоступен (а не что страница плохая)."""
+    if isinstance(error, (InvalidSessionIdException, NoSuchWindowException, ConnectionError)):
+        return True
+    message = str(error).lower()
+    return any(text in message for text in CRASH_MESSAGES) and (
+        isinstance(error, WebDriverException) or "max retries exceeded" in message
+    )
+
+
+def driver_rss_mb(driver: Chrome) -> Optional[float]:
+    """Память браузера вместе с дочерними процессами, МБ (нужен psutil)."""
+    pid = getattr(driver, "browser_pid", None)
+    if psutil is None or not pid:
+        return None
+    try:
+        process = psutil.Process(pid)
+        processes = [process] + process.children(recursive=True)
+        return sum(p.memory_info().rss for p in processes) / 1024 / 1024
+    except psutil.Error:
+        return None
+
+
+def quit_driver(driver: Chrome):
+    try:
+        driver.quit()
+    except Exception as e:
+        logger.error(f"Ошибка закрытия драйвера: {e}")
+
+
+class DriverInfo:
+    """Место в пуле (профиль) и число отрендеренных страниц драйвера."""
+
+    __slots__ = ("slot", "pages")
+
+    def __init__(self, slot: int):
+        self.slot = slot
+        self.pages = 0
+
+
+class DriverPool:
+    """Пул Chrome драйверов для параллельного рендеринга страниц.
+
+    Драйверы создаются лениво, не больше ``size`` штук. Каждый рабочий
+    поток берет драйвер через ``acquire`` и обязан вернуть его через
+    ``release``. Каждому драйверу выдается свой номер места в пуле, по
+    которому выбирается постоянный профиль Chrome.
+
+    Драйвер перезапускается после ``SELENIUM_MAX_PAGES_PER_DRIVER`` страниц,
+    при превышении ``SELENIUM_MAX_RSS_MB`` или если он упал
+    (``release(driver, healthy=False)``). С ``SELENIUM_SPARE_DRIVER`` заранее
+    запускается запасной драйвер, который сразу занимает место
+    перезапускаемого.
+
+    С ``store`` все драйверы пула привязаны к магазину.
+    """
+
+    def __init__(self, settings, size: int, store: Optional[dict] = None):
+        self.settings = settings
+        self.size = size
+        self.store = store
+        self.max_pages = settings.getint("SELENIUM_MAX_PAGES_PER_DRIVER", 0)
+        self.max_rss_mb = settings.getfloat("SELENIUM_MAX_RSS_MB", 0)
+        self.spare_enabled = settings.getbool("SELENIUM_SPARE_DRIVER", False)
+        self.restarts = 0
+        self.crashes = 0
+
+        self._idle: "queue.Queue[Chrome]" = queue.Queue()
+        self._drivers: List[Chrome] = []
+        self._info: Dict[int, DriverInfo] = {}
+        self._lock = threading.Lock()
+        # undetected_chromedriver патчит бинарник chromedriver при запуске,
+        # поэтому драйверы создаются строго по одному
+        self._create_lock = threading.Lock()
+        self._created = 0
+        self._slot_count = size + (1 if self.spare_enabled else 0)
+        self._free_slots = list(range(self._slot_count))
+        self._spare: Optional[Chrome] = None
+        self._warming = False
+        self._closed = False
+
+        if self.max_rss_mb and psutil is None:
+            logger.warning("psutil не установлен, SELENIUM_MAX_RSS_MB не проверяется")
+
+    def acquire(self) -> Chrome:
+        """Берет свободный драйвер, при необходимости создает новый."""
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+
+            with self._lock:
+                slot = None
+                if self._created < self.size and self._free_slots:
+                    self._created += 1
+                    slot = self._free_slots.pop(0)
+
+            if slot is not None:
+                return self._start(slot)
+
+            # Ждем освободившийся драйвер; место могло освободиться при
+            # перезапуске без запасного драйвера, поэтому проверяем снова
+            try:
+                return self._idle.get(timeout=1.0)
+            except queue.Empty:
+                continue
+
+    def _start(self, slot: int) -> Chrome:
+        try:
+            with self._create_lock:
+                driver = create_driver(self.settings, slot, self.store)
+        except Exception as e:
+            with self._lock:
+                self._created -= 1
+                self._free_slots.append(slot)
+            logger.error(f"Ошибка инициализации драйвера: {e}")
+            raise
+
+        with self._lock:
+            self._drivers.append(driver)
+            self._info[id(driver)] = DriverInfo(slot)
+            ready = self._created >= self.size
+        if ready:
+            self.warm_spare()
+        return driver
+
+    def release(self, driver: Chrome, healthy: bool = True):
+        """Возвращает драйвер в пул или перезапускает его."""
+        info = self._info.get(id(driver))
+        if info is not None:
+            info.pages += 1
+
+        reason = None
+        if not healthy:
+            reason = "браузер не отвечает"
+        elif self.max_pages and info is not None and info.pages >= self.max_pages:
+            reason = f"{info.pages} страниц"
+        elif self.max_rss_mb:
+            rss = driver_rss_mb(driver)
+            if rss is not None and rss > self.max_rss_mb:
+                reason = f"память {rss:.0f} МБ"
+
+        if reason is None:
+            self._idle.put(driver)
+        else:
+            self._replace(driver, reason, healthy)
+
+    def _replace(self, driver: Chrome, reason: str, healthy: bool):
+        """Закрывает драйвер; его место занимает запасной, если он готов."""
+        logger.info(f"♻️ Перезапуск браузера: {reason}")
+        with self._lock:
+            if driver in self._drivers:
+                self._drivers.remove(driver)
+            info = self._info.pop(id(driver), None)
+            spare, self._spare = self._spare, None
+            if spare is not None:
+                self._drivers.append(spare)
+            else:
+                self._created -= 1
+            self.restarts += 1
+            if not healthy:
+                self.crashes += 1
+
+        if spare is not None:
+            self._idle.put(spare)
+
+        # Профиль освобождается только после закрытия браузера
+        quit_driver(driver)
+        if info is not None:
+            with self._lock:
+                self._free_slots.append(info.slot)
+        self.warm_spare()
+
+    def warm_spare(self):
+        """Запускает запасной драйвер в фоне, если его нет."""
+        if not self.spare_enabled:
+            return
+        with self._lock:
+            if self._closed or self._spare is not None or self._warming or not self._free_slots:
+                return
+            self._warming = True
+            slot = self._free_slots.pop(0)
+
+        threading.Thread(
+            target=self._create_spare, args=(slot,), name="selenium-spare", daemon=True
+        ).start()
+
+    def _create_spare(self, slot: int):
+        try:
+            with self._create_lock:
+                driver = create_driver(self.settings, slot, self.store)
+        except Exception as e:
+            logger.error(f"Ошибка запуска запасного драйвера: {e}")
+            with self._lock:
+                self._warming = False
+                self._free_slots.append(slot)
+            return
+
+        with self._lock:
+            self._warming = False
+            closed = self._closed
+            if not closed:
+                self._spare = driver
+                self._info[id(driver)] = DriverInfo(slot)
+        if closed:
+            quit_driver(driver)
+        else:
+            logger.info("Запасной драйвер готов")
+
+    def close(self):
+        """Закрывает все драйверы пула."""
+        with self._lock:
+            self._closed = True
+            drivers, self._drivers = self._drivers, []
+            if self._spare is not None:
+                drivers.append(self._spare)
+                self._spare = None
+            self._idle = queue.Queue()
+            self._info = {}
+            self._created = 0
+            self._free_slots = list(range(self._slot_count))
+
+        for driver in drivers:
+            quit_driver(driver)
+
+        if drivers:
+            logger.info(f"Закрыто драйверов: {len(drivers)}")
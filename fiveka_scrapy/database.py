@@ -0,0 +1,594 @@
+"""
+Работа с SQLite: схема, миграции, настройка соединения и фоновый поток записи.
+
+Схема:
+    runs                - запуски парсера
+    products            - статические данные товара, ключ product_id
+    price_observations  - история цен/рейтингов, строка пишется только
+                          при изменении наблюдения; цены в копейках (int),
+                          ошибки разбора - в parse_errors (JSON);
+                          store_id - магазин ('' без контекста магазина)
+    latest_products     - последнее наблюдение по каждому товару
+                          в каждом магазине, обновляется при записи
+    dead_letters        - URL, которые не загрузились после всех повторов
+"""
+
+import collections
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import json
+import time
+
+from twisted.internet import defer, threads
+
+from fiveka_scrapy.metrics import stage_timer
+from fiveka_scrapy.normalize import NORMALIZED_FIELDS, normalize_fields
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+PRODUCT_ID_RE = re.compile(r'--(\d+)/?(?:[?#].*)?$')
+
+
+def product_id_from_url(url):
+    """ID товара из ссылки вида https://5ka.ru/product/granat--79085/."""
+    if not url:
+        return None
+    match = PRODUCT_ID_RE.search(url)
+    return match.group(1) if match else None
+
+
+def product_key(item):
+    """Ключ товара: product_id, артикул или ссылка."""
+    return (
+        item.get('product_id')
+        or item.get('article')
+        or product_id_from_url(item.get('url'))
+        or item.get('url')
+    )
+
+
+def _migrate_v1(conn):
+    """Нормализованная схема и перенос старой таблицы products (url UNIQUE)."""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(products)")]
+    legacy = 'date_scraped' in columns
+    if legacy:
+        conn.execute('ALTER TABLE products RENAME TO products_legacy')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            spider TEXT,
+            started_at TEXT NOT NULL,
+            finished_at TEXT,
+            items_count INTEGER DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS products (
+            product_id TEXT PRIMARY KEY,
+            article TEXT,
+            url TEXT,
+            name TEXT,
+            category TEXT,
+            description TEXT,
+            characteristics TEXT,
+            composition TEXT,
+            nutritional_info TEXT,
+            image_url TEXT,
+            brand TEXT,
+            weight TEXT,
+            country TEXT,
+            first_seen_at TEXT,
+            last_seen_at TEXT,
+            last_seen_run_id INTEGER REFERENCES runs(run_id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS price_observations (
+            product_id TEXT NOT NULL REFERENCES products(product_id),
+            ts TEXT NOT NULL,
+            run_id INTEGER REFERENCES runs(run_id),
+            price REAL,
+            old_price REAL,
+            rating REAL,
+            reviews_count INTEGER,
+            PRIMARY KEY (product_id, ts)
+        ) WITHOUT ROWID
+    ''')
+
+    if legacy:
+        _import_legacy_products(conn)
+        conn.execute('DROP TABLE products_legacy')
+
+
+def _import_legacy_products(conn):
+    """Переносит строки старой таблицы в products и price_observations."""
+    started = conn.execute('SELECT MIN(date_scraped) FROM products_legacy').fetchone()[0]
+    run_id = conn.execute(
+        'INSERT INTO runs (spider, started_at, finished_at) VALUES (?, ?, ?)',
+        ('legacy', started or '', started or ''),
+    ).lastrowid
+
+    rows = conn.execute('''
+        SELECT name, price, old_price, article, url, category, description,
+               characteristics, composition, nutritional_info, image_url,
+               brand, weight, country, rating, reviews_count, date_scraped
+        FROM products_legacy
+        ORDER BY date_scraped
+    ''').fetchall()
+
+    for row in rows:
+        (name, price, old_price, article, url, category, description,
+         characteristics, composition, nutritional_info, image_url,
+         brand, weight, country, rating, reviews_count, date_scraped) = row
+        key = product_key({'article': article, 'url': url})
+        if not key:
+            continue
+        conn.execute('''
+            INSERT OR REPLACE INTO products
+            (product_id, article, url, name, category, description,
+             characteristics, composition, nutritional_info, image_url,
+             brand, weight, country, first_seen_at, last_seen_at, last_seen_run_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (key, article, url, name, category, description,
+              characteristics, composition, nutritional_info, image_url,
+              brand, weight, country, date_scraped, date_scraped, run_id))
+        conn.execute('''
+            INSERT OR IGNORE INTO price_observations
+            (product_id, ts, run_id, price, old_price, rating, reviews_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (key, date_scraped or '', run_id, price, old_price, rating, reviews_count))
+
+
+def _migrate_v2(conn):
+    """Индексы и таблица последних наблюдений latest_products."""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_products_url ON products(url)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_products_category ON products(category)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_observations_ts ON price_observations(ts)')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS latest_products (
+            product_id TEXT PRIMARY KEY REFERENCES products(product_id),
+            run_id INTEGER REFERENCES runs(run_id),
+            price REAL,
+            old_price REAL,
+            rating REAL,
+            reviews_count INTEGER,
+            observed_at TEXT
+        )
+    ''')
+    conn.execute('''
+        INSERT OR REPLACE INTO latest_products
+        (product_id, run_id, price, old_price, rating, reviews_count, observed_at)
+        SELECT o.product_id, o.run_id, o.price, o.old_price, o.rating, o.reviews_count, o.ts
+        FROM price_observations o
+        JOIN (
+            SELECT product_id, MAX(ts) AS ts
+            FROM price_observations
+            GROUP BY product_id
+        ) last ON o.product_id = last.product_id AND o.ts = last.ts
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_latest_observed_at ON latest_products(observed_at)')
+
+
+def _migrate_v3(conn):
+    """Цены в копейках (INTEGER), числовые рейтинг/отзывы и колонка parse_errors.
+
+    SQLite не умеет менять тип колонки, поэтому таблицы пересоздаются.
+    """
+    conn.execute('''
+        CREATE TABLE price_observations_v3 (
+            product_id TEXT NOT NULL REFERENCES products(product_id),
+            ts TEXT NOT NULL,
+            run_id INTEGER REFERENCES runs(run_id),
+            price_kopecks INTEGER,
+            old_price_kopecks INTEGER,
+            rating REAL,
+            reviews_count INTEGER,
+            parse_errors TEXT,
+            PRIMARY KEY (product_id, ts)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE latest_products_v3 (
+            product_id TEXT PRIMARY KEY REFERENCES products(product_id),
+            run_id INTEGER REFERENCES runs(run_id),
+            price_kopecks INTEGER,
+            old_price_kopecks INTEGER,
+            rating REAL,
+            reviews_count INTEGER,
+            parse_errors TEXT,
+            observed_at TEXT
+        )
+    ''')
+
+    _copy_normalized(conn, 'price_observations', ['product_id', 'ts', 'run_id'])
+    _copy_normalized(conn, 'latest_products', ['product_id', 'run_id', 'observed_at'])
+
+    for table in ('price_observations', 'latest_products'):
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_v3 RENAME TO {table}')
+
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_observations_ts ON price_observations(ts)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_latest_observed_at ON latest_products(observed_at)')
+
+
+def _copy_normalized(conn, table, columns):
+    """Копирует строки в {table}_v3, нормализуя цены, рейтинг и отзывы."""
+    fields = ['price', 'old_price', 'rating', 'reviews_count']
+    rows = conn.execute(f'SELECT {", ".join(columns + fields)} FROM {table}').fetchall()
+
+    converted = []
+    for row in rows:
+        values = dict(zip(fields, row[len(columns):]))
+        errors = normalize_fields(values)
+        converted.append((
+            *row[:len(columns)],
+            *(values[field] for field in NORMALIZED_FIELDS),
+            json.dumps(errors, ensure_ascii=False) if errors else None,
+        ))
+
+    target_columns = columns + [
+        'price_kopecks', 'old_price_kopecks', 'rating', 'reviews_count', 'parse_errors',
+    ]
+    placeholders = ', '.join('?' * len(target_columns))
+    conn.executemany(
+        f'INSERT INTO {table}_v3 ({", ".join(target_columns)}) VALUES ({placeholders})',
+        converted,
+    )
+
+
+def _migrate_v4(conn):
+    """Время последнего сбора карточки товара для инкрементального режима."""
+    conn.execute('ALTER TABLE products ADD COLUMN detail_scraped_at TEXT')
+    conn.execute('UPDATE products SET detail_scraped_at = last_seen_at')
+
+
+def _migrate_v5(conn):
+    """Таблица URL, исчерпавших повторы загрузки."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS dead_letters (
+            url TEXT PRIMARY KEY,
+            callback TEXT,
+            reason TEXT,
+            message TEXT,
+            status INTEGER,
+            attempts INTEGER,
+            failures INTEGER DEFAULT 1,
+            first_failed_at TEXT,
+            failed_at TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_dead_letters_failed_at ON dead_letters(failed_at)')
+
+
+def _migrate_v6(conn):
+    """Наблюдения по магазинам: store_id в ключе price_observations и latest_products.
+
+    Существующие наблюдения получают store_id = '' (без контекста магазина).
+    """
+    conn.execute('''
+        CREATE TABLE price_observations_v6 (
+            product_id TEXT NOT NULL REFERENCES products(product_id),
+            store_id TEXT NOT NULL DEFAULT '',
+            ts TEXT NOT NULL,
+            run_id INTEGER REFERENCES runs(run_id),
+            price_kopecks INTEGER,
+            old_price_kopecks INTEGER,
+            rating REAL,
+            reviews_count INTEGER,
+            parse_errors TEXT,
+            PRIMARY KEY (product_id, store_id, ts)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE latest_products_v6 (
+            product_id TEXT NOT NULL REFERENCES products(product_id),
+            store_id TEXT NOT NULL DEFAULT '',
+            run_id INTEGER REFERENCES runs(run_id),
+            price_kopecks INTEGER,
+            old_price_kopecks INTEGER,
+            rating REAL,
+            reviews_count INTEGER,
+            parse_errors TEXT,
+            observed_at TEXT,
+            PRIMARY KEY (product_id, store_id)
+        )
+    ''')
+
+    columns = {
+        'price_observations': 'product_id, ts, run_id, price_kopecks, old_price_kopecks, '
+                              'rating, reviews_count, parse_errors',
+        'latest_products': 'product_id, run_id, price_kopecks, old_price_kopecks, '
+                           'rating, reviews_count, parse_errors, observed_at',
+    }
+    for table, names in columns.items():
+        conn.execute(f'INSERT INTO {table}_v6 ({names}) SELECT {names} FROM {table}')
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_v6 RENAME TO {table}')
+
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_observations_ts ON price_observations(ts)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_latest_observed_at ON latest_products(observed_at)')
+
+
+# Миграции по порядку; номер версии хранится в PRAGMA user_version
+MIGRATIONS = [
+    _migrate_v1,
+    _migrate_v2,
+    _migrate_v3,
+    _migrate_v4,
+    _migrate_v5,
+    _migrate_v6,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def load_last_observations(conn):
+    """Последнее наблюдение по каждому товару в магазине:
+    (product_id, store_id) -> кортеж значений."""
+    rows = conn.execute('''
+        SELECT product_id, store_id, price_kopecks, old_price_kopecks, rating, reviews_count
+        FROM latest_products
+    ''')
+    return {(row[0], row[1]): tuple(row[2:]) for row in rows}
+
+
+def read_last_observations(db_path):
+    """``load_last_observations`` из другой базы (базы обхода для шарда)."""
+    if not os.path.exists(db_path):
+        return {}
+
+    conn = connect(db_path)
+    try:
+        ensure_schema(conn)
+        return load_last_observations(conn)
+    finally:
+        conn.close()
+
+
+def load_catalog_snapshot(db_path):
+    """Последнее состояние каталога для инкрементального обхода.
+
+    Возвращает product_id -> (detail_scraped_at, has_detail, name), где
+    has_detail - собраны ли детальные поля (характеристики, состав или КБЖУ).
+    """
+    if not os.path.exists(db_path):
+        return {}
+
+    conn = connect(db_path)
+    try:
+        ensure_schema(conn)
+        rows = conn.execute('''
+            SELECT product_id, detail_scraped_at,
+                   characteristics IS NOT NULL
+                   OR composition IS NOT NULL
+                   OR nutritional_info IS NOT NULL,
+                   name
+            FROM products
+        ''')
+        return {row[0]: (row[1], bool(row[2]), row[3]) for row in rows}
+    finally:
+        conn.close()
+
+
+def ensure_schema(conn):
+    """Приводит схему базы к последней версии.
+
+    Каждая миграция выполняется в BEGIN IMMEDIATE с повторным чтением версии,
+    поэтому несколько соединений (поток записи, паук, шарды) могут вызывать
+    функцию одновременно.
+    """
+    while True:
+        # DDL в sqlite3 не открывает транзакцию сам, открываем явно,
+        # чтобы миграция применялась целиком или не применялась вовсе
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= SCHEMA_VERSION:
+                conn.commit()
+                return
+            MIGRATIONS[version](conn)
+            conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"Схема базы обновлена до версии {version + 1}")
+
+
+def connect(db_path, check_same_thread=True):
+    """Открывает базу с настройками для частой пакетной записи."""
+    db_dir = os.path.dirname(db_path)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+
+    conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
+    # WAL: запись не блокирует чтение, fsync только на checkpoint
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-20000')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA busy_timeout=30000')
+    return conn
+
+
+class DatabaseWriter(threading.Thread):
+    """Поток, который владеет соединением и пишет пачками.
+
+    Со стороны реактора используются только ``submit`` и ``close``.
+    Строки попадают в ограниченную очередь; если она заполнена, они ждут
+    в буфере реактора, а ``submit`` возвращает Deferred, который сработает
+    только когда строка попадет в очередь. Так медленный диск тормозит
+    обработку товаров, но не блокирует реактор. Порядок записи совпадает
+    с порядком вызовов ``submit``.
+
+    ``setup(conn)`` вызывается один раз в потоке записи,
+    ``write_batch(conn, rows)`` - для каждой пачки внутри транзакции,
+    ``after_commit(rows)`` - после успешной фиксации пачки,
+    ``teardown(conn)`` - после записи последней пачки.
+
+    Если соединение или ``setup`` не удались, поток завершается, а в потоке
+    реактора вызывается ``on_error(error)``: ожидающие и новые ``submit``
+    завершаются ошибкой, а не висят в буфере.
+
+    С ``timings`` время транзакции пачки вместе с фиксацией пишется
+    как этап ``db.batch``.
+    """
+
+    def __init__(self, db_path, setup, write_batch, teardown=None,
+                 batch_size=200, flush_interval=5.0, max_queue=10000, timings=None,
+                 on_error=None, after_commit=None):
+        super().__init__(name='sqlite-writer', daemon=True)
+        self.db_path = db_path
+        self.setup = setup
+        self.write_batch = write_batch
+        self.teardown = teardown
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.timings = timings
+        self.on_error = on_error
+        self.after_commit = after_commit
+
+        # Доступны только из потока реактора
+        self.error = None
+        self.overflow = collections.deque()
+        self.closing = False
+        self.stop_sent = False
+        self.written = 0
+        self.failed = 0
+
+    # --- Поток реактора ---
+
+    def submit(self, row, result=None):
+        """Ставит строку в очередь записи.
+
+        Возвращает Deferred с ``result``: сразу, если в очереди есть место,
+        иначе когда строка будет принята в очередь. Если поток записи не
+        запустился, Deferred завершается ошибкой.
+        """
+        if self.error is not None:
+            self.failed += 1
+            return defer.fail(self.error)
+
+        if not self.overflow:
+            try:
+                self.queue.put_nowait(row)
+                return defer.succeed(result)
+            except queue.Full:
+                pass
+
+        d = defer.Deferred()
+        self.overflow.append((row, d, result))
+        return d
+
+    def refill(self):
+        """Перекладывает строки из буфера реактора в очередь потока."""
+        while self.overflow:
+            row, d, result = self.overflow[0]
+            try:
+                self.queue.put_nowait(row)
+            except queue.Full:
+                return
+            self.overflow.popleft()
+            d.callback(result)
+
+        if self.closing and not self.stop_sent:
+            try:
+                self.queue.put_nowait(_STOP)
+                self.stop_sent = True
+            except queue.Full:
+                pass
+
+    def close(self):
+        """Дописывает все строки и останавливает поток. Возвращает Deferred."""
+        self.closing = True
+        self.refill()
+        return threads.deferToThread(self.join)
+
+    def setup_failed(self, error):
+        """Поток записи не запустился: отклоняем все строки (поток реактора)."""
+        self.error = error
+        self.failed += self.queue.qsize()
+        while self.overflow:
+            _, d, _ = self.overflow.popleft()
+            self.failed += 1
+            d.errback(error)
+        if self.on_error is not None:
+            self.on_error(error)
+
+    def batch_written(self, count, ok):
+        if ok:
+            self.written += count
+        else:
+            self.failed += count
+        self.refill()
+
+    # --- Поток записи ---
+
+    def run(self):
+        from twisted.internet import reactor
+
+        conn = None
+        try:
+            conn = connect(self.db_path)
+            self.setup(conn)
+        except Exception as e:
+            logger.error(f"Ошибка подготовки базы {self.db_path}: {e}")
+            if conn is not None:
+                conn.close()
+            reactor.callFromThread(self.setup_failed, e)
+            return
+
+        try:
+            stopping = False
+            while not stopping:
+                batch, stopping = self.collect_batch()
+                if batch:
+                    ok = self.flush(conn, batch)
+                    reactor.callFromThread(self.batch_written, len(batch), ok)
+            if self.teardown is not None:
+                with conn:
+                    self.teardown(conn)
+        finally:
+            conn.close()
+
+    def collect_batch(self):
+        """Собирает пачку: до batch_size строк или flush_interval секунд."""
+        first = self.queue.get()
+        if first is _STOP:
+            return [], True
+
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                row = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if row is _STOP:
+                return batch, True
+            batch.append(row)
+        return batch, False
+
+    def flush(self, conn, batch):
+        """Записывает пачку одной транзакцией."""
+        try:
+            with stage_timer(self.timings, 'db.batch'), conn:
+                self.write_batch(conn, batch)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения пачки из {len(batch)} строк: {e}")
+            return False
+        if self.after_commit is not None:
+            self.after_commit(batch)
+        return True
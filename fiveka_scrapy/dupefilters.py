@@ -0,0 +1,236 @@
+"""
+Компактная дедупликация URL.
+
+Вместо множества строк (100+ байт на URL) хранятся 64-битные отпечатки
+канонизированных URL:
+
+* ``FingerprintSet`` - точное множество на ``array('Q')`` с открытой
+  адресацией, около 16-32 байт на URL;
+* ``BloomFilter`` - фильтр Блума фиксированного размера с заданной
+  вероятностью ложного срабатывания, память не растет с числом URL.
+
+Перед хэшированием из URL удаляются трекинговые параметры
+(``DUPEFILTER_STRIP_PARAMS``), поэтому ссылки на один товар с разными
+utm-метками считаются одной.
+"""
+
+import hashlib
+import logging
+import math
+from array import array
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from scrapy.dupefilters import BaseDupeFilter
+from w3lib.url import canonicalize_url
+
+logger = logging.getLogger(__name__)
+
+TRACKING_PARAMS = [
+    'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content',
+    'yclid', 'gclid', 'fbclid', '_openstat', 'from', 'ref',
+]
+
+
+def strip_tracking(url, params=TRACKING_PARAMS):
+    """URL без трекинговых параметров и фрагмента"""
+    parts = urlsplit(url)
+    if not parts.query and not parts.fragment:
+        return url
+    strip = set(params)
+    query = [
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in strip and not key.startswith('utm_')
+    ]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ''))
+
+
+def url_fingerprint(url, params=TRACKING_PARAMS, method='GET', store=None):
+    """64-битный отпечаток канонизированного URL (никогда не 0).
+
+    Один URL в разных магазинах (``store``) - разные отпечатки.
+    """
+    key = f'{method} {canonicalize_url(strip_tracking(url, params))}'
+    if store:
+        key = f'{key} store={store}'
+    fp = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+    return fp or 1
+
+
+class FingerprintSet:
+    """Множество 64-битных отпечатков: открытая адресация в array('Q').
+
+    Пустая ячейка - 0, таблица удваивается при заполнении больше чем на половину.
+    """
+
+    def __init__(self, capacity=1 << 16):
+        size = 1 << max(4, math.ceil(math.log2(max(capacity, 1) * 2)))
+        self.slots = array('Q', bytes(8 * size))
+        self.mask = size - 1
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _find(self, fp):
+        """Индекс ячейки с отпечатком или первой пустой ячейки на пути поиска"""
+        slots, mask = self.slots, self.mask
+        index = fp & mask
+        while slots[index] and slots[index] != fp:
+            index = (index + 1) & mask
+        return index
+
+    def contains(self, fp):
+        return self.slots[self._find(fp)] == fp
+
+    def add(self, fp):
+        """Добавляет отпечаток, возвращает True, если его еще не было"""
+        index = self._find(fp)
+        if self.slots[index]:
+            return False
+        self.slots[index] = fp
+        self.count += 1
+        if self.count * 2 > len(self.slots):
+            self._grow()
+        return True
+
+    def _grow(self):
+        old = self.slots
+        self.slots = array('Q', bytes(8 * len(old) * 2))
+        self.mask = len(self.slots) - 1
+        for fp in old:
+            if fp:
+                self.slots[self._find(fp)] = fp
+
+    @property
+    def nbytes(self):
+        return len(self.slots) * self.slots.itemsize
+
+
+class BloomFilter:
+    """Фильтр Блума на bytearray, k индексов из отпечатка двойным хэшированием"""
+
+    def __init__(self, capacity=1_000_000, error_rate=0.001):
+        if not 0 < error_rate < 1:
+            raise ValueError(f"error_rate должен быть в (0, 1): {error_rate}")
+        capacity = max(capacity, 1)
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _indexes(self, fp):
+        h1 = fp & 0xFFFFFFFF
+        h2 = (fp >> 32) | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def contains(self, fp):
+        bits = self.bits
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(fp))
+
+    def add(self, fp):
+        """Добавляет отпечаток, возвращает True, если его (вероятно) еще не было"""
+        bits = self.bits
+        added = False
+        for i in self._indexes(fp):
+            byte, bit = i >> 3, 1 << (i & 7)
+            if not bits[byte] & bit:
+                bits[byte] |= bit
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+
+def fingerprint_store(settings):
+    """Хранилище отпечатков по настройкам DUPEFILTER_BACKEND"""
+    backend = settings.get('DUPEFILTER_BACKEND', 'array')
+    if backend == 'bloom':
+        return BloomFilter(
+            settings.getint('DUPEFILTER_CAPACITY', 1_000_000),
+            settings.getfloat('DUPEFILTER_ERROR_RATE', 0.001),
+        )
+    if backend == 'array':
+        return FingerprintSet()
+    raise ValueError(f"Неизвестный DUPEFILTER_BACKEND: {backend}")
+
+
+class UrlFilter:
+    """Множество URL поверх хранилища отпечатков (замена set() в пауке)"""
+
+    def __init__(self, store, params=TRACKING_PARAMS):
+        self.store = store
+        self.params = params
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            fingerprint_store(settings),
+            settings.getlist('DUPEFILTER_STRIP_PARAMS', TRACKING_PARAMS),
+        )
+
+    def __contains__(self, url):
+        return self.store.contains(url_fingerprint(url, self.params))
+
+    def __len__(self):
+        return len(self.store)
+
+    def add(self, url):
+        return self.store.add(url_fingerprint(url, self.params))
+
+
+class CompactDupeFilter(BaseDupeFilter):
+    """DUPEFILTER_CLASS на компактных отпечатках URL.
+
+    Учитываются метод, магазин и канонизированный URL без трекинговых параметров;
+    тело запроса не учитывается (паук делает только GET).
+    """
+
+    def __init__(self, store, params=TRACKING_PARAMS, debug=False, stats=None):
+        self.store = store
+        self.params = params
+        self.debug = debug
+        self.stats = stats
+        self.log_duplicates = True
+
+    @classmethod
+    def from_settings(cls, settings, stats=None):
+        return cls(
+            fingerprint_store(settings),
+            params=settings.getlist('DUPEFILTER_STRIP_PARAMS', TRACKING_PARAMS),
+            debug=settings.getbool('DUPEFILTER_DEBUG'),
+            stats=stats,
+        )
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls.from_settings(crawler.settings, stats=crawler.stats)
+
+    def request_seen(self, request):
+        fp = url_fingerprint(request.url, self.params, request.method, request.meta.get('store'))
+        return not self.store.add(fp)
+
+    def close(self, reason):
+        logger.info(
+            f"Дедупликация: {len(self.store)} URL, "
+            f"{self.store.nbytes / 1024 / 1024:.1f} МБ ({type(self.store).__name__})"
+        )
+
+    def log(self, request, spider):
+        if self.debug:
+            logger.debug(f"Отфильтрован дубликат: {request.url}")
+        elif self.log_duplicates:
+            logger.debug(
+                f"Отфильтрован дубликат: {request.url} - дальнейшие дубликаты "
+                f"не выводятся (DUPEFILTER_DEBUG = True, чтобы видеть все)"
+            )
+            self.log_duplicates = False
+        if self.stats is not None:
+            self.stats.inc_value('dupefilter/filtered')
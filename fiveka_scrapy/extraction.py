@@ -0,0 +1,436 @@
+"""
+Извлечение полей прекомпилированными селекторами.
+
+Все CSS-селекторы паука компилируются один раз при старте:
+
+* в ``lxml.etree.XPath`` - для поиска внутри небольших узлов (карточка,
+  блок характеристик);
+* в структуру для ``PageIndex`` - для поиска по всей странице. Индекс
+  за один обход дерева (одно XPath-выражение, выбирающее атрибуты class
+  и другие ключевые атрибуты, а также нужные теги) раскладывает элементы
+  по классам, атрибутам и тегам, после чего каждый селектор проверяет
+  только своих кандидатов, а не обходит весь DOM заново.
+
+Селекторы хранятся в версионированном реестре ``selectors.json``: для
+каждого поля задан упорядоченный список фолбэков. Реестр перечитывается
+без перезапуска обхода, если файл изменился. В статистику Scrapy
+пишется, какой по счету селектор сработал для поля
+(``fiveka/selectors/<поле>/<номер>``) и сколько было промахов
+(``fiveka/selectors/<поле>/miss``).
+"""
+
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from functools import lru_cache
+
+import cssselect
+from lxml import etree
+from parsel.csstranslator import HTMLTranslator
+
+logger = logging.getLogger(__name__)
+
+_translator = HTMLTranslator()
+
+# Реестр селекторов по умолчанию
+REGISTRY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'selectors.json')
+
+
+def load_registry(path):
+    """Версия, поля с селекторами-фолбэками и обязательные поля из JSON-реестра"""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+
+    fields, required = {}, set()
+    for field, spec in data['fields'].items():
+        if isinstance(spec, list):
+            spec = {'selectors': spec}
+        if not spec.get('selectors'):
+            raise ValueError(f"нет селекторов для поля {field}")
+        fields[field] = list(spec['selectors'])
+        if spec.get('required'):
+            required.add(field)
+    return data.get('version'), fields, required
+
+
+@lru_cache(maxsize=None)
+def compile_selector(css):
+    """CSS (с ::text и ::attr) -> скомпилированный XPath"""
+    return etree.XPath(_translator.css_to_xpath(css), smart_strings=False)
+
+
+class Unsupported(Exception):
+    """Селектор нельзя проверить по индексу, используется XPath"""
+
+
+class Compound:
+    """Простой селектор без комбинаторов: тег, классы и атрибуты"""
+
+    __slots__ = ('tag', 'classes', 'attribs')
+
+    def __init__(self, tree):
+        self.tag = None
+        self.classes = []
+        self.attribs = []
+        while True:
+            if isinstance(tree, cssselect.parser.Class):
+                self.classes.append(tree.class_name)
+            elif isinstance(tree, cssselect.parser.Attrib):
+                if tree.namespace or tree.operator not in ('exists', '=', '^=', '*=', '$=') or \
+                        not tree.attrib.replace('-', '').replace('_', '').isalnum():
+                    raise Unsupported(tree)
+                value = getattr(tree.value, 'value', tree.value)
+                self.attribs.append((tree.attrib, tree.operator, value))
+            elif isinstance(tree, cssselect.parser.Hash):
+                self.attribs.append(('id', '=', tree.id))
+            elif isinstance(tree, cssselect.parser.Element):
+                if tree.namespace:
+                    raise Unsupported(tree)
+                if tree.element and not tree.element.isalnum():
+                    raise Unsupported(tree)
+                self.tag = tree.element.lower() if tree.element else None
+                return
+            else:
+                raise Unsupported(tree)
+            tree = tree.selector
+
+    @property
+    def anchor(self):
+        """Ключ индекса, по которому выбираются кандидаты"""
+        if self.classes:
+            return 'class', self.classes[0]
+        if self.attribs:
+            return 'attr', self.attribs[0][0]
+        if self.tag:
+            return 'tag', self.tag
+        return None
+
+    def match(self, el):
+        if self.tag and el.tag != self.tag:
+            return False
+        if self.classes:
+            classes = (el.get('class') or '').split()
+            if any(name not in classes for name in self.classes):
+                return False
+        for name, operator, value in self.attribs:
+            actual = el.get(name)
+            if actual is None:
+                return False
+            if operator == '=' and actual != value:
+                return False
+            if operator == '^=' and not (value and actual.startswith(value)):
+                return False
+            if operator == '$=' and not (value and actual.endswith(value)):
+                return False
+            if operator == '*=' and not (value and value in actual):
+                return False
+        return True
+
+
+def _previous_element(el):
+    el = el.getprevious()
+    while el is not None and not isinstance(el.tag, str):
+        el = el.getprevious()
+    return el
+
+
+class IndexedSelector:
+    """Одна альтернатива CSS-селектора: цепочка простых селекторов и псевдоэлемент"""
+
+    def __init__(self, selector):
+        self.chain = []     # [(комбинатор слева, Compound)]
+        self._flatten(selector.parsed_tree)
+        self.last = self.chain[-1][1]
+
+        # Кандидаты берутся по последнему простому селектору: если он
+        # задан только тегом (или это *), а уточнения стоят левее,
+        # кандидатов слишком много - такой селектор выполняется через XPath
+        anchor = self.last.anchor
+        if anchor is None or (anchor[0] == 'tag' and len(self.chain) > 1):
+            raise Unsupported(selector)
+
+        pseudo = selector.pseudo_element
+        if pseudo is None or pseudo == 'text':
+            self.pseudo, self.attr = pseudo, None
+        elif getattr(pseudo, 'name', None) == 'attr':
+            self.pseudo, self.attr = 'attr', pseudo.arguments[0].value
+        else:
+            raise Unsupported(pseudo)
+
+    def _flatten(self, tree):
+        if isinstance(tree, cssselect.parser.CombinedSelector):
+            if tree.combinator not in (' ', '>', '+'):
+                raise Unsupported(tree)
+            self._flatten(tree.selector)
+            self.chain.append((tree.combinator, Compound(tree.subselector)))
+        else:
+            self.chain.append((None, Compound(tree)))
+
+    def matches(self, el, position=None):
+        """Проверка элемента справа налево по цепочке"""
+        if position is None:
+            position = len(self.chain) - 1
+        combinator, compound = self.chain[position]
+        if not compound.match(el):
+            return False
+        if position == 0:
+            return True
+        if combinator == '+':
+            previous = _previous_element(el)
+            return previous is not None and self.matches(previous, position - 1)
+        if combinator == '>':
+            parent = el.getparent()
+            return parent is not None and self.matches(parent, position - 1)
+        return any(self.matches(ancestor, position - 1) for ancestor in el.iterancestors())
+
+    def values(self, el):
+        if self.pseudo == 'text':
+            texts = [el.text] + [child.tail for child in el]
+            return [text for text in texts if text is not None]
+        if self.pseudo == 'attr':
+            value = el.get(self.attr)
+            return [] if value is None else [value]
+        return [el]
+
+
+def compile_candidates(anchors):
+    """XPath, выбирающий за один обход ключевые атрибуты и теги для индекса.
+
+    Проверка классов в предикатах XPath обходится дорого, поэтому
+    выбираются сами атрибуты, а классы разбираются в Python.
+    """
+    attrs = set(anchors.get('attr', ()))
+    if anchors.get('class'):
+        attrs.add('class')
+    paths = [f'descendant-or-self::*/@{name}' for name in sorted(attrs)]
+    paths += [f'descendant-or-self::{name}' for name in sorted(anchors.get('tag', ()))]
+    return etree.XPath(' | '.join(paths) or 'self::node()[false()]')
+
+
+@lru_cache(maxsize=None)
+def compile_indexed(css):
+    """CSS -> альтернативы для PageIndex или None, если нужен XPath"""
+    try:
+        return [IndexedSelector(selector) for selector in cssselect.parse(css)]
+    except (Unsupported, cssselect.SelectorError):
+        return None
+
+
+class SelectorEngine:
+    """Набор прекомпилированных селекторов с фолбэками.
+
+    Методы принимают элемент lxml (корень страницы или карточку):
+
+    * ``get`` - первое непустое значение первого сработавшего селектора;
+    * ``getall`` - все значения всех селекторов по порядку;
+    * ``select`` - элементы первого селектора, который что-то нашел.
+
+    Для поиска по всей странице используйте ``page(root)``.
+
+    Селекторы берутся из словаря ``selectors`` или из реестра ``path``;
+    реестр проверяется на изменения не чаще раза в ``reload_interval``
+    секунд. Если обязательное поле не находится ``miss_threshold`` раз
+    подряд, в лог пишется предупреждение.
+    """
+
+    def __init__(self, selectors=None, path=None, stats=None, reload_interval=30.0,
+                 miss_threshold=20):
+        self.path = path
+        self.stats = stats
+        self.reload_interval = reload_interval
+        self.miss_threshold = miss_threshold
+        self.version = None
+        self.required = set()
+        self.misses = defaultdict(int)
+        self.mtime = None
+        self.checked_at = time.monotonic()
+
+        if selectors is None:
+            self.path = path or REGISTRY_PATH
+            self.mtime = os.stat(self.path).st_mtime
+            self.version, selectors, self.required = load_registry(self.path)
+        self.compile(selectors)
+
+    def compile(self, selectors):
+        """Компилирует селекторы; при ошибке прежний набор остается в силе"""
+        compiled = {
+            field: [compile_selector(css) for css in fallbacks]
+            for field, fallbacks in selectors.items()
+        }
+        indexed = {
+            field: list(zip([compile_indexed(css) for css in fallbacks], compiled[field]))
+            for field, fallbacks in selectors.items()
+        }
+        anchors = defaultdict(set)
+        for fallbacks in indexed.values():
+            for alternatives, _ in fallbacks:
+                for alternative in alternatives or []:
+                    kind, key = alternative.last.anchor
+                    anchors[kind].add(key)
+
+        self.candidates = compile_candidates(anchors)
+        self.selectors, self.indexed, self.anchors = compiled, indexed, dict(anchors)
+
+    def maybe_reload(self):
+        """Перечитывает реестр, если файл изменился"""
+        if self.path is None:
+            return
+        now = time.monotonic()
+        if now - self.checked_at < self.reload_interval:
+            return
+        self.checked_at = now
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return
+            self.mtime = mtime
+            version, selectors, required = load_registry(self.path)
+            self.compile(selectors)
+        except (OSError, ValueError, KeyError, etree.XPathError, cssselect.SelectorError) as e:
+            logger.error(f"Реестр селекторов {self.path} не загружен, работают прежние: {e}")
+            return
+
+        self.version, self.required = version, required
+        self.misses.clear()
+        if self.stats is not None:
+            self.stats.set_value('fiveka/selectors/version', version)
+            self.stats.inc_value('fiveka/selectors/reloads')
+        logger.info(f"🔄 Реестр селекторов обновлен: версия {version}")
+
+    def hit(self, field, index):
+        self.misses[field] = 0
+        if self.stats is not None:
+            self.stats.inc_value(f'fiveka/selectors/{field}/{index}')
+
+    def miss(self, field):
+        if self.stats is not None:
+            self.stats.inc_value(f'fiveka/selectors/{field}/miss')
+        if field in self.required:
+            self.misses[field] += 1
+            if self.misses[field] == self.miss_threshold:
+                logger.warning(
+                    f"⚠️ Поле {field} не найдено {self.miss_threshold} раз подряд "
+                    f"(селекторы версии {self.version}) - возможно, сайт обновился"
+                )
+
+    def page(self, root):
+        """Индекс страницы для поиска по всему документу"""
+        self.maybe_reload()
+        return PageIndex(self, root)
+
+    def get(self, field, node):
+        for index, xpath in enumerate(self.selectors[field]):
+            result = xpath(node)
+            if result and result[0]:
+                self.hit(field, index)
+                return result[0]
+        self.miss(field)
+        return None
+
+    def getall(self, field, node):
+        values = []
+        for index, xpath in enumerate(self.selectors[field]):
+            result = xpath(node)
+            if result:
+                self.hit(field, index)
+                values.extend(result)
+        if not values:
+            self.miss(field)
+        return values
+
+    def select(self, field, node):
+        for index, xpath in enumerate(self.selectors[field]):
+            result = xpath(node)
+            if result:
+                self.hit(field, index)
+                return result
+        self.miss(field)
+        return []
+
+
+class PageIndex:
+    """Элементы-кандидаты страницы по классам, атрибутам и тегам.
+
+    Интерфейс как у ``SelectorEngine``, но без аргумента ``node``:
+    поиск идет по всему документу. Селекторы, которые не удалось
+    скомпилировать для индекса, выполняются через XPath.
+    """
+
+    def __init__(self, engine, root):
+        self.engine = engine
+        self.indexed = engine.indexed
+        self.root = root
+        self.positions = {}
+        self.index = defaultdict(list)
+
+        classes = engine.anchors.get('class', ())
+        index, positions = self.index, self.positions
+
+        # Узлы приходят в порядке документа: элемент, затем его атрибуты
+        for node in engine.candidates(root):
+            if isinstance(node, str):
+                el = node.getparent()
+                if node.attrname == 'class':
+                    for name in node.split():
+                        if name in classes:
+                            index['class', name].append(el)
+                else:
+                    index['attr', node.attrname].append(el)
+            else:
+                el = node
+                index['tag', el.tag].append(el)
+            if el not in positions:
+                positions[el] = len(positions)
+
+    def _query(self, alternatives, xpath):
+        """Результаты одного CSS-селектора в порядке документа"""
+        if alternatives is None:
+            return xpath(self.root)
+
+        matched = []
+        for alternative in alternatives:
+            candidates = self.index.get(alternative.last.anchor, ())
+            matched.extend((self.positions[el], alternative, el)
+                           for el in candidates if alternative.matches(el))
+        if len(alternatives) > 1:
+            matched.sort(key=lambda entry: entry[0])
+
+        values, seen = [], set()
+        for position, alternative, el in matched:
+            if position in seen:
+                continue
+            seen.add(position)
+            values.extend(alternative.values(el))
+        return values
+
+    def get(self, field):
+        for index, (alternatives, xpath) in enumerate(self.indexed[field]):
+            result = self._query(alternatives, xpath)
+            if result and result[0]:
+                self.engine.hit(field, index)
+                return result[0]
+        self.engine.miss(field)
+        return None
+
+    def getall(self, field):
+        values = []
+        for index, (alternatives, xpath) in enumerate(self.indexed[field]):
+            result = self._query(alternatives, xpath)
+            if result:
+                self.engine.hit(field, index)
+                values.extend(result)
+        if not values:
+            self.engine.miss(field)
+        return values
+
+    def select(self, field):
+        for index, (alternatives, xpath) in enumerate(self.indexed[field]):
+            result = self._query(alternatives, xpath)
+            if result:
+                self.engine.hit(field, index)
+                return result
+        self.engine.miss(field)
+        return []
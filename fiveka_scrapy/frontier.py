@@ -0,0 +1,378 @@
+"""
+Персистентный фронтир обхода для продолжения после падения.
+
+Каждый запрос, который выдает паук, записывается в SQLite как ожидающий,
+а после обработки ответа помечается выполненным. При запуске с
+``FRONTIER_RESUME`` паук начинает с ожидающих запросов, а выполненные
+страницы больше не загружаются, а запросы, исчерпавшие повторы или
+уронившие колбэк, помечаются сбойными и при продолжении не выдаются.
+Для страниц категорий дополнительно хранится прогресс пагинации
+(по категории и магазину).
+
+Во время обхода изменения пишет ``DatabaseWriter`` в своем потоке:
+реактор только кладет их в очередь, сериализация запросов и запись
+идут пачками в потоке записи.
+"""
+
+import logging
+import pickle
+import sqlite3
+from datetime import datetime
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Request
+from scrapy.utils.request import request_from_dict
+
+from fiveka_scrapy.database import DatabaseWriter, connect
+from fiveka_scrapy.dupefilters import FingerprintSet
+from fiveka_scrapy.retry import request_dead_lettered
+from fiveka_scrapy.stores import DEFAULT_STORE
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+# Изменение прогресса категории (только в очереди записи)
+PROGRESS = 'progress'
+
+
+def fp_key(fp):
+    """64-битный ключ отпечатка запроса (hex) для FingerprintSet"""
+    return int(fp[:16], 16) or 1
+
+
+def ensure_frontier_schema(conn):
+    """Создает таблицы фронтира"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS requests (
+            fp TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            status TEXT NOT NULL,
+            priority INTEGER DEFAULT 0,
+            request BLOB,
+            updated_at TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_requests_status ON requests(status)')
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(category_progress)')]
+    if columns and 'store' not in columns:
+        # Прогресс без магазина: переносим под магазин по умолчанию
+        conn.execute('ALTER TABLE category_progress RENAME TO category_progress_old')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS category_progress (
+            category TEXT,
+            store TEXT NOT NULL DEFAULT '',
+            pages_done INTEGER DEFAULT 0,
+            last_page_url TEXT,
+            next_page_url TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (category, store)
+        )
+    ''')
+    if columns and 'store' not in columns:
+        conn.execute('''
+            INSERT INTO category_progress (category, pages_done, last_page_url, next_page_url, updated_at)
+            SELECT category, pages_done, last_page_url, next_page_url, updated_at
+            FROM category_progress_old
+        ''')
+        conn.execute('DROP TABLE category_progress_old')
+    conn.commit()
+
+
+class CrawlFrontier:
+    """Хранилище запросов обхода и прогресса категорий.
+
+    Изменения копятся в памяти и пишутся пачкой в ``commit()``, а если
+    задан ``writer`` - уходят в его очередь. Выполненные отпечатки
+    проверяются по памяти без запросов к SQLite.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = connect(path)
+        ensure_frontier_schema(self.conn)
+        self.writer = None
+        self.changes = []
+        self.done_set = self.load_done()
+
+    def reset(self):
+        """Очищает фронтир перед новым обходом."""
+        self.conn.execute('DELETE FROM requests')
+        self.conn.execute('DELETE FROM category_progress')
+        self.conn.commit()
+        self.changes.clear()
+        self.done_set = FingerprintSet()
+
+    def load_done(self):
+        """Выполненные запросы прошлых запусков - в память."""
+        done_set = FingerprintSet()
+        for (fp,) in self.conn.execute('SELECT fp FROM requests WHERE status = ?', (DONE,)):
+            done_set.add(fp_key(fp))
+        return done_set
+
+    def is_done(self, fp):
+        return self.done_set.contains(fp_key(fp))
+
+    def record(self, change):
+        if self.writer is None:
+            self.changes.append(change)
+        elif self.writer.error is None:
+            self.writer.submit(change)
+
+    def add_pending(self, fp, request_dict, url, priority):
+        """Запоминает запрос как ожидающий (выполненные не трогаем)."""
+        self.record((PENDING, fp, url, priority, request_dict, datetime.now().isoformat()))
+
+    def mark_done(self, fp, url):
+        self.done_set.add(fp_key(fp))
+        self.record((DONE, fp, url, datetime.now().isoformat()))
+
+    def mark_failed(self, fp, url):
+        self.record((FAILED, fp, url, datetime.now().isoformat()))
+
+    def record_category_page(self, category, page_url, next_page_url, store=DEFAULT_STORE):
+        self.record((PROGRESS, category, store, page_url, next_page_url, datetime.now().isoformat()))
+
+    def flush(self):
+        """Записывает изменения, накопленные без writer."""
+        changes, self.changes = self.changes, []
+        self.write_changes(self.conn, changes)
+
+    @staticmethod
+    def write_changes(conn, changes):
+        """Записывает пачку изменений; ожидающий и затем выполненный
+        запрос пишется один раз (в потоке записи при обходе)."""
+        pending = {}
+        done = {}
+        progress = []
+        for change in changes:
+            kind = change[0]
+            if kind == PENDING:
+                pending[change[1]] = change[1:]
+            elif kind in (DONE, FAILED):
+                pending.pop(change[1], None)
+                done[change[1]] = (change[1], change[2], kind, change[3])
+            else:
+                progress.append(change[1:])
+
+        if pending:
+            conn.executemany('''
+                INSERT INTO requests (fp, url, status, priority, request, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(fp) DO UPDATE SET
+                    request = excluded.request,
+                    priority = excluded.priority,
+                    updated_at = excluded.updated_at
+                WHERE status != 'done'
+            ''', [
+                (fp, url, PENDING, priority, pickle.dumps(request_dict, protocol=4), updated_at)
+                for fp, url, priority, request_dict, updated_at in pending.values()
+            ])
+        if done:
+            conn.executemany('''
+                INSERT INTO requests (fp, url, status, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(fp) DO UPDATE SET
+                    status = excluded.status,
+                    request = CASE WHEN excluded.status = 'done' THEN NULL ELSE request END,
+                    updated_at = excluded.updated_at
+                WHERE excluded.status = 'done' OR status != 'done'
+            ''', list(done.values()))
+        if progress:
+            conn.executemany('''
+                INSERT INTO category_progress
+                    (category, store, pages_done, last_page_url, next_page_url, updated_at)
+                VALUES (?, ?, 1, ?, ?, ?)
+                ON CONFLICT(category, store) DO UPDATE SET
+                    pages_done = pages_done + 1,
+                    last_page_url = excluded.last_page_url,
+                    next_page_url = excluded.next_page_url,
+                    updated_at = excluded.updated_at
+            ''', progress)
+
+    def pending_requests(self):
+        """Ожидающие запросы (сериализованные словари) по убыванию приоритета."""
+        rows = self.conn.execute(
+            'SELECT request FROM requests WHERE status = ? AND request IS NOT NULL '
+            'ORDER BY priority DESC',
+            (PENDING,),
+        )
+        for (blob,) in rows:
+            yield pickle.loads(blob)
+
+    def counts(self):
+        return dict(self.conn.execute('SELECT status, COUNT(*) FROM requests GROUP BY status'))
+
+    def commit(self):
+        self.flush()
+        self.conn.commit()
+
+    def close(self):
+        try:
+            self.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка сохранения фронтира: {e}")
+        self.conn.close()
+
+
+class FrontierMiddleware:
+    """Spider middleware: записывает запросы паука во фронтир.
+
+    Выполненной страница считается после того, как callback полностью
+    отработал; после редиректа выполненным отмечается и исходный запрос
+    (его отпечаток в ``meta['frontier_fp']``). Запрос, записанный в dead
+    letters, и ответ, на котором упал колбэк (или ``HttpError``), помечаются
+    сбойными. Изменения пишет
+    ``DatabaseWriter`` пачкой раз в ``FRONTIER_COMMIT_INTERVAL`` секунд
+    и при закрытии паука.
+    """
+
+    def __init__(self, crawler, path, resume, commit_interval):
+        self.crawler = crawler
+        self.frontier = CrawlFrontier(path)
+        self.resume = resume
+        self.commit_interval = commit_interval
+        self.writer = None
+
+        if not resume:
+            self.frontier.reset()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('FRONTIER_ENABLED', False):
+            raise NotConfigured
+        middleware = cls(
+            crawler,
+            path=settings.get('FRONTIER_PATH', 'data/frontier.db'),
+            resume=settings.getbool('FRONTIER_RESUME', False),
+            commit_interval=settings.getfloat('FRONTIER_COMMIT_INTERVAL', 2.0),
+        )
+        crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(middleware.request_failed, signal=request_dead_lettered)
+        return middleware
+
+    def spider_opened(self, spider):
+        self.frontier.commit()
+        self.writer = DatabaseWriter(
+            self.frontier.path,
+            setup=ensure_frontier_schema,
+            write_batch=CrawlFrontier.write_changes,
+            batch_size=500,
+            flush_interval=self.commit_interval,
+            on_error=lambda error: logger.error(f"Фронтир не сохраняется: {error}"),
+        )
+        self.frontier.writer = self.writer
+        self.writer.start()
+        if self.resume:
+            counts = self.frontier.counts()
+            logger.info(
+                f"Продолжение обхода: выполнено {counts.get(DONE, 0)}, "
+                f"ожидает {counts.get(PENDING, 0)}, сбойных {counts.get(FAILED, 0)}"
+            )
+
+    def spider_closed(self, spider):
+        if self.writer is None:
+            self.frontier.close()
+            return None
+        d = self.writer.close()
+        d.addBoth(lambda _: self.frontier.close())
+        return d
+
+    def fingerprint(self, request):
+        return self.crawler.request_fingerprinter.fingerprint(request).hex()
+
+    def process_start_requests(self, start_requests, spider):
+        """При продолжении сначала выдаем ожидающие запросы из фронтира."""
+        yield from self.restore(spider)
+        for request in start_requests:
+            tracked = self.track(request, spider)
+            if tracked is not None:
+                yield tracked
+
+    async def process_start(self, start):
+        """То же для асинхронного start() в Scrapy 2.13+."""
+        spider = self.crawler.spider
+        for request in self.restore(spider):
+            yield request
+        async for entry in start:
+            if isinstance(entry, Request):
+                entry = self.track(entry, spider)
+                if entry is None:
+                    continue
+            yield entry
+
+    def restore(self, spider):
+        """Ожидающие запросы из фронтира (только при продолжении)."""
+        if not self.resume:
+            return
+        restored = 0
+        for request_dict in list(self.frontier.pending_requests()):
+            restored += 1
+            yield request_from_dict(request_dict, spider=spider)
+        logger.info(f"Восстановлено запросов: {restored}")
+
+    def process_spider_output(self, response, result, spider=None):
+        spider = spider or self.crawler.spider
+        next_page = []
+        for entry in result:
+            entry = self.handle_output(response, entry, spider, next_page)
+            if entry is not None:
+                yield entry
+        self.response_done(response, spider, next_page[-1] if next_page else None)
+
+    async def process_spider_output_async(self, response, result, spider=None):
+        spider = spider or self.crawler.spider
+        next_page = []
+        async for entry in result:
+            entry = self.handle_output(response, entry, spider, next_page)
+            if entry is not None:
+                yield entry
+        self.response_done(response, spider, next_page[-1] if next_page else None)
+
+    def process_spider_exception(self, response, exception, spider=None):
+        self.request_failed(response.request)
+
+    def request_failed(self, request):
+        """Запрос не будет выполнен: при продолжении его не выдаем."""
+        fp = request.meta.get('frontier_fp') or self.fingerprint(request)
+        self.frontier.mark_failed(fp, request.url)
+        self.crawler.stats.inc_value('fiveka/frontier/failed')
+
+    def handle_output(self, response, entry, spider, next_page):
+        """Учитывает запрос из колбэка, следующую страницу категории - в next_page."""
+        if not isinstance(entry, Request):
+            return entry
+        if entry.callback == getattr(spider, 'parse_category', None) and \
+                response.meta.get('category_name') == entry.meta.get('category_name'):
+            next_page.append(entry.url)
+        return self.track(entry, spider)
+
+    def response_done(self, response, spider, next_page_url):
+        """Callback отработал без ошибок - страница выполнена."""
+        request = response.request
+        self.frontier.mark_done(self.fingerprint(request), request.url)
+        original_fp = request.meta.get('frontier_fp')
+        if original_fp:
+            redirect_urls = request.meta.get('redirect_urls') or [request.url]
+            self.frontier.mark_done(original_fp, redirect_urls[0])
+        if request.callback == getattr(spider, 'parse_category', None):
+            self.frontier.record_category_page(
+                response.meta.get('category_name'), response.url, next_page_url,
+                response.meta.get('store') or DEFAULT_STORE,
+            )
+
+    def track(self, request, spider):
+        """Записывает запрос как ожидающий; выполненные запросы отбрасывает."""
+        fp = self.fingerprint(request)
+        if self.frontier.is_done(fp):
+            self.crawler.stats.inc_value('fiveka/frontier/skipped_done')
+            return None
+        request.meta['frontier_fp'] = fp
+        request_dict = request.to_dict(spider=spider)
+        # Словарь сериализуется в потоке записи, meta запроса к тому времени может измениться
+        request_dict['meta'] = dict(request_dict['meta'])
+        self.frontier.add_pending(fp, request_dict, request.url, request.priority)
+        return request
@@ -7,6 +7,8 @@ class FivekaItem(scrapy.Item):
     price = scrapy.Field()
     old_price = scrapy.Field()
     discount = scrapy.Field()
+    price_kopecks = scrapy.Field()  # Цена в копейках (int), заполняется при нормализации
+    old_price_kopecks = scrapy.Field()
 
     # Ссылки
     url = scrapy.Field()
@@ -44,4 +46,7 @@ class FivekaItem(scrapy.Item):
     timestamp = scrapy.Field()
     source_url = scrapy.Field()
     page_number = scrapy.Field()
-    date_scraped = scrapy.Field()  # Дата парсинга в формате ISO 8601
\ No newline at end of file
+    date_scraped = scrapy.Field()  # Дата парсинга в формате ISO 8601
+    parse_errors = scrapy.Field()  # Поля, которые не удалось привести к числу
+    partial = scrapy.Field()  # True - данные только со страницы категории
+    store = scrapy.Field()  # id магазина из STORES, цены которого собраны
\ No newline at end of file
@@ -0,0 +1,277 @@
+"""
+Время этапов обработки и метрики обхода.
+
+``StageTimings`` собирает длительности этапов горячего пути: загрузка
+страницы драйвером, ожидание готовности, прокрутка, ``page_source``,
+сборка ``HtmlResponse``, функции извлечения паука и записи в базу.
+Этапы замеряются в потоках рендеринга и записи, поэтому счетчики под
+блокировкой. Этапы именуются ``<группа>.<этап>``: ``render.driver_get``,
+``extract.characteristics``, ``db.observations``.
+
+``MetricsExtension`` раз в ``METRICS_INTERVAL`` секунд переносит время
+этапов в статистику Scrapy (``fiveka/timing/<этап>/count|total|max``),
+пишет статистику в JSON (``METRICS_JSON_PATH``) и, если задан
+``METRICS_PORT``, отдает метрики в текстовом формате Prometheus::
+
+    curl http://127.0.0.1:9410/metrics
+"""
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы, сек
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class StageStats:
+    """Число замеров, суммарное и максимальное время, гистограмма"""
+
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+
+class StageTimings:
+    """Время этапов по имени, потокобезопасно"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = StageStats()
+            stats.add(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def snapshot(self):
+        """Копия счетчиков: этап -> (count, total, max, buckets)"""
+        with self.lock:
+            return {
+                stage: (stats.count, stats.total, stats.max, list(stats.buckets))
+                for stage, stats in self.stages.items()
+            }
+
+
+@contextmanager
+def _noop():
+    yield
+
+
+def stage_timer(timings, stage):
+    """Контекст замера этапа; без метрик (timings is None) ничего не делает"""
+    if timings is None:
+        return _noop()
+    return timings.time(stage)
+
+
+def timed(stage):
+    """Декоратор метода: замер этапа в ``self.timings`` (если метрики включены)"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            timings = getattr(self, 'timings', None)
+            if timings is None:
+                return method(self, *args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                timings.observe(stage, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def timings_for(crawler):
+    """Общий для компонентов краулера ``StageTimings`` или None без METRICS_ENABLED"""
+    if crawler is None or not crawler.settings.getbool('METRICS_ENABLED', True):
+        return None
+    timings = getattr(crawler, 'stage_timings', None)
+    if timings is None:
+        timings = crawler.stage_timings = StageTimings()
+    return timings
+
+
+def publish_timings(timings, stats):
+    """Переносит время этапов в статистику Scrapy"""
+    for stage, (count, total, longest, _) in timings.snapshot().items():
+        stats.set_value(f'fiveka/timing/{stage}/count', count)
+        stats.set_value(f'fiveka/timing/{stage}/total', round(total, 3))
+        stats.set_value(f'fiveka/timing/{stage}/max', round(longest, 3))
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(timings, stats):
+    """Метрики в текстовом формате Prometheus"""
+    lines = [
+        '# HELP fiveka_stage_seconds Время этапов обработки страниц',
+        '# TYPE fiveka_stage_seconds histogram',
+    ]
+    for stage, (count, total, _, buckets) in sorted(timings.snapshot().items()):
+        cumulative = 0
+        for bound, hits in zip(BUCKETS, buckets):
+            cumulative += hits
+            lines.append(f'fiveka_stage_seconds_bucket{{stage="{_label(stage)}",le="{bound}"}} {cumulative}')
+        lines.append(f'fiveka_stage_seconds_bucket{{stage="{_label(stage)}",le="+Inf"}} {count}')
+        lines.append(f'fiveka_stage_seconds_sum{{stage="{_label(stage)}"}} {total:.6f}')
+        lines.append(f'fiveka_stage_seconds_count{{stage="{_label(stage)}"}} {count}')
+
+    lines += [
+        '# HELP fiveka_stat Числовые значения статистики Scrapy',
+        '# TYPE fiveka_stat gauge',
+    ]
+    for key, value in sorted(stats.get_stats().items()):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        if key.startswith('fiveka/timing/'):
+            continue
+        lines.append(f'fiveka_stat{{key="{_label(key)}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsExtension:
+    """Публикация времени этапов в статистику, JSON-дамп и HTTP-эндпоинт"""
+
+    def __init__(self, crawler, timings, interval=30.0, json_path=None, port=None,
+                 host='127.0.0.1'):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.timings = timings
+        self.interval = interval
+        self.json_path = json_path
+        self.port = port
+        self.host = host
+        self.loop = None
+        self.listener = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        timings = timings_for(crawler)
+        if timings is None:
+            raise NotConfigured
+        settings = crawler.settings
+        extension = cls(
+            crawler,
+            timings,
+            interval=settings.getfloat('METRICS_INTERVAL', 30.0),
+            json_path=settings.get('METRICS_JSON_PATH'),
+            port=settings.getint('METRICS_PORT') or None,
+            host=settings.get('METRICS_HOST', '127.0.0.1'),
+        )
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        if self.interval > 0:
+            self.loop = task.LoopingCall(self.publish)
+            self.loop.start(self.interval, now=False)
+        if self.port:
+            self.listen()
+
+    def listen(self):
+        from twisted.internet import reactor
+        from twisted.web.resource import Resource
+        from twisted.web.server import Site
+
+        extension = self
+
+        class MetricsResource(Resource):
+            isLeaf = True
+
+            def render_GET(self, request):
+                extension.publish_stats()
+                request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+                return prometheus_text(extension.timings, extension.stats).encode('utf-8')
+
+        try:
+            self.listener = reactor.listenTCP(self.port, Site(MetricsResource()), interface=self.host)
+        except Exception as e:
+            logger.warning(f"Не удалось открыть порт метрик {self.host}:{self.port}: {e}")
+            return
+        logger.info(f"📈 Метрики: http://{self.host}:{self.port}/metrics")
+
+    def publish_stats(self):
+        publish_timings(self.timings, self.stats)
+
+    def publish(self):
+        """Время этапов в статистику и, если задан путь, статистику в JSON"""
+        self.publish_stats()
+        if self.json_path:
+            try:
+                self.dump_json()
+            except OSError as e:
+                logger.warning(f"Не удалось записать метрики в {self.json_path}: {e}")
+
+    def dump_json(self):
+        directory = os.path.dirname(self.json_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        data = {
+            'updated_at': datetime.now().isoformat(),
+            'stats': self.stats.get_stats(),
+            'stages': {
+                stage: {'count': count, 'total': round(total, 6), 'max': round(longest, 6)}
+                for stage, (count, total, longest, _) in self.timings.snapshot().items()
+            },
+        }
+        tmp_path = f'{self.json_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+        os.replace(tmp_path, self.json_path)
+
+    def spider_closed(self, spider):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+        self.publish()
+        self.log_summary()
+        if self.listener is not None:
+            return self.listener.stopListening()
+        return None
+
+    def log_summary(self, top=10):
+        """Этапы с наибольшим суммарным временем"""
+        stages = sorted(self.timings.snapshot().items(), key=lambda entry: entry[1][1], reverse=True)
+        if not stages:
+            return
+        lines = [
+            f"  {stage}: {total:.1f} с, {count} раз, среднее {total / count * 1000:.1f} мс, макс {longest:.2f} с"
+            for stage, (count, total, longest, _) in stages[:top]
+        ]
+        logger.info("⏱ Время по этапам:\n" + '\n'.join(lines))
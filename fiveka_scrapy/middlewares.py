@@ -1,111 +1,353 @@
-import time
-import random
 import logging
-from typing import Optional
+import time
 from scrapy import signals
-from scrapy.http import HtmlResponse, Request
+from scrapy.http import HtmlResponse, Response
+from scrapy.utils.httpobj import urlparse_cached
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException
-from undetected_chromedriver import Chrome
-from undetected_chromedriver.options import ChromeOptions as Options
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+from fiveka_scrapy.browser import DriverPool, is_driver_crash
+from fiveka_scrapy.metrics import stage_timer, timings_for
+from fiveka_scrapy.readiness import ReadinessWaiter, has_markers, rule_name
+from fiveka_scrapy.retry import RenderError, RenderTimeout
+from fiveka_scrapy.stores import load_stores
+from fiveka_scrapy.throttle import AdaptiveThrottle
 
 logger = logging.getLogger(__name__)
 
 
 class FivekaSeleniumMiddleware:
-    """Упрощенный Selenium Middleware."""
+    """Selenium Middleware с пулом Chrome драйверов.
+
+    Страницы рендерятся в отдельных потоках, а ``process_request``
+    возвращает Deferred, поэтому реактор не блокируется и одновременно
+    загружается до ``SELENIUM_POOL_SIZE`` страниц.
+
+    В гибридном режиме (``HYBRID_DOWNLOAD``) браузер открывается один раз,
+    чтобы получить cookies и User-Agent сессии, а страницы из
+    ``HYBRID_CALLBACKS`` скачиваются обычным HTTP клиентом Scrapy. Если в
+    ответе нет ожидаемых маркеров, запрос повторяется через Selenium.
+
+    С ``ADAPTIVE_THROTTLE_ENABLED`` рендеринг ждет очереди
+    ``AdaptiveThrottle``, а его задержка и параллельность переносятся на
+    слоты загрузчика для HTTP-запросов.
 
-    def __init__(self, settings):
+    Таймаут и ошибка рендеринга поднимаются как ``RenderTimeout`` и
+    ``RenderError``, их повторяет ``BackoffRetryMiddleware``.
+
+    С ``STORES`` у каждого магазина свой пул драйверов (``SELENIUM_POOL_SIZE``
+    делится между магазинами) и своя сессия гибридного режима; пул
+    выбирается по ``meta['store']``.
+
+    Время этапов рендеринга (ожидание драйвера, ``driver.get``, ожидание
+    готовности, прокрутка, ``page_source``, сборка ответа) пишется в
+    ``StageTimings`` как ``render.*``.
+    """
+
+    def __init__(self, settings, stats=None, crawler=None):
         self.settings = settings
-        self.driver: Optional[Chrome] = None
+        self.stats = stats
+        self.crawler = crawler
+        self.timings = timings_for(crawler)
+        self.pool_size = max(1, settings.getint("SELENIUM_POOL_SIZE", 1))
+        self.stores = load_stores(settings)
+        self.pools = self.create_pools(settings)
+        self.readiness = ReadinessWaiter.from_settings(settings)
+        self.page_load_timeout = settings.getint("SELENIUM_PAGE_LOAD_TIMEOUT", 30)
+        self.crash_retries = settings.getint("SELENIUM_CRASH_RETRIES", 1)
+        self.threadpool = ThreadPool(
+            minthreads=1, maxthreads=sum(pool.size for pool in self.pools.values()), name="selenium"
+        )
+
+        self.hybrid = settings.getbool("HYBRID_DOWNLOAD", False)
+        self.hybrid_callbacks = set(settings.getlist("HYBRID_CALLBACKS"))
+        self.sessions = {}
+        self.session_lock = defer.DeferredLock()
+
+        self.throttle = None
+        if settings.getbool("ADAPTIVE_THROTTLE_ENABLED", False):
+            self.throttle = AdaptiveThrottle.from_settings(settings, stats)
+
+    def create_pools(self, settings):
+        """Пул драйверов на каждый магазин или один пул без контекста магазина."""
+        if not self.stores:
+            return {None: DriverPool(settings, self.pool_size)}
+        size = max(1, self.pool_size // len(self.stores))
+        return {store["id"]: DriverPool(settings, size, store) for store in self.stores}
+
+    def pool_key(self, request):
+        """Магазин запроса; без магазина (или с неизвестным) - первый пул."""
+        store = request.meta.get("store")
+        return store if store in self.pools else next(iter(self.pools))
 
     @classmethod
     def from_crawler(cls, crawler):
-        middleware = cls(crawler.settings)
+        middleware = cls(crawler.settings, crawler.stats, crawler)
+        crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
         crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
         return middleware
 
-    def init_driver(self):
-        """Инициализация драйвера."""
-        if self.driver:
-            return
+    def spider_opened(self, spider):
+        """Запуск пула потоков рендеринга."""
+        self.threadpool.start()
+        if self.stores:
+            logger.info(f"Магазинов: {len(self.stores)}, браузеров на магазин: {self.pools[self.stores[0]['id']].size}")
+        else:
+            logger.info(f"Пул браузеров: {self.pool_size}")
+        if self.hybrid:
+            logger.info(f"Гибридный режим: HTTP для {sorted(self.hybrid_callbacks)}")
 
-        try:
-            logger.info("🚀 Инициализация Chrome драйвера...")
+    def process_request(self, request, spider):
+        """Обработка запроса через Selenium в пуле потоков или через HTTP."""
+        if self.use_http(request):
+            d = self.session_lock.run(self.ensure_session, self.pool_key(request))
+            d.addCallback(lambda _: self.prepare_http_request(request))
+            d.addErrback(self.session_failed, request)
+            return d
 
-            options = Options()
-            options.add_argument("--no-sandbox")
-            options.add_argument("--disable-dev-shm-usage")
-            options.add_argument("--disable-gpu")
+        return self.render_deferred(request)
 
-            window_size = self.settings.get("SELENIUM_WINDOW_SIZE", "1920,1080")
-            options.add_argument(f"--window-size={window_size}")
+    def process_response(self, request, response, spider):
+        """Возврат к Selenium, если HTTP ответ не похож на нужную страницу."""
+        if not request.meta.get("fiveka_http"):
+            return response
 
-            if self.settings.getbool("SELENIUM_HEADLESS", False):
-                options.add_argument("--headless=new")
+        if self.throttle is not None:
+            self.observe(request, response)
 
-            self.driver = Chrome(options=options)
-            self.driver.set_page_load_timeout(30)
+        if response.status == 200 and has_markers(response, rule_name(request)):
+            self.inc_stat("fiveka/http/ok")
+            return response
 
-            logger.info("Chrome драйвер инициализирован")
+        logger.info(f"Нет маркеров в HTTP ответе ({response.status}), Selenium: {request.url}")
+        self.inc_stat("fiveka/http/fallback")
+        return self.selenium_retry(request)
 
-        except Exception as e:
-            logger.error(f"Ошибка инициализации драйвера: {e}")
-            raise
+    def process_exception(self, request, exception, spider):
+        """Ошибка HTTP загрузки - повтор через Selenium."""
+        if not request.meta.get("fiveka_http"):
+            return None
 
-    def process_request(self, request, spider):
-        """Обработка запроса через Selenium."""
-        if not self.driver:
-            self.init_driver()
+        logger.info(f"Ошибка HTTP загрузки ({exception}), Selenium: {request.url}")
+        self.inc_stat("fiveka/http/fallback")
+        return self.selenium_retry(request)
 
-        logger.info(f"Загружаю: {request.url}")
+    def use_http(self, request):
+        """Можно ли скачать запрос без браузера."""
+        return (
+            self.hybrid
+            and not request.meta.get("selenium")
+            and rule_name(request) in self.hybrid_callbacks
+        )
+
+    def selenium_retry(self, request):
+        """Копия запроса, которая будет отрендерена браузером."""
+        meta = dict(request.meta, selenium=True, fiveka_http=False)
+        return request.replace(meta=meta, dont_filter=True)
+
+    def ensure_session(self, key):
+        """Получает cookies и User-Agent браузерной сессии (один раз на пул)."""
+        from twisted.internet import reactor
+
+        if key in self.sessions:
+            return None
+
+        d = threads.deferToThreadPool(
+            reactor, self.threadpool, self.bootstrap_session, key
+        )
+        d.addCallback(self.set_session, key)
+        return d
+
+    def bootstrap_session(self, key):
+        """Открывает главную страницу браузером (выполняется в потоке)."""
+        url = self.settings.get("BASE_URL", "https://5ka.ru")
+        logger.info(f"Получаю сессию браузера: {url}" + (f" (магазин {key})" if key else ""))
 
+        pool = self.pools[key]
+        driver = pool.acquire()
+        healthy = True
         try:
-            self.driver.get(request.url)
-            WebDriverWait(self.driver, 30).until(
+            driver.get(url)
+            WebDriverWait(driver, self.page_load_timeout).until(
                 EC.presence_of_element_located((By.TAG_NAME, "body"))
             )
+            return self.read_session(driver)
+        except Exception as e:
+            healthy = not is_driver_crash(e)
+            raise
+        finally:
+            pool.release(driver, healthy)
+
+    def read_session(self, driver):
+        """Cookies и User-Agent текущего состояния драйвера."""
+        return {
+            "cookies": {c["name"]: c["value"] for c in driver.get_cookies()},
+            "user_agent": driver.execute_script("return navigator.userAgent"),
+        }
+
+    def set_session(self, session, key):
+        self.sessions[key] = session
+        logger.info(f"Сессия получена, cookies: {len(session['cookies'])}")
+
+    def session_failed(self, failure, request):
+        """Сессию получить не удалось - рендерим браузером."""
+        logger.error(f"Ошибка получения сессии: {failure.value}")
+        return self.render_deferred(request)
+
+    def prepare_http_request(self, request):
+        """Подставляет в запрос cookies и User-Agent браузера."""
+        key = self.pool_key(request)
+        session = self.sessions[key]
+        request.meta["fiveka_http"] = True
+        if key is not None:
+            # Отдельная банка cookies на магазин, иначе магазины перезапишут друг друга
+            request.meta.setdefault("cookiejar", key)
+        if session["user_agent"]:
+            request.headers["User-Agent"] = session["user_agent"]
+        if isinstance(request.cookies, dict):
+            request.cookies = {**session["cookies"], **request.cookies}
+        return None
 
-            time.sleep(2)
-            self.scroll_page()
+    def render_deferred(self, request):
+        """Рендеринг в пуле потоков, при адаптивном троттлинге - в его очереди."""
+        from twisted.internet import reactor
 
-            html = self.driver.page_source
-            return HtmlResponse(
-                url=request.url,
-                body=html.encode("utf-8"),
-                encoding="utf-8",
-                request=request,
+        if self.throttle is None:
+            return threads.deferToThreadPool(
+                reactor, self.threadpool, self.render, request
             )
 
-        except TimeoutException:
+        key = urlparse_cached(request).hostname
+        d = self.throttle.acquire(key)
+        d.addCallback(
+            lambda _: threads.deferToThreadPool(reactor, self.threadpool, self.render, request)
+        )
+        d.addBoth(self.render_done, request, key)
+        return d
+
+    def render_done(self, result, request, key):
+        """Освобождает место в очереди троттлинга и учитывает ответ или ошибку."""
+        self.throttle.release(key)
+        if isinstance(result, Response):
+            self.observe(request, result)
+        elif isinstance(result, Failure) and result.check(RenderError):
+            self.throttle.observe(key, result.value.status, request.meta.get("render_time"))
+        return result
+
+    def observe(self, request, response):
+        """Передает троттлингу время загрузки, статус и признаки блокировки."""
+        key = urlparse_cached(request).hostname
+        blocked = self.throttle.is_blocked(
+            response, lambda: has_markers(response, rule_name(request))
+        )
+        latency = request.meta.get("render_time", request.meta.get("download_latency"))
+        self.throttle.observe(key, response.status, latency, blocked)
+
+        if request.meta.get("fiveka_http") and self.crawler is not None:
+            slot = self.crawler.engine.downloader.slots.get(request.meta.get("download_slot"))
+            if slot is not None:
+                self.throttle.apply_to_slot(key, slot)
+
+    def render(self, request):
+        """Загружает страницу свободным драйвером (выполняется в потоке).
+
+        Если браузер упал, драйвер заменяется, а запрос повторяется новым
+        драйвером до ``SELENIUM_CRASH_RETRIES`` раз.
+        """
+        key = self.pool_key(request)
+        pool = self.pools[key]
+        attempt = 0
+        while True:
+            with stage_timer(self.timings, "render.acquire"):
+                driver = pool.acquire()
+            healthy = True
+            started = time.monotonic()
+            try:
+                response = self.render_with(driver, request)
+                if self.hybrid and response.status == 200:
+                    # Обновляем сессию свежими cookies после успешного рендеринга
+                    try:
+                        self.sessions[key] = self.read_session(driver)
+                    except Exception as e:
+                        logger.debug(f"Не удалось обновить сессию: {e}")
+                return response
+            except Exception as e:
+                if not is_driver_crash(e):
+                    raise
+                healthy = False
+                if attempt >= self.crash_retries:
+                    logger.error(f"Браузер упал при загрузке {request.url}: {e}")
+                    raise RenderError(f"Браузер упал: {e}") from e
+                attempt += 1
+                logger.warning(f"💥 Браузер упал при загрузке {request.url}, повтор с новым драйвером")
+            finally:
+                request.meta["render_time"] = time.monotonic() - started
+                if self.timings is not None:
+                    self.timings.observe("render.total", request.meta["render_time"])
+                pool.release(driver, healthy)
+
+    def render_with(self, driver, request):
+        """Рендеринг страницы указанным драйвером."""
+        logger.info(f"Загружаю: {request.url}")
+
+        timings = self.timings
+        try:
+            with stage_timer(timings, "render.driver_get"):
+                driver.get(request.url)
+            with stage_timer(timings, "render.body_wait"):
+                WebDriverWait(driver, self.page_load_timeout).until(
+                    EC.presence_of_element_located((By.TAG_NAME, "body"))
+                )
+
+            # Прокрутка запускает ленивую подгрузку карточек,
+            # дальше ждем условия готовности вместо фиксированных пауз
+            with stage_timer(timings, "render.scroll"):
+                self.scroll_page(driver)
+            with stage_timer(timings, "render.readiness"):
+                self.readiness.wait(driver, request)
+
+            with stage_timer(timings, "render.page_source"):
+                html = driver.page_source
+            with stage_timer(timings, "render.response"):
+                return HtmlResponse(
+                    url=request.url,
+                    body=html.encode("utf-8"),
+                    encoding="utf-8",
+                    request=request,
+                )
+
+        except TimeoutException as e:
             logger.error(f"Таймаут при загрузке {request.url}")
-            return HtmlResponse(url=request.url, status=408, request=request)
+            raise RenderTimeout(f"Таймаут {self.page_load_timeout} с") from e
         except Exception as e:
+            if is_driver_crash(e):
+                raise
             logger.error(f"Ошибка загрузки {request.url}: {e}")
-            return HtmlResponse(
-                url=request.url,
-                status=500,
-                body=str(e).encode("utf-8"),
-                request=request,
-            )
+            raise RenderError(str(e)) from e
 
-    def scroll_page(self):
-        """Простая прокрутка страницы."""
+    def scroll_page(self, driver):
+        """Прокрутка страницы вниз для подгрузки контента."""
         try:
-            self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight)")
-            time.sleep(1)
-            self.driver.execute_script("window.scrollTo(0, 300)")
-            time.sleep(0.5)
+            driver.execute_script("window.scrollTo(0, document.body.scrollHeight)")
         except Exception as e:
             logger.debug(f"Ошибка прокрутки: {e}")
 
+    def inc_stat(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(key)
+
     def spider_closed(self, spider):
-        """Закрытие драйвера."""
-        if self.driver:
-            try:
-                self.driver.quit()
-                logger.info("Драйвер закрыт")
-            except Exception as e:
-                logger.error(f"Ошибка закрытия драйвера: {e}")
\ No newline at end of file
+        """Остановка потоков и закрытие драйверов."""
+        if self.threadpool.started:
+            self.threadpool.stop()
+        if self.stats is not None:
+            self.stats.set_value("fiveka/driver/restarts", sum(p.restarts for p in self.pools.values()))
+            self.stats.set_value("fiveka/driver/crashes", sum(p.crashes for p in self.pools.values()))
+        for pool in self.pools.values():
+            pool.close()
+        logger.info("Драйверы закрыты")
@@ -0,0 +1,92 @@
+"""
+Приведение цен, рейтинга и количества отзывов к числовым типам.
+
+Функции возвращают None для пустого значения и бросают ValueError, если
+значение есть, но разобрать его не удалось.
+"""
+
+import re
+from decimal import Decimal, InvalidOperation
+
+NON_NUMERIC_RE = re.compile(r'[^\d.]')
+DIGIT_GROUP_SPACE_RE = re.compile(r'(?<=\d)\s(?=\d)')
+DIGITS_RE = re.compile(r'\d+')
+
+
+def _is_empty(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def _to_decimal(value):
+    """Число из строки вида '1 299,50 ₽' или из int/float."""
+    if isinstance(value, bool):
+        raise ValueError(f"не число: {value!r}")
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+
+    text = NON_NUMERIC_RE.sub('', str(value).replace(',', '.'))
+    try:
+        return Decimal(text)
+    except InvalidOperation:
+        raise ValueError(f"не число: {value!r}") from None
+
+
+def parse_price_kopecks(value):
+    """Цена в копейках (int)."""
+    if _is_empty(value):
+        return None
+    amount = _to_decimal(value)
+    if not amount.is_finite() or amount < 0:
+        raise ValueError(f"некорректная цена: {value!r}")
+    return int((amount * 100).to_integral_value())
+
+
+def parse_rating(value):
+    """Рейтинг (float)."""
+    if _is_empty(value):
+        return None
+    rating = _to_decimal(value)
+    if not rating.is_finite():
+        raise ValueError(f"некорректный рейтинг: {value!r}")
+    return float(rating)
+
+
+def parse_reviews_count(value):
+    """Количество отзывов (int) из числа или текста вида '1 234 отзыва'."""
+    if _is_empty(value):
+        return None
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    match = DIGITS_RE.search(DIGIT_GROUP_SPACE_RE.sub('', str(value)))
+    if not match:
+        raise ValueError(f"нет числа отзывов: {value!r}")
+    return int(match.group())
+
+
+# Поле товара -> (поле результата, функция нормализации).
+# Копейки пишутся в отдельные поля: price/old_price в выгрузке остаются в рублях
+NORMALIZERS = {
+    'price': ('price_kopecks', parse_price_kopecks),
+    'old_price': ('old_price_kopecks', parse_price_kopecks),
+    'rating': ('rating', parse_rating),
+    'reviews_count': ('reviews_count', parse_reviews_count),
+}
+
+# Нормализованные поля в порядке NORMALIZERS
+NORMALIZED_FIELDS = [target for target, _ in NORMALIZERS.values()]
+
+
+def normalize_fields(values):
+    """Нормализует поля словаря на месте, возвращает ошибки {поле: исходное значение}.
+
+    Результат пишется в поле результата из ``NORMALIZERS``.
+    """
+    errors = {}
+    for field, (target, normalizer) in NORMALIZERS.items():
+        raw = values.get(field)
+        try:
+            values[target] = normalizer(raw)
+        except ValueError:
+            values[target] = None
+            errors[field] = raw
+    return errors
@@ -1,56 +1,212 @@
-import sqlite3
-import os
 import json
 from datetime import datetime
 
+from scrapy.utils.defer import deferred_from_coro
+
+from fiveka_scrapy.database import (
+    DatabaseWriter,
+    ensure_schema,
+    load_last_observations,
+    product_key,
+    read_last_observations,
+)
+from fiveka_scrapy.metrics import stage_timer, timings_for
+from fiveka_scrapy.normalize import NORMALIZED_FIELDS, normalize_fields
+from fiveka_scrapy.stores import DEFAULT_STORE
+
+
+class FivekaNormalizePipeline:
+    """Приводит цены, рейтинг и отзывы к числовым типам один раз при сборе.
+
+    Цены в копейках (int) пишутся в ``price_kopecks``/``old_price_kopecks``,
+    а ``price``/``old_price`` в выгрузке остаются в рублях. Рейтинг
+    приводится к float, отзывы к int. Значения, которые не удалось
+    разобрать, обнуляются и сохраняются как есть в ``parse_errors``.
+    """
+
+    def process_item(self, item, spider):
+        errors = normalize_fields(item)
+        item['parse_errors'] = errors or None
+        if errors:
+            spider.logger.debug(f"Не разобраны поля {sorted(errors)}: {item.get('url')}")
+        return item
+
 
 class FivekaPipeline:
-    """Pipeline для записи в SQLite базу"""
+    """Pipeline для записи в SQLite базу.
+
+    Вся работа с базой идет в отдельном потоке ``DatabaseWriter`` со своим
+    соединением: товары пишутся пачками по ``DATABASE_BATCH_SIZE`` или раз в
+    ``DATABASE_FLUSH_INTERVAL`` секунд, а реактор только кладет строки в
+    очередь.
+
+    Статические данные товара обновляются в ``products``, а цена, рейтинг и
+    отзывы добавляются в ``price_observations`` только если они изменились
+    с последнего наблюдения в том же магазине (``store_id``); тогда же
+    обновляется ``latest_products``.
+
+    С ``DATABASE_BASELINE_PATH`` (процесс шарда пишет в свою базу) последние
+    наблюдения берутся из основной базы, чтобы в базу шарда попадали только
+    изменения относительно нее.
+
+    Частичные товары (``partial``, собраны со страницы категории) не
+    затирают детальные поля, название и изображения со страницы товара.
+    Рейтинг и отзывы (а если в карточке нет цены - и цены) берутся из
+    последнего наблюдения, поэтому неизмененный товар только отмечается
+    как увиденный (``last_seen_at``).
+    """
+
+    UPSERT_PRODUCT_SQL = '''
+        INSERT INTO products
+        (product_id, article, url, name, category, description,
+         characteristics, composition, nutritional_info, image_url,
+         brand, weight, country, first_seen_at, last_seen_at, last_seen_run_id,
+         detail_scraped_at)
+        VALUES
+        (:product_id, :article, :url, :name, :category, :description,
+         :characteristics, :composition, :nutritional_info, :image_url,
+         :brand, :weight, :country, :date_scraped, :date_scraped, :run_id,
+         :detail_scraped_at)
+        ON CONFLICT(product_id) DO UPDATE SET
+            article = COALESCE(excluded.article, article),
+            url = COALESCE(excluded.url, url),
+            name = CASE WHEN excluded.detail_scraped_at IS NULL
+                        THEN COALESCE(name, excluded.name)
+                        ELSE COALESCE(excluded.name, name) END,
+            category = COALESCE(excluded.category, category),
+            description = COALESCE(excluded.description, description),
+            characteristics = COALESCE(excluded.characteristics, characteristics),
+            composition = COALESCE(excluded.composition, composition),
+            nutritional_info = COALESCE(excluded.nutritional_info, nutritional_info),
+            image_url = CASE WHEN excluded.detail_scraped_at IS NULL
+                             THEN COALESCE(image_url, excluded.image_url)
+                             ELSE COALESCE(excluded.image_url, image_url) END,
+            brand = COALESCE(excluded.brand, brand),
+            weight = COALESCE(excluded.weight, weight),
+            country = COALESCE(excluded.country, country),
+            last_seen_at = excluded.last_seen_at,
+            last_seen_run_id = excluded.last_seen_run_id,
+            detail_scraped_at = COALESCE(excluded.detail_scraped_at, detail_scraped_at)
+    '''
+
+    INSERT_OBSERVATION_SQL = '''
+        INSERT OR IGNORE INTO price_observations
+        (product_id, store_id, ts, run_id, price_kopecks, old_price_kopecks, rating,
+         reviews_count, parse_errors)
+        VALUES
+        (:product_id, :store_id, :date_scraped, :run_id, :price_kopecks, :old_price_kopecks, :rating,
+         :reviews_count, :parse_errors)
+    '''
+
+    UPSERT_LATEST_SQL = '''
+        INSERT OR REPLACE INTO latest_products
+        (product_id, store_id, run_id, price_kopecks, old_price_kopecks, rating,
+         reviews_count, parse_errors, observed_at)
+        VALUES
+        (:product_id, :store_id, :run_id, :price_kopecks, :old_price_kopecks, :rating,
+         :reviews_count, :parse_errors, :date_scraped)
+    '''
+
+    PRODUCT_FIELDS = [
+        'article', 'url', 'name', 'category', 'description', 'characteristics',
+        'composition', 'nutritional_info', 'image_url', 'brand', 'weight', 'country',
+    ]
+    OBSERVATION_FIELDS = NORMALIZED_FIELDS
+    # Поля наблюдения, которых нет в карточке категории
+    LISTING_CARRY_FIELDS = ['rating', 'reviews_count']
+
+    def __init__(self, db_path='data/fiveka_products.db', batch_size=200,
+                 flush_interval=5.0, max_queue=10000, timings=None, baseline_path=None):
+        self.db_path = db_path
+        self.baseline_path = baseline_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.writer = None
+        self.run_id = None
+        self.items_count = 0
+        self.last_observations = {}
+        # Наблюдения пачки, которые попадут в кэш только после фиксации
+        self.pending_observations = {}
+        # Время записей в базу (db.*), см. fiveka_scrapy.metrics
+        self.timings = timings
+        self.crawler = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        pipeline = cls(
+            db_path=settings.get('DATABASE_PATH', 'data/fiveka_products.db'),
+            batch_size=settings.getint('DATABASE_BATCH_SIZE', 200),
+            flush_interval=settings.getfloat('DATABASE_FLUSH_INTERVAL', 5.0),
+            max_queue=settings.getint('DATABASE_QUEUE_SIZE', 10000),
+            timings=timings_for(crawler),
+            baseline_path=settings.get('DATABASE_BASELINE_PATH'),
+        )
+        pipeline.crawler = crawler
+        return pipeline
 
     def open_spider(self, spider):
-        """Создаем базу при запуске"""
-        if not os.path.exists('data'):
-            os.makedirs('data')
-
-        self.db_path = 'data/fiveka_products.db'
-        self.conn = sqlite3.connect(self.db_path)
-        self.cursor = self.conn.cursor()
-        self.create_table()
-
-    def create_table(self):
-        """Создаем таблицу"""
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS products (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT,
-                price REAL,
-                old_price REAL,
-                article TEXT,
-                url TEXT UNIQUE,
-                category TEXT,
-                description TEXT,
-                characteristics TEXT,
-                composition TEXT,
-                nutritional_info TEXT,
-                image_url TEXT,
-                brand TEXT,
-                weight TEXT,
-                country TEXT,
-                rating REAL,
-                reviews_count INTEGER,
-                date_scraped TEXT,
-                timestamp TEXT
-            )
-        ''')
-        self.conn.commit()
+        """Запускаем поток записи в базу"""
+        self.spider_name = spider.name
+        self.writer = DatabaseWriter(
+            self.db_path,
+            setup=self.setup_database,
+            write_batch=self.write_batch,
+            teardown=self.finish_run,
+            batch_size=self.batch_size,
+            flush_interval=self.flush_interval,
+            max_queue=self.max_queue,
+            timings=self.timings,
+            on_error=lambda error: self.database_failed(spider, error),
+            after_commit=self.batch_committed,
+        )
+        self.writer.start()
+
+    def database_failed(self, spider, error):
+        """База недоступна: товары не сохранить, останавливаем паука"""
+        spider.logger.error(f"База {self.db_path} недоступна, паук останавливается: {error}")
+        engine = getattr(self.crawler, 'engine', None)
+        if engine is None:
+            return
+        if hasattr(engine, 'close_spider_async'):
+            deferred_from_coro(engine.close_spider_async(reason='database_error'))
+        else:
+            engine.close_spider(spider, 'database_error')
+
+    def setup_database(self, conn):
+        """Схема, запись о запуске и кэш последних наблюдений (в потоке записи)"""
+        ensure_schema(conn)
+        with conn:
+            self.run_id = conn.execute(
+                'INSERT INTO runs (spider, started_at) VALUES (?, ?)',
+                (self.spider_name, datetime.now().isoformat()),
+            ).lastrowid
+        if self.baseline_path:
+            self.last_observations = read_last_observations(self.baseline_path)
+        else:
+            self.last_observations = load_last_observations(conn)
+
+    def finish_run(self, conn):
+        """Отмечаем завершение запуска (в потоке записи)"""
+        conn.execute(
+            'UPDATE runs SET finished_at = ?, items_count = ? WHERE run_id = ?',
+            (datetime.now().isoformat(), self.items_count, self.run_id),
+        )
 
     def close_spider(self, spider):
-        """Закрываем соединение"""
-        if hasattr(self, 'conn'):
-            self.conn.close()
+        """Дописываем очередь и останавливаем поток записи"""
+        if self.writer is None:
+            return None
+
+        d = self.writer.close()
+        d.addCallback(lambda _: spider.logger.info(
+            f"База: записано {self.writer.written}, ошибок {self.writer.failed}"
+        ))
+        return d
 
     def process_item(self, item, spider):
-        """Сохраняем товар в базу"""
+        """Отправляем товар в очередь записи"""
         try:
             # Добавляем дату парсинга
             item['date_scraped'] = datetime.now().isoformat()
@@ -63,38 +219,62 @@ class FivekaPipeline:
             if item.get('image_url') and isinstance(item['image_url'], list):
                 item['image_url'] = json.dumps(item['image_url'], ensure_ascii=False)
 
-            # Вставляем данные
-            self.cursor.execute('''
-                INSERT OR REPLACE INTO products 
-                (name, price, old_price, article, url, category, description, 
-                 characteristics, composition, nutritional_info, image_url, 
-                 brand, weight, country, rating, reviews_count, date_scraped, timestamp)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                item.get('name'),
-                item.get('price'),
-                item.get('old_price'),
-                item.get('article'),
-                item.get('url'),
-                item.get('category'),
-                item.get('description'),
-                item.get('characteristics'),
-                item.get('composition'),
-                item.get('nutritional_info'),
-                item.get('image_url'),
-                item.get('brand'),
-                item.get('weight'),
-                item.get('country'),
-                item.get('rating'),
-                item.get('reviews_count'),
-                item.get('date_scraped'),
-                item.get('timestamp')
-            ))
-
-            self.conn.commit()
+            if item.get('parse_errors') and isinstance(item['parse_errors'], dict):
+                item['parse_errors'] = json.dumps(item['parse_errors'], ensure_ascii=False)
+
+            row = self.item_to_row(item)
+            if not row['product_id']:
+                spider.logger.warning(f"Товар без идентификатора: {item.get('url')}")
+                return item
 
         except Exception as e:
-            spider.logger.error(f"Ошибка сохранения: {e}")
-            self.conn.rollback()
+            spider.logger.error(f"Ошибка подготовки товара: {e}")
+            return item
+
+        return self.writer.submit(row, item)
+
+    def item_to_row(self, item):
+        """Параметры записи для товара"""
+        row = {field: item.get(field) for field in self.PRODUCT_FIELDS + self.OBSERVATION_FIELDS}
+        row['product_id'] = product_key(item)
+        row['store_id'] = item.get('store') or DEFAULT_STORE
+        row['date_scraped'] = item.get('date_scraped')
+        row['parse_errors'] = item.get('parse_errors')
+        row['partial'] = bool(item.get('partial'))
+        row['detail_scraped_at'] = None if row['partial'] else row['date_scraped']
+        return row
+
+    def write_batch(self, conn, rows):
+        """Записываем пачку (вызывается в потоке записи).
+
+        Кэш последних наблюдений обновляется в ``batch_committed``: если
+        транзакция откатится, наблюдения пачки запишутся при следующей встрече.
+        """
+        observations = []
+        pending = self.pending_observations = {}
+        for row in rows:
+            row['run_id'] = self.run_id
+            key = (row['product_id'], row['store_id'])
+            last = pending.get(key, self.last_observations.get(key))
+            if row['partial'] and last is not None:
+                carry = self.LISTING_CARRY_FIELDS if row['price_kopecks'] is not None else self.OBSERVATION_FIELDS
+                for field, last_value in zip(self.OBSERVATION_FIELDS, last):
+                    if field in carry and row[field] is None:
+                        row[field] = last_value
+            values = tuple(row[field] for field in self.OBSERVATION_FIELDS)
+            if last != values:
+                pending[key] = values
+                observations.append(row)
+
+        with stage_timer(self.timings, 'db.products'):
+            conn.executemany(self.UPSERT_PRODUCT_SQL, rows)
+        with stage_timer(self.timings, 'db.observations'):
+            conn.executemany(self.INSERT_OBSERVATION_SQL, observations)
+        with stage_timer(self.timings, 'db.latest'):
+            conn.executemany(self.UPSERT_LATEST_SQL, observations)
 
-        return item
\ No newline at end of file
+    def batch_committed(self, rows):
+        """Пачка зафиксирована: обновляем кэш наблюдений (в потоке записи)"""
+        self.last_observations.update(self.pending_observations)
+        self.pending_observations = {}
+        self.items_count += len(rows)
@@ -0,0 +1,134 @@
+"""
+Ожидание готовности DOM вместо фиксированных пауз.
+
+Для каждого callback'а паука задан набор условий, которые должны
+выполниться, чтобы страницу можно было парсить. Правило выбирается по
+``request.meta['readiness']`` или по имени callback'а.
+"""
+
+import time
+import logging
+
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+
+logger = logging.getLogger(__name__)
+
+
+class ElementsPresent:
+    """Все селекторы нашли хотя бы по одному элементу."""
+
+    def __init__(self, *selectors):
+        self.selectors = selectors
+
+    def __call__(self, driver):
+        return all(driver.find_elements(By.CSS_SELECTOR, s) for s in self.selectors)
+
+
+class AnyPresent:
+    """Хотя бы один из селекторов нашел элемент."""
+
+    def __init__(self, *selectors):
+        self.selectors = selectors
+
+    def __call__(self, driver):
+        return any(driver.find_elements(By.CSS_SELECTOR, s) for s in self.selectors)
+
+
+class StableCount:
+    """Количество элементов больше нуля и не меняется ``settle`` секунд."""
+
+    def __init__(self, selector, settle=0.5):
+        self.selector = selector
+        self.settle = settle
+        self.last_count = -1
+        self.since = 0.0
+
+    def __call__(self, driver):
+        count = len(driver.find_elements(By.CSS_SELECTOR, self.selector))
+        now = time.monotonic()
+        if count != self.last_count:
+            self.last_count = count
+            self.since = now
+            return False
+        return count > 0 and now - self.since >= self.settle
+
+
+# Правила готовности: имя -> фабрика списка условий.
+# Условия с состоянием (StableCount) создаются заново на каждый запрос.
+READINESS_RULES = {
+    'parse': lambda: [
+        AnyPresent('a[data-qa^="section-category-item-"]', 'a.chakra-link.css-1mjqhey'),
+    ],
+    'parse_category': lambda: [
+        StableCount('div[data-qa^="product-card-"]'),
+    ],
+    # Цены у товара может не быть (нет в наличии), поэтому ждем только заголовок
+    'parse_product': lambda: [
+        ElementsPresent('h1[data-qa="product-card-title"]'),
+    ],
+}
+
+
+def rule_name(request):
+    """Имя правила готовности для запроса."""
+    hint = request.meta.get('readiness')
+    if hint:
+        return hint
+    callback = request.callback
+    if callback is None:
+        return 'parse'
+    return getattr(callback, '__name__', None)
+
+
+class ReadinessWaiter:
+    """Ждет выполнения условий готовности для запроса."""
+
+    def __init__(self, timeout=15, poll=0.1, rules=None):
+        self.timeout = timeout
+        self.poll = poll
+        self.rules = rules if rules is not None else READINESS_RULES
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            timeout=settings.getfloat('SELENIUM_READY_TIMEOUT', 15),
+            poll=settings.getfloat('SELENIUM_READY_POLL', 0.1),
+        )
+
+    def wait(self, driver, request):
+        """Возвращает True, если страница готова, False по таймауту."""
+        name = rule_name(request)
+        factory = self.rules.get(name)
+        if factory is None:
+            return True
+
+        conditions = factory()
+        try:
+            WebDriverWait(driver, self.timeout, poll_frequency=self.poll).until(
+                lambda d: all(condition(d) for condition in conditions)
+            )
+            return True
+        except TimeoutException:
+            logger.warning(f"Страница не готова за {self.timeout} с ({name}): {request.url}")
+            return False
+
+
+# Маркеры, по которым проверяется ответ, полученный обычным HTTP без браузера.
+# Если маркеров нет (антибот, клиентский рендеринг), страница
+# перезапрашивается через Selenium.
+HTTP_MARKERS = {
+    'parse_category': ['div[data-qa^="product-card-"]'],
+    'parse_product': ['meta[itemprop="price"]', 'h1'],
+}
+
+
+def has_markers(response, name):
+    """Проверяет, что HTTP ответ содержит все маркеры правила."""
+    markers = HTTP_MARKERS.get(name)
+    if not markers:
+        return True
+    if not hasattr(response, 'css'):
+        return False
+    return all(response.css(marker) for marker in markers)
@@ -0,0 +1,240 @@
+"""
+Повторы неудачных загрузок.
+
+Selenium middleware при таймауте или ошибке браузера бросает
+``RenderTimeout``/``RenderError`` вместо пустых ответов 408/500, поэтому
+ошибочные страницы не попадают в колбэки. ``BackoffRetryMiddleware``
+заменяет стандартный ``RetryMiddleware``:
+
+* повтор получает приоритет ниже на ``RETRY_PRIORITY_ADJUST`` за каждую
+  попытку и уходит в конец очереди;
+* повтор встает в очередь через ``RETRY_BACKOFF_BASE * 2 ** (попытка - 1)``
+  секунд (не больше ``RETRY_BACKOFF_MAX``); задержку отсчитывает реактор,
+  а не загрузчик, поэтому ожидающий повтор не занимает слот загрузки,
+  исходный запрос завершается ``RetryScheduled``;
+* бюджет ``RETRY_TIMES`` (или meta ``max_retry_times``) считается по
+  каноническому URL, а не по объекту запроса, поэтому копии запроса
+  (откат гибридного режима на Selenium) расходуют общий бюджет;
+* URL, исчерпавшие бюджет, записываются в таблицу ``dead_letters``,
+  а подписчики получают сигнал ``request_dead_lettered``.
+"""
+
+import logging
+import random
+import time
+from datetime import datetime
+
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest, NotConfigured
+from scrapy.utils.misc import load_object
+from scrapy.utils.python import global_object_name
+
+from fiveka_scrapy.database import DatabaseWriter, ensure_schema
+from fiveka_scrapy.dupefilters import url_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# Сигнал: запрос исчерпал повторы и записан в dead letters (request)
+request_dead_lettered = object()
+
+
+class RenderError(Exception):
+    """Браузер не смог отрендерить страницу"""
+
+    status = 500
+
+
+class RenderTimeout(RenderError):
+    """Страница не загрузилась за SELENIUM_PAGE_LOAD_TIMEOUT"""
+
+    status = 408
+
+
+class RetryScheduled(IgnoreRequest):
+    """Повтор запроса отложен и встанет в очередь после задержки"""
+
+
+class BackoffRetryMiddleware:
+    """Повторы с экспоненциальной задержкой, бюджетом на URL и dead letters"""
+
+    def __init__(self, crawler, max_retry_times=3, retry_http_codes=(), exceptions=(),
+                 priority_adjust=-1, backoff_base=5.0, backoff_max=300.0,
+                 dead_letter_path=None, flush_interval=5.0):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.max_retry_times = max_retry_times
+        self.retry_http_codes = set(retry_http_codes)
+        self.exceptions = (RenderError,) + tuple(exceptions)
+        self.priority_adjust = priority_adjust
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.dead_letter_path = dead_letter_path
+        self.flush_interval = flush_interval
+        self.failures = {}
+        self.delayed = {}
+        self.writer = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('RETRY_ENABLED'):
+            raise NotConfigured
+        dead_letter_path = None
+        if settings.getbool('DEAD_LETTER_ENABLED', True):
+            dead_letter_path = settings.get('DATABASE_PATH', 'data/fiveka_products.db')
+        middleware = cls(
+            crawler,
+            max_retry_times=settings.getint('RETRY_TIMES'),
+            retry_http_codes=[int(code) for code in settings.getlist('RETRY_HTTP_CODES')],
+            exceptions=[
+                load_object(e) if isinstance(e, str) else e
+                for e in settings.getlist('RETRY_EXCEPTIONS')
+            ],
+            priority_adjust=settings.getint('RETRY_PRIORITY_ADJUST'),
+            backoff_base=settings.getfloat('RETRY_BACKOFF_BASE', 5.0),
+            backoff_max=settings.getfloat('RETRY_BACKOFF_MAX', 300.0),
+            dead_letter_path=dead_letter_path,
+            flush_interval=settings.getfloat('DATABASE_FLUSH_INTERVAL', 5.0),
+        )
+        crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(middleware.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def spider_opened(self, spider):
+        if self.dead_letter_path:
+            self.writer = DatabaseWriter(
+                self.dead_letter_path,
+                setup=ensure_schema,
+                write_batch=self.write_dead_letters,
+                batch_size=50,
+                flush_interval=self.flush_interval,
+            )
+            self.writer.start()
+
+    def spider_idle(self, spider):
+        # Отложенные повторы еще не в очереди планировщика
+        if self.delayed:
+            raise DontCloseSpider
+
+    def spider_closed(self, spider):
+        for call in self.delayed.values():
+            if call.active():
+                call.cancel()
+        if self.delayed:
+            logger.warning(f"Отменено отложенных повторов: {len(self.delayed)}")
+        self.delayed.clear()
+        if self.writer is None:
+            return None
+        return self.writer.close()
+
+    # Загрузчик
+
+    def process_response(self, request, response, spider=None):
+        if request.meta.get('dont_retry') or response.status not in self.retry_http_codes:
+            self.failures.pop(self.fingerprint(request), None)
+            return response
+        retry_request = self.retry(request, f'{response.status}', response.status)
+        if retry_request is None:
+            return response
+        return self.schedule(retry_request)
+
+    def process_exception(self, request, exception, spider=None):
+        if request.meta.get('dont_retry') or not isinstance(exception, self.exceptions):
+            return None
+        status = getattr(exception, 'status', None)
+        retry_request = self.retry(request, exception, status)
+        if retry_request is None:
+            return None
+        return self.schedule(retry_request)
+
+    # Повторы
+
+    def fingerprint(self, request):
+        return url_fingerprint(request.url, method=request.method, store=request.meta.get('store'))
+
+    def retry(self, request, reason, status=None):
+        """Копия запроса для повтора или None, если бюджет URL исчерпан"""
+        if isinstance(reason, Exception):
+            message = str(reason)
+            reason = global_object_name(reason.__class__)
+        else:
+            message = reason
+
+        fp = self.fingerprint(request)
+        attempts = max(self.failures.get(fp, 0), request.meta.get('retry_times', 0)) + 1
+        max_retry_times = request.meta.get('max_retry_times')
+        if max_retry_times is None:
+            max_retry_times = self.max_retry_times
+
+        if attempts > max_retry_times:
+            self.failures.pop(fp, None)
+            self.stats.inc_value('retry/max_reached')
+            logger.error(f"Отказ после {attempts} попыток ({reason}): {request.url}")
+            self.dead_letter(request, reason, message, attempts, status)
+            return None
+
+        self.failures[fp] = attempts
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        delay *= random.uniform(0.75, 1.25)
+
+        retry_request = request.copy()
+        retry_request.meta['retry_times'] = attempts
+        retry_request.meta['retry_not_before'] = time.time() + delay
+        retry_request.dont_filter = True
+        retry_request.priority = request.priority + self.priority_adjust
+
+        self.stats.inc_value('retry/count')
+        self.stats.inc_value(f'retry/reason_count/{reason}')
+        logger.info(f"Повтор {attempts}/{max_retry_times} через {delay:.0f} с ({reason}): {request.url}")
+        return retry_request
+
+    def schedule(self, retry_request):
+        """Ставит повтор в очередь после задержки, не занимая загрузчик"""
+        wait = retry_request.meta['retry_not_before'] - time.time()
+        if wait <= 0:
+            return retry_request
+
+        from twisted.internet import reactor
+
+        self.delayed[id(retry_request)] = reactor.callLater(wait, self.enqueue, retry_request)
+        raise RetryScheduled(f"Повтор через {wait:.0f} с: {retry_request.url}")
+
+    def enqueue(self, retry_request):
+        self.delayed.pop(id(retry_request), None)
+        engine = self.crawler.engine
+        if engine is None or not engine.running:
+            return
+        engine.crawl(retry_request)
+
+    def dead_letter(self, request, reason, message, attempts, status):
+        self.stats.inc_value('fiveka/dead_letters')
+        self.crawler.signals.send_catch_log(request_dead_lettered, request=request)
+        if self.writer is None or self.writer.error is not None:
+            return
+        callback = request.callback.__name__ if callable(request.callback) else request.callback
+        self.writer.submit((
+            request.url,
+            callback,
+            reason,
+            (message or '')[:1000],
+            status,
+            attempts,
+            datetime.now().isoformat(),
+        ))
+
+    def write_dead_letters(self, conn, rows):
+        """Запись отказов (в потоке записи); повторный отказ обновляет строку"""
+        conn.executemany('''
+            INSERT INTO dead_letters
+                (url, callback, reason, message, status, attempts, failed_at, first_failed_at, failures)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)
+            ON CONFLICT(url) DO UPDATE SET
+                callback = excluded.callback,
+                reason = excluded.reason,
+                message = excluded.message,
+                status = excluded.status,
+                attempts = excluded.attempts,
+                failed_at = excluded.failed_at,
+                failures = failures + 1
+        ''', [row + (row[-1],) for row in rows])
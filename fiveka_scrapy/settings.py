@@ -9,31 +9,128 @@ NEWSPIDER_MODULE = 'fiveka_scrapy.spiders'
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = False
 
+# Количество одновременно открытых браузеров
+SELENIUM_POOL_SIZE = 4
+
 # Configure maximum concurrent requests
-CONCURRENT_REQUESTS = 1
-CONCURRENT_REQUESTS_PER_DOMAIN = 1
-CONCURRENT_REQUESTS_PER_IP = 1
+CONCURRENT_REQUESTS = SELENIUM_POOL_SIZE
+CONCURRENT_REQUESTS_PER_DOMAIN = SELENIUM_POOL_SIZE
+CONCURRENT_REQUESTS_PER_IP = SELENIUM_POOL_SIZE
 
 # Configure a delay for requests
-DOWNLOAD_DELAY = 10
+DOWNLOAD_DELAY = 2
 RANDOMIZE_DOWNLOAD_DELAY = True
 
+# Адаптивный троттлинг: задержка и параллельность подстраиваются под время
+# рендеринга, долю ответов 408/500 и признаки блокировки (капча, 403, 429).
+# DOWNLOAD_DELAY - начальная задержка
+ADAPTIVE_THROTTLE_ENABLED = True
+ADAPTIVE_THROTTLE_MIN_DELAY = 0.5
+ADAPTIVE_THROTTLE_MAX_DELAY = 60
+ADAPTIVE_THROTTLE_MIN_CONCURRENCY = 1
+ADAPTIVE_THROTTLE_MAX_CONCURRENCY = SELENIUM_POOL_SIZE
+ADAPTIVE_THROTTLE_WINDOW = 20        # Ответов в окне оценки
+ADAPTIVE_THROTTLE_ERROR_RATE = 0.2   # Доля 408/500, при которой сбавляем темп
+ADAPTIVE_THROTTLE_COOLDOWN = 120     # Секунд без разгона после блокировки
+ADAPTIVE_THROTTLE_BLOCK_MARKERS = ['captcha', 'Доступ ограничен', 'не робот']
+
 # Enable or disable downloader middlewares
 DOWNLOADER_MIDDLEWARES = {
     'fiveka_scrapy.middlewares.FivekaSeleniumMiddleware': 543,
     'scrapy.downloadermiddlewares.useragent.UserAgentMiddleware': None,
+    # Повторы с задержкой и dead letters вместо стандартного RetryMiddleware;
+    # стоит раньше Selenium, чтобы получать его ответы и ошибки рендеринга
+    'scrapy.downloadermiddlewares.retry.RetryMiddleware': None,
+    'fiveka_scrapy.retry.BackoffRetryMiddleware': 540,
+    # Снимки страниц: запись ответов или воспроизведение без браузера
+    'fiveka_scrapy.snapshots.SnapshotMiddleware': 541,
+    # Общая очередь: незагруженный запрос помечается сбойным (только с BROKER_ENABLED)
+    'fiveka_scrapy.broker.BrokerFailMiddleware': 10,
+}
+
+# Снимки отрендеренных страниц для отладки и бенчмарков парсера
+SNAPSHOT_MODE = None                  # None, 'record' или 'replay'
+SNAPSHOT_DIR = 'data/snapshots'
+SNAPSHOT_COMPRESSION = 'zstd'         # 'zstd' (нужен zstandard) или 'gzip'
+SNAPSHOT_REPLAY_DATABASE = 'data/replay_products.db'  # База для товаров из воспроизведения
+
+# Повторы неудачных загрузок
+RETRY_TIMES = 3               # Повторов на URL за запуск
+RETRY_PRIORITY_ADJUST = -10   # Повтор уходит в конец очереди
+RETRY_BACKOFF_BASE = 5.0      # Задержка первого повтора, дальше удваивается, сек
+RETRY_BACKOFF_MAX = 300.0
+DEAD_LETTER_ENABLED = True    # URL без ответа после всех повторов - в таблицу dead_letters
+
+# Фронтир обхода: запросы и прогресс категорий для продолжения после падения
+SPIDER_MIDDLEWARES = {
+    'fiveka_scrapy.frontier.FrontierMiddleware': 50,
+    'fiveka_scrapy.broker.BrokerAckMiddleware': 55,
 }
 
+# Дедупликация запросов по 64-битным отпечаткам URL без трекинговых параметров
+DUPEFILTER_CLASS = 'fiveka_scrapy.dupefilters.CompactDupeFilter'
+DUPEFILTER_BACKEND = 'array'      # 'array' - точно, 'bloom' - фиксированная память
+DUPEFILTER_CAPACITY = 1000000     # Ожидаемое число URL для фильтра Блума
+DUPEFILTER_ERROR_RATE = 0.001     # Доля ложных срабатываний фильтра Блума
+
 # Enable or disable extensions
 EXTENSIONS = {
     'scrapy.extensions.telnet.TelnetConsole': None,
+    'fiveka_scrapy.metrics.MetricsExtension': 500,
 }
 
+# Метрики: время этапов (render.*, extract.*, db.*) в статистике Scrapy,
+# периодический JSON-дамп и эндпоинт Prometheus http://127.0.0.1:9410/metrics
+METRICS_ENABLED = True
+METRICS_INTERVAL = 30.0                       # Как часто публиковать, сек
+METRICS_JSON_PATH = 'data/metrics.json'       # None - без дампа
+METRICS_PORT = None                           # Например 9410; None - без эндпоинта
+METRICS_HOST = '127.0.0.1'
+
 # Configure item pipelines
 ITEM_PIPELINES = {
+    'fiveka_scrapy.pipelines.FivekaNormalizePipeline': 200,
     'fiveka_scrapy.pipelines.FivekaPipeline': 300,
 }
 
+# База данных
+DATABASE_PATH = 'data/fiveka_products.db'
+DATABASE_BATCH_SIZE = 200       # Товаров в одной транзакции
+DATABASE_FLUSH_INTERVAL = 5.0   # Максимальное время хранения буфера, сек
+DATABASE_QUEUE_SIZE = 10000     # Размер очереди записи, дальше - backpressure
+# База с последним состоянием каталога, если товары пишутся в другую
+# (выставляется процессам шардов, их базы сливаются в DATABASE_PATH)
+DATABASE_BASELINE_PATH = None
+
+# Фронтир обхода (python run.py --resume продолжает прерванный обход)
+FRONTIER_ENABLED = True
+FRONTIER_PATH = 'data/frontier.db'
+FRONTIER_RESUME = False
+FRONTIER_COMMIT_INTERVAL = 2.0  # Как часто фиксировать фронтир, сек
+
+# Шардированный запуск (python run.py --shards N): список категорий собирается
+# один раз, у каждого процесса свой пул браузеров и троттлинг, база общая
+SHARD_CATEGORIES_PATH = 'data/shards/categories.json'
+
+# Общая очередь запросов для нескольких узлов (python run.py --broker):
+# запросы берутся из брокера в аренду и подтверждаются после обработки
+BROKER_ENABLED = False
+BROKER_CLASS = 'fiveka_scrapy.broker.SqliteBroker'
+BROKER_PATH = 'data/broker.db'
+BROKER_WORKER_ID = None            # None - имя хоста и pid
+BROKER_VISIBILITY_TIMEOUT = 300    # Через сколько секунд без продления аренда истекает
+BROKER_MAX_DELIVERIES = 5          # Сколько раз выдавать запрос без подтверждения
+BROKER_RESET = False               # Очистить очередь при старте (новый обход)
+
+# Магазины: цены зависят от выбранного магазина. У каждого магазина свой пул
+# браузеров (SELENIUM_POOL_SIZE делится между ними), cookies и localStorage
+# выбора магазина выставляются при запуске браузера:
+# STORES = [{'id': 'msk-1', 'cookies': {...}, 'local_storage': {...}}, ...]
+# Пустой список - без контекста магазина (как выбрано на сайте по умолчанию)
+STORES = []
+# Отпечаток запроса учитывает meta['store'] (фронтир, брокер)
+REQUEST_FINGERPRINTER_CLASS = 'fiveka_scrapy.stores.StoreRequestFingerprinter'
+
 # Enable and configure HTTP caching
 HTTPCACHE_ENABLED = False
 
@@ -58,6 +155,36 @@ SELENIUM_HEADLESS = False  # True для продакшена, False для от
 SELENIUM_WINDOW_SIZE = '1920,1080'
 SELENIUM_PAGE_LOAD_TIMEOUT = 30
 SELENIUM_IMPLICIT_WAIT = 10
+SELENIUM_READY_TIMEOUT = 15  # Ожидание условий готовности страницы, сек
+SELENIUM_READY_POLL = 0.1    # Интервал проверки условий, сек
+
+# Блокировка тяжелых ресурсов (CDP Network.setBlockedURLs): нужен только DOM,
+# ссылки на изображения берутся из атрибутов
+SELENIUM_BLOCK_RESOURCES = True
+SELENIUM_BLOCKED_RESOURCES = {
+    # тип ресурса -> домены, где он блокируется ('*' - везде)
+    'image': ['*'],
+    'font': ['*'],
+    'media': ['*'],
+}
+SELENIUM_BLOCKED_DOMAINS = [
+    'mc.yandex.ru', 'google-analytics.com', 'googletagmanager.com',
+    'top-fwz1.mail.ru', 'vk.com', 'doubleclick.net',
+]
+# Постоянные профили Chrome (по одному на место в пуле) с дисковым кэшем
+SELENIUM_PROFILE_DIR = 'data/chrome_profiles'  # None - временный профиль
+SELENIUM_DISK_CACHE_SIZE = 200 * 1024 * 1024
+
+# Перезапуск браузеров в долгих обходах: Chrome со временем разрастается по памяти
+SELENIUM_MAX_PAGES_PER_DRIVER = 200  # 0 - без ограничения
+SELENIUM_MAX_RSS_MB = 1500           # Память браузера с дочерними процессами (нужен psutil), 0 - не проверять
+SELENIUM_SPARE_DRIVER = True         # Заранее запущенный запасной драйвер на замену
+SELENIUM_CRASH_RETRIES = 1           # Повторов запроса новым драйвером, если браузер упал
+
+# Гибридный режим: браузер только для получения сессии,
+# страницы из HYBRID_CALLBACKS качаются обычным HTTP с откатом на Selenium
+HYBRID_DOWNLOAD = True
+HYBRID_CALLBACKS = ['parse_category', 'parse_product']
 
 # Настройки сайта
 BASE_URL = 'https://5ka.ru'
@@ -71,7 +198,21 @@ USER_AGENTS = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0',
 ]
 
+# Реестр селекторов (None - fiveka_scrapy/selectors.json). Файл перечитывается
+# на лету, если изменился; после правки поднимайте version
+SELECTOR_REGISTRY = None
+SELECTOR_RELOAD_INTERVAL = 30   # Как часто проверять изменения реестра, сек
+SELECTOR_MISS_THRESHOLD = 20    # Промахов подряд по обязательному полю до предупреждения
+
 # Настройки парсинга
 PARSE_CATEGORIES = True  # Парсить категории
 MAX_CATEGORIES = None    # Ограничить количество категорий (None - все)
-MAX_PAGES_PER_CATEGORY = 10  # Максимальное количество страниц на категорию
\ No newline at end of file
+MAX_PAGES_PER_CATEGORY = 10  # Максимальное количество страниц на категорию
+
+# Товары из карточек категорий: цены и базовые данные берутся из карточек,
+# страницы товаров загружаются только для новых товаров и товаров, у которых
+# нет или устарели детальные поля (характеристики, состав, КБЖУ).
+# По умолчанию - полный обход страниц товаров
+LISTING_ITEMS = False
+INCREMENTAL_CRAWL = False    # Прежнее имя режима, включает его и при LISTING_ITEMS = False
+INCREMENTAL_TTL_HOURS = 168  # Через сколько часов карточку товара собираем заново
\ No newline at end of file
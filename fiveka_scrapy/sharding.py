@@ -0,0 +1,238 @@
+"""
+Разбиение обхода по категориям на несколько процессов.
+
+Список категорий один раз собирается отдельным запуском паука
+(``discover_file``), затем делится на ``shards`` частей; каждый процесс
+обходит свою часть со своим пулом браузеров, фронтиром и профилями Chrome.
+
+Каждый шард пишет товары в свою базу (``data/fiveka_products.shard-0.db``),
+а последние наблюдения и состояние каталога берет из основной
+(``DATABASE_BASELINE_PATH``). После завершения шардов ``merge_shard_database``
+переносит их базы в основную одним процессом: товар из категорий разных
+шардов получает одно наблюдение, а не по одному от каждого шарда.
+"""
+
+import json
+import logging
+import os
+
+from fiveka_scrapy.database import connect, ensure_schema, load_last_observations
+
+logger = logging.getLogger(__name__)
+
+OBSERVATION_COLUMNS = ['price_kopecks', 'old_price_kopecks', 'rating', 'reviews_count']
+
+MERGE_PRODUCTS_SQL = '''
+    INSERT INTO products
+    (product_id, article, url, name, category, description,
+     characteristics, composition, nutritional_info, image_url,
+     brand, weight, country, first_seen_at, last_seen_at, last_seen_run_id,
+     detail_scraped_at)
+    SELECT product_id, article, url, name, category, description,
+           characteristics, composition, nutritional_info, image_url,
+           brand, weight, country, first_seen_at, last_seen_at, :run_id,
+           detail_scraped_at
+    FROM shard.products WHERE last_seen_run_id = :shard_run_id
+    ON CONFLICT(product_id) DO UPDATE SET
+        article = COALESCE(excluded.article, article),
+        url = COALESCE(excluded.url, url),
+        name = CASE WHEN excluded.detail_scraped_at IS NULL
+                    THEN COALESCE(name, excluded.name)
+                    ELSE COALESCE(excluded.name, name) END,
+        category = COALESCE(excluded.category, category),
+        description = COALESCE(excluded.description, description),
+        characteristics = COALESCE(excluded.characteristics, characteristics),
+        composition = COALESCE(excluded.composition, composition),
+        nutritional_info = COALESCE(excluded.nutritional_info, nutritional_info),
+        image_url = CASE WHEN excluded.detail_scraped_at IS NULL
+                         THEN COALESCE(image_url, excluded.image_url)
+                         ELSE COALESCE(excluded.image_url, image_url) END,
+        brand = COALESCE(excluded.brand, brand),
+        weight = COALESCE(excluded.weight, weight),
+        country = COALESCE(excluded.country, country),
+        last_seen_at = MAX(last_seen_at, excluded.last_seen_at),
+        last_seen_run_id = excluded.last_seen_run_id,
+        detail_scraped_at = COALESCE(
+            MAX(excluded.detail_scraped_at, detail_scraped_at),
+            excluded.detail_scraped_at, detail_scraped_at
+        )
+'''
+
+MERGE_DEAD_LETTERS_SQL = '''
+    INSERT INTO dead_letters
+        (url, callback, reason, message, status, attempts, failures, first_failed_at, failed_at)
+    SELECT url, callback, reason, message, status, attempts, failures, first_failed_at, failed_at
+    FROM shard.dead_letters WHERE true
+    ON CONFLICT(url) DO UPDATE SET
+        callback = excluded.callback,
+        reason = excluded.reason,
+        message = excluded.message,
+        status = excluded.status,
+        attempts = excluded.attempts,
+        failed_at = excluded.failed_at,
+        failures = failures + excluded.failures
+'''
+
+
+def shard_path(path, shard):
+    """data/frontier.db -> data/frontier.shard-0.db"""
+    root, ext = os.path.splitext(path)
+    return f'{root}.shard-{shard}{ext}'
+
+
+def save_categories(path, categories):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(categories, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_categories(path):
+    """Список категорий [{'url': ..., 'name': ...}]"""
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def shard_categories(categories, shard, shards):
+    """Категории шарда: по кругу в порядке URL.
+
+    Сортировка делает разбиение независимым от порядка ссылок в каталоге.
+    """
+    if not 0 <= shard < shards:
+        raise ValueError(f"Номер шарда {shard} вне диапазона 0..{shards - 1}")
+    ordered = sorted(categories, key=lambda category: category['url'])
+    return ordered[shard::shards]
+
+
+def shard_settings(settings, shard):
+    """Отдельные база, фронтир, профили Chrome, лог, метрики и выгрузка для процесса шарда.
+
+    Последние наблюдения шард берет из основной базы.
+    """
+    db_path = settings.get('DATABASE_PATH', 'data/fiveka_products.db')
+    overrides = {
+        'DATABASE_PATH': shard_path(db_path, shard),
+        'DATABASE_BASELINE_PATH': db_path,
+        'FRONTIER_PATH': shard_path(settings.get('FRONTIER_PATH', 'data/frontier.db'), shard),
+        'FEEDS': {
+            shard_path(path, shard): options
+            for path, options in settings.getdict('FEEDS').items()
+        },
+    }
+    if settings.get('SELENIUM_PROFILE_DIR'):
+        overrides['SELENIUM_PROFILE_DIR'] = os.path.join(
+            settings.get('SELENIUM_PROFILE_DIR'), f'shard-{shard}'
+        )
+    if settings.get('METRICS_JSON_PATH'):
+        overrides['METRICS_JSON_PATH'] = shard_path(settings.get('METRICS_JSON_PATH'), shard)
+    if settings.getint('METRICS_PORT'):
+        # Шарды занимают порты следом за METRICS_PORT
+        overrides['METRICS_PORT'] = settings.getint('METRICS_PORT') + shard + 1
+    if settings.get('LOG_FILE'):
+        overrides['LOG_FILE'] = shard_path(settings.get('LOG_FILE'), shard)
+    return overrides
+
+
+def merge_shard_databases(db_path, shard_db_paths):
+    """Переносит базы шардов в основную и удаляет их.
+
+    Запуски шардов копируются с новыми run_id, товары сливаются так же, как
+    при записи пайплайном. Наблюдения всех шардов идут по времени и пишутся,
+    только если отличаются от последнего наблюдения товара в магазине.
+    Возвращает (товаров, наблюдений).
+    """
+    shard_db_paths = [path for path in shard_db_paths if os.path.exists(path)]
+    if not shard_db_paths:
+        return 0, 0
+
+    conn = connect(db_path)
+    try:
+        ensure_schema(conn)
+        products = 0
+        observations = []
+        for shard_db_path in shard_db_paths:
+            shard_conn = connect(shard_db_path)
+            try:
+                # Схема шарда могла отстать, если он не дошел до записи
+                ensure_schema(shard_conn)
+            finally:
+                shard_conn.close()
+
+            conn.execute('ATTACH DATABASE ? AS shard', (shard_db_path,))
+            try:
+                with conn:
+                    products += _merge_attached(conn, observations)
+            finally:
+                conn.execute('DETACH DATABASE shard')
+
+        with conn:
+            written = _merge_observations(conn, observations)
+    finally:
+        conn.close()
+
+    for shard_db_path in shard_db_paths:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(shard_db_path + suffix):
+                os.remove(shard_db_path + suffix)
+    return products, written
+
+
+def _merge_attached(conn, observations):
+    """Запуски, товары и dead letters шарда; наблюдения - в ``observations``"""
+    products = 0
+    shard_runs = conn.execute(
+        'SELECT run_id, spider, started_at, finished_at, items_count FROM shard.runs ORDER BY run_id'
+    ).fetchall()
+    for shard_run_id, spider, started_at, finished_at, items_count in shard_runs:
+        run_id = conn.execute(
+            'INSERT INTO runs (spider, started_at, finished_at, items_count) VALUES (?, ?, ?, ?)',
+            (spider, started_at, finished_at, items_count),
+        ).lastrowid
+        products += conn.execute(
+            MERGE_PRODUCTS_SQL, {'run_id': run_id, 'shard_run_id': shard_run_id}
+        ).rowcount
+        rows = conn.execute(
+            f'SELECT product_id, store_id, ts, {", ".join(OBSERVATION_COLUMNS)}, parse_errors '
+            f'FROM shard.price_observations WHERE run_id = ?',
+            (shard_run_id,),
+        )
+        observations.extend((*row[:3], run_id, *row[3:]) for row in rows)
+
+    conn.execute(MERGE_DEAD_LETTERS_SQL)
+    return products
+
+
+def _merge_observations(conn, observations):
+    """Пишет изменившиеся наблюдения по времени, возвращает их число"""
+    last_observations = load_last_observations(conn)
+    changed = []
+    for row in sorted(observations, key=lambda row: row[2]):
+        key = (row[0], row[1])
+        values = tuple(row[4:4 + len(OBSERVATION_COLUMNS)])
+        if last_observations.get(key) == values:
+            continue
+        last_observations[key] = values
+        changed.append(row)
+
+    columns = ', '.join(OBSERVATION_COLUMNS)
+    conn.executemany(
+        f'INSERT OR IGNORE INTO price_observations '
+        f'(product_id, store_id, ts, run_id, {columns}, parse_errors) '
+        f'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        changed,
+    )
+    # Основная база могла получить более новые наблюдения, пока шли шарды
+    conn.executemany(
+        f'INSERT INTO latest_products '
+        f'(product_id, store_id, observed_at, run_id, {columns}, parse_errors) '
+        f'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+        f'ON CONFLICT(product_id, store_id) DO UPDATE SET '
+        f'observed_at = excluded.observed_at, run_id = excluded.run_id, '
+        + ', '.join(f'{column} = excluded.{column}' for column in OBSERVATION_COLUMNS)
+        + ', parse_errors = excluded.parse_errors WHERE excluded.observed_at >= observed_at',
+        changed,
+    )
+    return len(changed)
@@ -0,0 +1,279 @@
+"""
+Хранилище снимков отрендеренных страниц и режим воспроизведения.
+
+Страницы хранятся по хэшу содержимого (sha256) в сжатом виде (zstd, если
+установлен ``zstandard``, иначе gzip): одинаковые страницы занимают место
+один раз. Индекс URL -> хэш лежит в SQLite рядом с объектами::
+
+    data/snapshots/index.db
+    data/snapshots/objects/ab/abcdef....html.zst
+
+``SnapshotMiddleware`` с ``SNAPSHOT_MODE = 'record'`` сохраняет успешные
+ответы, а с ``SNAPSHOT_MODE = 'replay'`` отдает сохраненные страницы без
+браузера и сети; запросы без снимка отбрасываются. При записи сжатие и
+запись файла идут в пуле потоков, а строки индекса пишутся пачками
+через ``DatabaseWriter``, поэтому реактор не ждет диска.
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+import threading
+from datetime import datetime
+
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import HtmlResponse
+from twisted.internet import defer, threads
+from w3lib.url import canonicalize_url
+
+from fiveka_scrapy.database import DatabaseWriter, connect
+from fiveka_scrapy.dupefilters import strip_tracking
+from fiveka_scrapy.readiness import rule_name
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {'zstd': '.html.zst', 'gzip': '.html.gz'}
+
+
+def snapshot_key(url, store=None):
+    """Ключ индекса: канонизированный URL без трекинговых параметров.
+
+    Страницы магазинов различаются фрагментом ``#store=<id>``.
+    """
+    key = canonicalize_url(strip_tracking(url))
+    if store:
+        key = f'{key}#store={store}'
+    return key
+
+
+def ensure_index(conn):
+    """Создает таблицу индекса страниц"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS pages (
+            url TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            codec TEXT NOT NULL,
+            callback TEXT,
+            size INTEGER,
+            stored_at TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pages_callback ON pages(callback)')
+
+
+class SnapshotStore:
+    """Сжатые страницы по хэшу содержимого и индекс URL -> хэш"""
+
+    def __init__(self, path, compression='zstd'):
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Неизвестное сжатие снимков: {compression}")
+        if compression == 'zstd' and zstandard is None:
+            logger.warning("zstandard не установлен, снимки сжимаются gzip")
+            compression = 'gzip'
+
+        self.path = path
+        self.compression = compression
+        self.objects_dir = os.path.join(path, 'objects')
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+        self.index_path = os.path.join(path, 'index.db')
+        self.conn = connect(self.index_path)
+        ensure_index(self.conn)
+        self.conn.commit()
+
+    def object_path(self, digest, codec):
+        return os.path.join(self.objects_dir, digest[:2], digest + EXTENSIONS[codec])
+
+    def compress(self, body):
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor(level=10).compress(body)
+        return gzip.compress(body, compresslevel=6)
+
+    @staticmethod
+    def decompress(data, codec):
+        if codec == 'zstd':
+            if zstandard is None:
+                raise RuntimeError("Для чтения снимков .zst нужен пакет zstandard")
+            return zstandard.ZstdDecompressor().decompress(data)
+        return gzip.decompress(data)
+
+    def put(self, url, body, callback=None, store=None):
+        """Сохраняет страницу, возвращает хэш содержимого"""
+        digest = self.write_object(body)
+        self.write_index(self.conn, [self.index_row(url, digest, len(body), callback, store)])
+        self.conn.commit()
+        return digest
+
+    def write_object(self, body):
+        """Сжимает и записывает страницу, возвращает хэш (можно из любого потока)"""
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.object_path(digest, self.compression)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(self.compress(body))
+            os.replace(tmp_path, path)
+        return digest
+
+    def index_row(self, url, digest, size, callback=None, store=None):
+        return (snapshot_key(url, store), digest, self.compression, callback, size,
+                datetime.now().isoformat())
+
+    @staticmethod
+    def write_index(conn, rows):
+        conn.executemany(
+            'INSERT OR REPLACE INTO pages (url, hash, codec, callback, size, stored_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            rows,
+        )
+
+    def get(self, url, store=None):
+        """Тело сохраненной страницы или None"""
+        row = self.conn.execute(
+            'SELECT hash, codec FROM pages WHERE url = ?', (snapshot_key(url, store),)
+        ).fetchone()
+        if row is None:
+            return None
+        return self.read(*row)
+
+    def read(self, digest, codec):
+        with open(self.object_path(digest, codec), 'rb') as f:
+            return self.decompress(f.read(), codec)
+
+    def entries(self, callbacks=None):
+        """(url, callback, hash, codec) сохраненных страниц по порядку URL"""
+        query = 'SELECT url, callback, hash, codec FROM pages'
+        params = ()
+        if callbacks:
+            query += f' WHERE callback IN ({", ".join("?" * len(callbacks))})'
+            params = tuple(callbacks)
+        return self.conn.execute(query + ' ORDER BY url', params).fetchall()
+
+    def summary(self):
+        pages, objects, size = self.conn.execute(
+            'SELECT COUNT(*), COUNT(DISTINCT hash), COALESCE(SUM(size), 0) FROM pages'
+        ).fetchone()
+        return {'pages': pages, 'objects': objects, 'html_bytes': size}
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class SnapshotMiddleware:
+    """Запись ответов в хранилище снимков или воспроизведение из него"""
+
+    def __init__(self, store, mode, stats=None, flush_interval=5.0):
+        self.store = store
+        self.mode = mode
+        self.stats = stats
+        self.flush_interval = flush_interval
+        self.writer = None
+        self.pending = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        mode = settings.get('SNAPSHOT_MODE')
+        if not mode:
+            raise NotConfigured
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Неизвестный SNAPSHOT_MODE: {mode}")
+
+        store = SnapshotStore(
+            settings.get('SNAPSHOT_DIR', 'data/snapshots'),
+            settings.get('SNAPSHOT_COMPRESSION', 'zstd'),
+        )
+        middleware = cls(
+            store, mode, crawler.stats,
+            flush_interval=settings.getfloat('DATABASE_FLUSH_INTERVAL', 5.0),
+        )
+        crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        logger.info(f"Снимки страниц: {mode}, {store.path}")
+        return middleware
+
+    def spider_opened(self, spider):
+        if self.mode == 'record':
+            self.writer = DatabaseWriter(
+                self.store.index_path,
+                setup=ensure_index,
+                write_batch=SnapshotStore.write_index,
+                batch_size=100,
+                flush_interval=self.flush_interval,
+            )
+            self.writer.start()
+
+    def process_request(self, request, spider=None):
+        if self.mode != 'replay':
+            return None
+
+        body = self.store.get(request.url, request.meta.get('store'))
+        if body is None:
+            self.inc_stat('fiveka/snapshots/missing')
+            raise IgnoreRequest(f"Нет снимка страницы: {request.url}")
+
+        self.inc_stat('fiveka/snapshots/replayed')
+        return HtmlResponse(
+            url=request.url, body=body, encoding='utf-8', request=request, flags=['snapshot']
+        )
+
+    def process_response(self, request, response, spider=None):
+        if (
+            self.mode == 'record'
+            and response.status == 200
+            and isinstance(response, HtmlResponse)
+        ):
+            self.record(request, response.body)
+        return response
+
+    def record(self, request, body):
+        """Сохраняет страницу в фоне: сжатие в пуле потоков, индекс через writer"""
+        d = threads.deferToThread(self.store.write_object, body)
+        d.addCallback(self.recorded, request, len(body))
+        d.addErrback(self.record_failed, request.url)
+        d.addBoth(lambda _: self.pending.discard(d))
+        self.pending.add(d)
+
+    def recorded(self, digest, request, size):
+        row = self.store.index_row(
+            request.url, digest, size, rule_name(request), request.meta.get('store')
+        )
+        d = self.writer.submit(row)
+        d.addCallback(lambda _: self.inc_stat('fiveka/snapshots/recorded'))
+        return d
+
+    def record_failed(self, failure, url):
+        self.inc_stat('fiveka/snapshots/failed')
+        logger.warning(f"Не удалось сохранить снимок {url}: {failure.value}")
+
+    def inc_stat(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(key)
+
+    def spider_closed(self, spider):
+        """Дожидается записи снимков и закрывает хранилище"""
+        if self.writer is None and not self.pending:
+            self.close_store()
+            return None
+        d = defer.DeferredList(list(self.pending))
+        if self.writer is not None:
+            d.addCallback(lambda _: self.writer.close())
+        d.addCallback(lambda _: self.close_store())
+        return d
+
+    def close_store(self):
+        summary = self.store.summary()
+        logger.info(
+            f"Снимки: страниц {summary['pages']}, уникальных {summary['objects']}, "
+            f"HTML {summary['html_bytes'] / 1024 / 1024:.1f} МБ"
+        )
+        self.store.close()
@@ -3,9 +3,15 @@ import time
 import random
 import json
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 from urllib.parse import urljoin
 from fiveka_scrapy.items import FivekaItem
+from fiveka_scrapy.database import load_catalog_snapshot, product_id_from_url
+from fiveka_scrapy.dupefilters import UrlFilter, strip_tracking
+from fiveka_scrapy.extraction import REGISTRY_PATH, SelectorEngine
+from fiveka_scrapy.metrics import timed, timings_for
+from fiveka_scrapy.sharding import load_categories, save_categories, shard_categories
+from fiveka_scrapy.stores import load_stores
 
 
 class FivekaSpider(scrapy.Spider):
@@ -18,110 +24,292 @@ class FivekaSpider(scrapy.Spider):
         self.base_url = 'https://5ka.ru'
         self.categories_parsed = set()
         self.product_urls_parsed = set()
+        self.incremental = False
+        self.snapshot = {}
+        self.detail_cutoff = None
+        # Селекторы компилируются один раз при старте
+        self.selectors = SelectorEngine()
+        # Шардированный запуск: discover_file - только собрать категории,
+        # categories_file - обходить категории шарда shard из shards
+        self.discover_file = kwargs.get('discover_file')
+        self.categories_file = kwargs.get('categories_file')
+        self.shard = int(kwargs.get('shard', 0))
+        self.shards = int(kwargs.get('shards', 1))
+        self.discovered = []
+        # Время функций извлечения (extract.*), см. fiveka_scrapy.metrics
+        self.timings = None
+        # Магазины: [None] - без контекста магазина
+        self.stores = [None]
+        self.listed_urls = {}
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.setup_selectors(crawler)
+        spider.setup_dedup(crawler.settings)
+        spider.setup_incremental(crawler.settings)
+        spider.setup_stores(crawler.settings)
+        spider.timings = timings_for(crawler)
+        return spider
+
+    def setup_selectors(self, crawler):
+        """Селекторы из реестра с горячей перезагрузкой и счетчиками в статистике"""
+        settings = crawler.settings
+        self.selectors = SelectorEngine(
+            path=settings.get('SELECTOR_REGISTRY') or REGISTRY_PATH,
+            stats=crawler.stats,
+            reload_interval=settings.getfloat('SELECTOR_RELOAD_INTERVAL', 30.0),
+            miss_threshold=settings.getint('SELECTOR_MISS_THRESHOLD', 20),
+        )
+        crawler.stats.set_value('fiveka/selectors/version', self.selectors.version)
+        self.logger.info(f"Реестр селекторов: {self.selectors.path}, версия {self.selectors.version}")
+
+    def setup_dedup(self, settings):
+        """Просмотренные категории и товары храним компактными отпечатками URL"""
+        self.categories_parsed = UrlFilter.from_settings(settings)
+        self.product_urls_parsed = UrlFilter.from_settings(settings)
+
+    def setup_stores(self, settings):
+        """Категории обходятся в каждом магазине, страница товара - один раз"""
+        stores = load_stores(settings)
+        if stores:
+            self.stores = [store['id'] for store in stores]
+            self.listed_urls = {store: UrlFilter.from_settings(settings) for store in self.stores}
+            self.logger.info(f"Магазины: {', '.join(self.stores)}")
+
+    def category_requests(self, url, category_name):
+        """Запросы страницы категории по одному на магазин"""
+        for store in self.stores:
+            yield scrapy.Request(
+                url=url,
+                callback=self.parse_category,
+                meta=self.request_meta(category_name, store)
+            )
+
+    def request_meta(self, category_name, store=None):
+        meta = {'category_name': category_name}
+        if store:
+            meta['store'] = store
+        return meta
+
+    def setup_incremental(self, settings):
+        """Товары из карточек категорий (LISTING_ITEMS или INCREMENTAL_CRAWL):
+        загружаем последнее состояние каталога из базы"""
+        self.incremental = (
+            settings.getbool('LISTING_ITEMS', False) or settings.getbool('INCREMENTAL_CRAWL', False)
+        )
+        if not self.incremental:
+            return
+
+        ttl = timedelta(hours=settings.getfloat('INCREMENTAL_TTL_HOURS', 168))
+        self.detail_cutoff = (datetime.now() - ttl).isoformat()
+        self.snapshot = load_catalog_snapshot(
+            settings.get('DATABASE_BASELINE_PATH')
+            or settings.get('DATABASE_PATH', 'data/fiveka_products.db')
+        )
+        self.logger.info(f"Инкрементальный режим: известно товаров {len(self.snapshot)}")
+
+    async def start(self):
+        for request in self.start_requests():
+            yield request
+
+    def start_requests(self):
+        """Каталог или, в процессе шарда, сразу категории шарда"""
+        if not self.categories_file:
+            for url in self.start_urls:
+                yield scrapy.Request(url, dont_filter=True)
+            return
+
+        categories = shard_categories(load_categories(self.categories_file), self.shard, self.shards)
+        self.logger.info(f"Шард {self.shard + 1}/{self.shards}: категорий {len(categories)}")
+        for category in categories:
+            self.categories_parsed.add(category['url'])
+            yield from self.category_requests(category['url'], category['name'])
+
+    def closed(self, reason):
+        if self.discover_file:
+            save_categories(self.discover_file, self.discovered)
+            self.logger.info(f"Найдено категорий: {len(self.discovered)} -> {self.discover_file}")
 
     def parse(self, response):
         """Парсинг категорий"""
-        category_links = response.css('a.chakra-link.css-1mjqhey')
-        if not category_links:
-            category_links = response.css('a[data-qa^="section-category-item-"]')
-
-        for link in category_links:
-            category_url = link.css('::attr(href)').get()
-            category_name = link.css('p.css-54eu44::text').get() or 'Без названия'
+        selectors = self.selectors
+        for link in selectors.page(response.selector.root).select('category_link'):
+            category_url = selectors.get('category_url', link)
+            category_name = selectors.get('category_name', link) or 'Без названия'
 
             if category_url:
-                full_url = urljoin(self.base_url, category_url)
+                full_url = strip_tracking(urljoin(self.base_url, category_url))
 
                 if full_url not in self.categories_parsed:
                     self.categories_parsed.add(full_url)
 
-                    yield scrapy.Request(
-                        url=full_url,
-                        callback=self.parse_category,
-                        meta={'category_name': category_name}
-                    )
+                    if self.discover_file:
+                        self.discovered.append({'url': full_url, 'name': category_name})
+                        continue
+
+                    yield from self.category_requests(full_url, category_name)
 
     def parse_category(self, response):
         """Парсинг товаров в категории"""
         category_name = response.meta.get('category_name', 'Без названия')
+        store = response.meta.get('store')
+        page = self.selectors.page(response.selector.root)
 
         # Парсим товары на текущей странице
-        for product_url in self.get_product_links(response):
-            if product_url not in self.product_urls_parsed:
-                self.product_urls_parsed.add(product_url)
+        for card in self.get_product_cards(page):
+            product_url = card['url']
+
+            # С магазинами цена из карточки пишется для каждого магазина,
+            # а общие данные со страницы товара загружаются один раз
+            if store:
+                listed = self.listed_urls[store]
+                if product_url in listed:
+                    continue
+                listed.add(product_url)
+            elif product_url in self.product_urls_parsed:
+                continue
+
+            new_product = product_url not in self.product_urls_parsed
+            self.product_urls_parsed.add(product_url)
+            detail = new_product and self.needs_detail(card)
 
+            # В инкрементальном режиме цена и базовые данные берутся из карточки,
+            # а страница товара нужна только для детальных полей. Если она
+            # загружается, полный товар с нее заменяет карточку
+            if not detail and (store or self.incremental):
+                yield self.listing_item(card, category_name, store)
+
+            if detail:
                 yield scrapy.Request(
                     url=product_url,
                     callback=self.parse_product,
-                    meta={'category_name': category_name}
+                    meta=self.request_meta(category_name, store)
                 )
+            elif new_product:
+                self.crawler.stats.inc_value('fiveka/incremental/skipped')
 
         # Следующая страница
-        next_page = self.find_next_page(response)
+        next_page = self.find_next_page(page)
         if next_page:
             yield scrapy.Request(
                 url=next_page,
                 callback=self.parse_category,
-                meta={'category_name': category_name}
+                meta=self.request_meta(category_name, store)
             )
 
     def get_product_links(self, response):
         """Извлекает ссылки на товары"""
-        links = []
-
-        product_cards = response.css('div[data-qa^="product-card-"]')
-        if not product_cards:
-            product_cards = response.css('.chakra-stack.css-lovawgy')
-
-        for card in product_cards:
-            href = card.css('a[data-qa="product-card-link"]::attr(href)').get()
-            if href and '/product/' in href:
-                full_url = urljoin(self.base_url, href)
-                if full_url not in links:
-                    links.append(full_url)
-
-        return links
+        page = self.selectors.page(response.selector.root)
+        return [card['url'] for card in self.get_product_cards(page)]
+
+    @timed('extract.cards')
+    def get_product_cards(self, page):
+        """Извлекает карточки товаров со страницы категории"""
+        cards = {}
+
+        for card in page.select('product_card'):
+            data = self.extract_card(card)
+            if data and data['url'] not in cards:
+                cards[data['url']] = data
+
+        return list(cards.values())
+
+    @timed('extract.card')
+    def extract_card(self, card):
+        """Данные карточки товара (элемент lxml): ссылка, название, цены и изображение"""
+        selectors = self.selectors
+        href = selectors.get('card_link', card)
+        if not href or '/product/' not in href:
+            return None
+
+        url = strip_tracking(urljoin(self.base_url, href))
+        name = selectors.get('card_name', card)
+        price, old_price = self.split_prices(self.extract_prices(selectors.getall('card_price', card)))
+        image = selectors.get('card_image', card)
+
+        return {
+            'url': url,
+            'product_id': product_id_from_url(url),
+            'name': name.strip() if name else None,
+            'price': price,
+            'old_price': old_price,
+            'image_url': [image] if image else None,
+        }
+
+    def needs_detail(self, card):
+        """Нужно ли загружать страницу товара: в инкрементальном режиме только
+        если товар новый, его название на карточке изменилось или детальных
+        полей (характеристики, состав, КБЖУ) нет либо они устарели"""
+        if not self.incremental:
+            return True
+
+        known = self.snapshot.get(card['product_id'])
+        if known is None:
+            return True
+
+        detail_scraped_at, has_detail, name = known
+        if not has_detail:
+            return True
+        if card['name'] and name and card['name'] != name.strip():
+            return True
+        return not detail_scraped_at or detail_scraped_at < self.detail_cutoff
+
+    def listing_item(self, card, category_name, store=None):
+        """Частичный товар по данным карточки категории"""
+        item = FivekaItem()
+        item['url'] = card['url']
+        item['product_id'] = card['product_id']
+        item['name'] = card['name']
+        item['price'] = card['price']
+        item['old_price'] = card['old_price']
+        item['image_url'] = card['image_url']
+        item['category'] = category_name
+        item['timestamp'] = datetime.now().isoformat()
+        item['partial'] = True
+        if store:
+            item['store'] = store
+        return item
 
     def parse_product(self, response):
         """Парсинг страницы товара"""
+        page = self.selectors.page(response.selector.root)
         item = FivekaItem()
         item['url'] = response.url
         item['category'] = response.meta.get('category_name', 'Без категории')
         item['timestamp'] = datetime.now().isoformat()
+        if response.meta.get('store'):
+            item['store'] = response.meta['store']
 
-        # Артикул
-        item['article'] = self.extract_article(response)
+        # Идентификаторы
+        item['product_id'] = product_id_from_url(response.url)
+        item['article'] = self.extract_article(page)
 
         # Название
-        item['name'] = response.css('h1[data-qa="product-card-title"]::text').get() or \
-                       response.css('h1::text').get() or \
-                       response.css('[itemprop="name"]::text').get()
+        item['name'] = page.get('name')
 
         # Цены
-        prices = self.extract_prices(response)
-        if prices:
-            unique_prices = sorted(list(set(prices)))
-            if len(unique_prices) >= 2:
-                item['price'] = str(unique_prices[0])
-                item['old_price'] = str(unique_prices[1])
-            elif len(unique_prices) == 1:
-                item['price'] = str(unique_prices[0])
+        price, old_price = self.split_prices(self.extract_prices(page.getall('price')))
+        if price:
+            item['price'] = price
+        if old_price:
+            item['old_price'] = old_price
 
         # Изображения
-        item['image_url'] = self.extract_images(response)
+        item['image_url'] = self.extract_images(page)
 
         # Описание
-        item['description'] = response.css('div.css-19ps4ew::text, div.css-6ua3wa::text').get()
+        item['description'] = page.get('description')
 
         # Характеристики
-        characteristics = self.extract_characteristics(response)
+        characteristics = self.extract_characteristics(page)
         item['characteristics'] = characteristics
 
         # Состав
         item['composition'] = self.extract_composition(characteristics)
 
         # КБЖУ
-        item['nutritional_info'] = self.extract_nutritional_info(response, characteristics)
+        item['nutritional_info'] = self.extract_nutritional_info(page, characteristics)
 
         # Бренд, вес, страна
         if characteristics:
@@ -130,18 +318,19 @@ class FivekaSpider(scrapy.Spider):
             item['country'] = characteristics.get('Страна производства') or characteristics.get('Страна')
 
         # Рейтинг и отзывы
-        item['rating'] = response.css('h2.css-16706lo::text').get()
-        reviews_text = response.css('h2.css-w9opm3::text').get()
+        item['rating'] = page.get('rating')
+        reviews_text = page.get('reviews')
         if reviews_text:
             numbers = re.findall(r'\d+', reviews_text)
             item['reviews_count'] = numbers[0] if numbers else reviews_text
 
         yield item
 
-    def extract_article(self, response):
+    @timed('extract.article')
+    def extract_article(self, page):
         """Извлекает артикул"""
         # Из JSON-LD
-        json_ld_scripts = response.xpath('//script[@type="application/ld+json"]/text()').getall()
+        json_ld_scripts = page.getall('json_ld')
         for script in json_ld_scripts:
             try:
                 data = json.loads(script)
@@ -155,75 +344,69 @@ class FivekaSpider(scrapy.Spider):
                 continue
 
         # Из селекторов
-        selectors = [
-            '[itemprop="sku"]::text',
-            '[data-qa="product-sku"]::text',
-            'span:contains("Артикул") + span::text',
-            'div:contains("Артикул")::text'
-        ]
-
-        for selector in selectors:
-            article = response.css(selector).get()
-            if article:
-                return article.strip()
+        article = page.get('article')
+        if article:
+            return article.strip()
 
         return None
 
-    def extract_prices(self, response):
-        """Извлекает все цены"""
+    @timed('extract.prices')
+    def extract_prices(self, raw_prices):
+        """Разбирает все найденные цены"""
         prices = []
 
-        # Основные селекторы цен
-        price_selectors = [
-            'meta[itemprop="price"]::attr(content)',
-            '[itemprop="priceSpecification"] meta[itemprop="price"]::attr(content)',
-            '.product-price::text',
-            '.price::text',
-            '[data-qa="product-price"]::text'
-        ]
-
-        for selector in price_selectors:
-            for price in response.css(selector).getall():
-                if price:
-                    try:
-                        clean_price = re.sub(r'[^\d\.]', '', price.replace(',', '.'))
-                        if clean_price:
-                            price_float = float(clean_price)
-                            if price_float > 0:
-                                prices.append(price_float)
-                    except:
-                        continue
+        for price in raw_prices:
+            if price:
+                try:
+                    clean_price = re.sub(r'[^\d\.]', '', price.replace(',', '.'))
+                    if clean_price:
+                        price_float = float(clean_price)
+                        if price_float > 0:
+                            prices.append(price_float)
+                except:
+                    continue
 
         return prices
 
-    def extract_images(self, response):
+    @timed('extract.split_prices')
+    def split_prices(self, prices):
+        """Цена и старая цена: две наименьшие различные цены"""
+        unique_prices = sorted(set(prices))
+        price = str(unique_prices[0]) if unique_prices else None
+        old_price = str(unique_prices[1]) if len(unique_prices) >= 2 else None
+        return price, old_price
+
+    @timed('extract.images')
+    def extract_images(self, page):
         """Извлекает изображения"""
         images = []
 
-        main_img = response.css('img[itemprop="image"]::attr(src)').get()
+        main_img = page.get('main_image')
         if main_img:
             images.append(main_img)
 
-        all_images = response.css('img.chakra-image.css-1epf5lq::attr(src)').getall()
+        all_images = page.getall('image')
         for img in all_images:
             if img and img not in images:
                 images.append(img)
 
         return images if images else None
 
-    def extract_characteristics(self, response):
+    @timed('extract.characteristics')
+    def extract_characteristics(self, page):
         """Извлекает характеристики"""
+        selectors = self.selectors
         characteristics = {}
 
-        char_sections = response.css('.chakra-stack.css-o0cdb2, .css-o0cdb2')
-        for section in char_sections:
-            key = section.css('.css-8696l::text, .css-11ze7cv span::text').get()
-            value = section.css('.css-1vhi7o2::text, .css-gai91n span::text').get()
+        for section in page.select('characteristic'):
+            key = selectors.get('characteristic_key', section)
+            value = selectors.get('characteristic_value', section)
             if key and value:
                 characteristics[key.strip()] = value.strip()
 
         return characteristics if characteristics else None
 
+    @timed('extract.composition')
     def extract_composition(self, characteristics):
         """Извлекает состав из характеристик"""
         if characteristics:
@@ -232,15 +415,16 @@ class FivekaSpider(scrapy.Spider):
                     return characteristics[key]
         return None
 
-    def extract_nutritional_info(self, response, characteristics):
+    @timed('extract.nutritional_info')
+    def extract_nutritional_info(self, page, characteristics):
         """Извлекает КБЖУ"""
+        selectors = self.selectors
         nutritional_info = {}
 
         # Из блоков КБЖУ
-        nutrition_blocks = response.css('.chakra-stack.css-iicxse')
-        for block in nutrition_blocks:
-            value = block.css('h2.css-1j4x839::text').get()
-            label = block.css('p.css-sdw6z7::text').get()
+        for block in page.select('nutrition'):
+            value = selectors.get('nutrition_value', block)
+            label = selectors.get('nutrition_label', block)
             if value and label:
                 nutritional_info[label.strip()] = value.strip().replace(',', '.')
 
@@ -261,17 +445,11 @@ class FivekaSpider(scrapy.Spider):
 
         return nutritional_info if nutritional_info else None
 
-    def find_next_page(self, response):
+    @timed('extract.next_page')
+    def find_next_page(self, page):
         """Находит следующую страницу"""
-        next_selectors = [
-            '.pagination .next a::attr(href)',
-            'a[rel="next"]::attr(href)',
-            '[data-qa="pagination-next"]::attr(href)'
-        ]
-
-        for selector in next_selectors:
-            next_url = response.css(selector).get()
-            if next_url:
-                return urljoin(self.base_url, next_url)
+        next_url = page.get('next_page')
+        if next_url:
+            return urljoin(self.base_url, next_url)
 
         return None
\ No newline at end of file
@@ -0,0 +1,72 @@
+"""
+Контекст магазина: цены 5ka.ru зависят от выбранного магазина и региона.
+
+Магазины задаются в ``STORES``::
+
+    STORES = [
+        {'id': 'msk-1', 'cookies': {'location': '...'}, 'local_storage': {...}},
+        {'id': 'spb-1', 'cookies': {'location': '...'}},
+    ]
+
+У каждого магазина свой пул браузеров, в которых при запуске выставлены
+cookies и localStorage магазина, своя HTTP-сессия гибридного режима и
+свои наблюдения цен (``store_id`` в базе). Магазин запроса передается в
+``meta['store']``; без него запрос рендерится в первом магазине.
+"""
+
+import hashlib
+import logging
+
+from scrapy.utils.request import RequestFingerprinter
+
+logger = logging.getLogger(__name__)
+
+# store_id наблюдений без контекста магазина
+DEFAULT_STORE = ''
+
+
+def load_stores(settings):
+    """Список магазинов из STORES с проверкой идентификаторов"""
+    stores = []
+    seen = set()
+    for store in settings.getlist('STORES'):
+        store_id = str(store.get('id') or '')
+        if not store_id:
+            raise ValueError(f"У магазина нет id: {store}")
+        if store_id in seen:
+            raise ValueError(f"Повторяющийся id магазина: {store_id}")
+        seen.add(store_id)
+        stores.append(dict(store, id=store_id))
+    return stores
+
+
+def apply_store(driver, base_url, store):
+    """Выставляет cookies и localStorage магазина в браузере"""
+    driver.get(base_url)
+    for name, value in (store.get('cookies') or {}).items():
+        driver.add_cookie({'name': name, 'value': str(value), 'path': '/'})
+    for key, value in (store.get('local_storage') or {}).items():
+        driver.execute_script('window.localStorage.setItem(arguments[0], arguments[1])', key, str(value))
+    logger.info(f"Браузер привязан к магазину {store['id']}")
+
+
+class StoreRequestFingerprinter:
+    """Отпечаток запроса с учетом магазина (REQUEST_FINGERPRINTER_CLASS).
+
+    Одна и та же страница категории в разных магазинах - разные запросы
+    для дедупликации, фронтира и брокера.
+    """
+
+    def __init__(self, fingerprinter):
+        self.fingerprinter = fingerprinter
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(RequestFingerprinter.from_crawler(crawler))
+
+    def fingerprint(self, request):
+        fp = self.fingerprinter.fingerprint(request)
+        store = request.meta.get('store')
+        if not store:
+            return fp
+        return hashlib.sha1(fp + b'|store=' + str(store).encode()).digest()
@@ -0,0 +1,204 @@
+"""
+Адаптивный троттлинг загрузки страниц.
+
+Рендеринг Selenium идет в обход слотов загрузчика Scrapy (middleware сам
+возвращает ответ), поэтому ``DOWNLOAD_DELAY`` и
+``CONCURRENT_REQUESTS_PER_DOMAIN`` на него не действуют. ``AdaptiveThrottle``
+сам ограничивает задержку между стартами и число одновременных загрузок
+для каждого домена и подстраивает их по наблюдениям:
+
+* задержка стремится к ``время рендеринга / параллельность``, чтобы все
+  браузеры были заняты, но сайт не получал лишних запросов;
+* если в окне из ``ADAPTIVE_THROTTLE_WINDOW`` ответов доля 408/500 выше
+  ``ADAPTIVE_THROTTLE_ERROR_RATE``, задержка растет, а параллельность
+  уменьшается; иначе параллельность растет на единицу;
+* признак блокировки (403, 429 или страница капчи) удваивает задержку и
+  вдвое уменьшает параллельность, после чего ``ADAPTIVE_THROTTLE_COOLDOWN``
+  секунд параллельность не увеличивается.
+
+Все значения держатся в пределах ``ADAPTIVE_THROTTLE_MIN_*/MAX_*``.
+"""
+
+import logging
+import random
+import time
+from collections import deque
+
+from twisted.internet import defer
+
+logger = logging.getLogger(__name__)
+
+ERROR_STATUSES = {408, 500}
+BLOCK_STATUSES = {403, 429}
+
+
+class ThrottleState:
+    """Параметры и очередь ожидания для одного домена"""
+
+    def __init__(self, delay, concurrency):
+        self.delay = delay
+        self.concurrency = concurrency
+        self.latency = None
+        self.window = 0
+        self.errors = 0
+        self.blocked_at = None
+        self.active = 0
+        self.waiting = deque()
+        self.next_start = 0.0
+        self.call = None
+
+
+class AdaptiveThrottle:
+    """Задержка и параллельность по домену, подстраиваемые под сайт"""
+
+    def __init__(self, delay=2.0, min_delay=0.5, max_delay=60.0, min_concurrency=1,
+                 max_concurrency=4, window=20, error_rate=0.2, cooldown=120.0,
+                 block_markers=(), randomize=True, stats=None):
+        self.start_delay = min(max(delay, min_delay), max_delay)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_concurrency = max(1, min_concurrency)
+        self.max_concurrency = max(self.min_concurrency, max_concurrency)
+        self.window = window
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.block_markers = [marker.encode('utf-8') for marker in block_markers]
+        self.randomize = randomize
+        self.stats = stats
+        self.states = {}
+
+    @classmethod
+    def from_settings(cls, settings, stats=None):
+        pool_size = max(1, settings.getint('SELENIUM_POOL_SIZE', 1))
+        return cls(
+            delay=settings.getfloat('DOWNLOAD_DELAY', 2.0),
+            min_delay=settings.getfloat('ADAPTIVE_THROTTLE_MIN_DELAY', 0.5),
+            max_delay=settings.getfloat('ADAPTIVE_THROTTLE_MAX_DELAY', 60.0),
+            min_concurrency=settings.getint('ADAPTIVE_THROTTLE_MIN_CONCURRENCY', 1),
+            max_concurrency=settings.getint('ADAPTIVE_THROTTLE_MAX_CONCURRENCY', pool_size),
+            window=settings.getint('ADAPTIVE_THROTTLE_WINDOW', 20),
+            error_rate=settings.getfloat('ADAPTIVE_THROTTLE_ERROR_RATE', 0.2),
+            cooldown=settings.getfloat('ADAPTIVE_THROTTLE_COOLDOWN', 120.0),
+            block_markers=settings.getlist('ADAPTIVE_THROTTLE_BLOCK_MARKERS'),
+            randomize=settings.getbool('RANDOMIZE_DOWNLOAD_DELAY', True),
+            stats=stats,
+        )
+
+    def state(self, key):
+        if key not in self.states:
+            self.states[key] = ThrottleState(self.start_delay, self.min_concurrency)
+        return self.states[key]
+
+    # Очередь загрузок (вызывается в потоке реактора)
+
+    def acquire(self, key):
+        """Deferred, который срабатывает, когда можно начинать загрузку"""
+        d = defer.Deferred()
+        state = self.state(key)
+        state.waiting.append(d)
+        self.process_queue(state)
+        return d
+
+    def release(self, key):
+        state = self.state(key)
+        state.active = max(0, state.active - 1)
+        self.process_queue(state)
+
+    def process_queue(self, state):
+        from twisted.internet import reactor
+
+        if state.call is not None and state.call.active():
+            return
+        state.call = None
+
+        while state.waiting and state.active < state.concurrency:
+            now = time.monotonic()
+            if state.next_start > now:
+                state.call = reactor.callLater(state.next_start - now, self.process_queue, state)
+                return
+            state.active += 1
+            delay = state.delay * random.uniform(0.5, 1.5) if self.randomize else state.delay
+            state.next_start = now + delay
+            state.waiting.popleft().callback(None)
+
+    # Наблюдения
+
+    def is_blocked(self, response, has_content):
+        """403/429 или страница капчи вместо ожидаемого содержимого.
+
+        ``has_content`` - функция, проверяющая маркеры нужной страницы:
+        слово "captcha" может встречаться и в скриптах обычной страницы.
+        """
+        if response.status in BLOCK_STATUSES:
+            return True
+        if response.status != 200 or not any(marker in response.body for marker in self.block_markers):
+            return False
+        return not has_content()
+
+    def observe(self, key, status, latency=None, blocked=False):
+        """Учитывает ответ и пересчитывает задержку и параллельность"""
+        state = self.state(key)
+        now = time.monotonic()
+
+        if latency is not None:
+            state.latency = latency if state.latency is None else 0.7 * state.latency + 0.3 * latency
+
+        if blocked:
+            state.blocked_at = now
+            state.delay = min(self.max_delay, max(state.delay, self.min_delay, 1.0) * 2)
+            state.concurrency = max(self.min_concurrency, state.concurrency // 2)
+            state.window = state.errors = 0
+            self.inc_stat('fiveka/throttle/blocks')
+            logger.warning(
+                f"⛔ Признаки блокировки ({status}) на {key}: задержка {state.delay:.1f} с, "
+                f"параллельность {state.concurrency}"
+            )
+        else:
+            state.window += 1
+            if status in ERROR_STATUSES:
+                state.errors += 1
+                self.inc_stat('fiveka/throttle/errors')
+            if state.window >= self.window:
+                self.adjust(key, state, now)
+
+        self.publish(state)
+        self.process_queue(state)
+
+    def adjust(self, key, state, now):
+        """Итог окна наблюдений"""
+        rate = state.errors / state.window
+        state.window = state.errors = 0
+
+        if rate > self.error_rate:
+            state.delay = min(self.max_delay, max(state.delay, self.min_delay) * 1.5)
+            state.concurrency = max(self.min_concurrency, state.concurrency - 1)
+            logger.info(
+                f"Ошибок {rate:.0%} на {key}: задержка {state.delay:.1f} с, "
+                f"параллельность {state.concurrency}"
+            )
+            return
+
+        if state.blocked_at is None or now - state.blocked_at >= self.cooldown:
+            state.concurrency = min(self.max_concurrency, state.concurrency + 1)
+        if state.latency is not None:
+            target = state.latency / state.concurrency
+            state.delay = min(self.max_delay, max(self.min_delay, (state.delay + target) / 2))
+        logger.debug(
+            f"Троттлинг {key}: задержка {state.delay:.1f} с, параллельность {state.concurrency}, "
+            f"время загрузки {state.latency or 0:.1f} с"
+        )
+
+    def apply_to_slot(self, key, slot):
+        """Переносит параметры на слот загрузчика Scrapy (для HTTP-запросов)"""
+        state = self.state(key)
+        slot.delay = state.delay
+        slot.concurrency = state.concurrency
+
+    def publish(self, state):
+        if self.stats is not None:
+            self.stats.set_value('fiveka/throttle/delay', round(state.delay, 2))
+            self.stats.set_value('fiveka/throttle/concurrency', state.concurrency)
+
+    def inc_stat(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(key)
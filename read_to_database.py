@@ -1,15 +1,154 @@
 #!/usr/bin/env python3
 """
-Экспорт всех товаров в CSV
+Экспорт всех товаров в CSV, XLSX и (опционально) Parquet
+
+Строки читаются из базы порциями и сразу дописываются во все файлы,
+поэтому расход памяти не зависит от размера каталога.
+
+    python read_to_database.py [--parquet] [--no-xlsx] [--chunk-size 5000]
 """
 
-import sqlite3
-import pandas as pd
+import argparse
+import csv
 import os
 from datetime import datetime
 
+from fiveka_scrapy.database import connect, ensure_schema
+
+# Последние данные по каждому товару хранятся в latest_products
+QUERY = '''
+SELECT
+    p.name as "Название",
+    o.price_kopecks / 100.0 as "Цена (со скидкой)",
+    o.old_price_kopecks / 100.0 as "Цена (без скидки)",
+    p.article as "Артикул",
+    p.url as "Ссылка",
+    p.category as "Категория",
+    o.store_id as "Магазин",
+    p.description as "Описание",
+    p.characteristics as "Характеристики",
+    p.composition as "Состав",
+    p.nutritional_info as "КБЖУ",
+    p.image_url as "Изображения",
+    p.brand as "Бренд",
+    p.weight as "Вес",
+    p.country as "Страна",
+    o.rating as "Рейтинг",
+    o.reviews_count as "Отзывы",
+    -- Форматируем дату для Excel (YYYY-MM-DD HH:MM:SS)
+    strftime('%Y-%m-%d %H:%M:%S', p.last_seen_at) as "Дата сбора"
+FROM latest_products o
+JOIN products p ON p.product_id = o.product_id
+ORDER BY p.last_seen_at DESC
+'''
+
+# Числовые колонки для типизированной схемы Parquet
+FLOAT_COLUMNS = {'Цена (со скидкой)', 'Цена (без скидки)', 'Рейтинг'}
+INT_COLUMNS = {'Отзывы'}
+
+
+class CsvExport:
+    """Построчная запись CSV"""
+
+    def __init__(self, path, columns):
+        self.path = path
+        # Используем UTF-8-BOM для корректного отображения в Excel
+        self.file = open(path, 'w', encoding='utf-8-sig', newline='')
+        self.writer = csv.writer(self.file, delimiter=';')
+        self.writer.writerow(columns)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+        print(f"✅ Сохранено в CSV: {self.path}")
+
+
+class XlsxExport:
+    """XLSX в write-only режиме openpyxl: строки сразу уходят на диск"""
+
+    def __init__(self, path, columns):
+        from openpyxl import Workbook
+
+        self.path = path
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet()
+        self.sheet.append(columns)
+
+    def write(self, rows):
+        for row in rows:
+            self.sheet.append(row)
+
+    def close(self):
+        self.workbook.save(self.path)
+        print(f"✅ Сохранено в Excel: {self.path}")
+
+
+class ParquetExport:
+    """Parquet через pyarrow, одна row group на порцию"""
+
+    def __init__(self, path, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.path = path
+        self.columns = columns
+        self.schema = pa.schema([(name, column_type(pa, name)) for name in columns])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        data = {}
+        for index, name in enumerate(self.columns):
+            if name in FLOAT_COLUMNS or name in INT_COLUMNS:
+                data[name] = [row[index] for row in rows]
+            else:
+                data[name] = [None if row[index] is None else str(row[index]) for row in rows]
+        self.writer.write_table(self.pa.Table.from_pydict(data, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+        print(f"✅ Сохранено в Parquet: {self.path}")
+
+
+def column_type(pa, name):
+    if name in FLOAT_COLUMNS:
+        return pa.float64()
+    if name in INT_COLUMNS:
+        return pa.int64()
+    return pa.string()
+
+
+def open_exports(columns, current_date, with_xlsx, with_parquet):
+    """Открывает файлы выгрузки; недоступные форматы пропускаются"""
+    formats = [('csv', CsvExport)]
+    if with_xlsx:
+        formats.append(('xlsx', XlsxExport))
+    if with_parquet:
+        formats.append(('parquet', ParquetExport))
+
+    exports = []
+    for extension, export_class in formats:
+        filepath = os.path.join('data', f'fiveka_products_{current_date}.{extension}')
+        try:
+            exports.append(export_class(filepath, columns))
+        except Exception as e:
+            print(f"ℹ️  {extension.upper()} не сохранен: {e}")
+    return exports
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Экспорт товаров 5ka.ru')
+    parser.add_argument('--parquet', action='store_true', help='дополнительно сохранить Parquet')
+    parser.add_argument('--no-xlsx', action='store_true', help='не сохранять XLSX')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='строк в одной порции')
+    return parser.parse_args()
+
 
 def main():
+    args = parse_args()
+
     print("""
     ╔══════════════════════════════════╗
     ║     Экспорт данных 5ka.ru       ║
@@ -22,67 +161,41 @@ def main():
         print("❌ База данных не найдена")
         return
 
-    conn = sqlite3.connect(db_path)
-
-    # Получаем последние данные для каждого товара
-    query = '''
-    WITH latest AS (
-        SELECT url, MAX(date_scraped) as latest_date
-        FROM products
-        GROUP BY url
-    )
-    SELECT 
-        p.name as "Название",
-        p.price as "Цена (со скидкой)",
-        p.old_price as "Цена (без скидки)",
-        p.article as "Артикул",
-        p.url as "Ссылка",
-        p.category as "Категория",
-        p.description as "Описание",
-        p.characteristics as "Характеристики",
-        p.composition as "Состав",
-        p.nutritional_info as "КБЖУ",
-        p.image_url as "Изображения",
-        p.brand as "Бренд",
-        p.weight as "Вес",
-        p.country as "Страна",
-        p.rating as "Рейтинг",
-        p.reviews_count as "Отзывы",
-        -- Форматируем дату для Excel (YYYY-MM-DD HH:MM:SS)
-        strftime('%Y-%m-%d %H:%M:%S', p.date_scraped) as "Дата сбора"
-    FROM products p
-    JOIN latest l ON p.url = l.url AND p.date_scraped = l.latest_date
-    ORDER BY p.date_scraped DESC
-    '''
-
-    df = pd.read_sql_query(query, conn)
-    conn.close()
+    # База старого формата переводится на текущую схему
+    conn = connect(db_path)
+    ensure_schema(conn)
+    cursor = conn.execute(QUERY)
+    columns = [description[0] for description in cursor.description]
 
-    if df.empty:
+    chunk = cursor.fetchmany(args.chunk_size)
+    if not chunk:
+        conn.close()
         print("📭 Нет данных")
         return
 
-    print(f"📊 Товаров: {len(df)}")
-
-    # Сохраняем в CSV с правильными настройками для Excel
     current_date = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f'fiveka_products_{current_date}.csv'
-    filepath = os.path.join('data', filename)
+    exports = open_exports(columns, current_date, not args.no_xlsx, args.parquet)
+
+    total = 0
+    while chunk:
+        total += len(chunk)
+        for export in list(exports):
+            try:
+                export.write(chunk)
+            except Exception as e:
+                print(f"ℹ️  {os.path.basename(export.path)} не сохранен: {e}")
+                exports.remove(export)
+        chunk = cursor.fetchmany(args.chunk_size)
 
-    # Используем UTF-8-BOM для корректного отображения в Excel
-    df.to_csv(filepath, index=False, encoding='utf-8-sig', sep=';', date_format='%Y-%m-%d %H:%M:%S')
-
-    print(f"✅ Сохранено в CSV: {filepath}")
+    conn.close()
+    print(f"📊 Товаров: {total}")
 
-    # Дополнительно создаем XLSX для Excel
-    try:
-        xlsx_filename = f'fiveka_products_{current_date}.xlsx'
-        xlsx_filepath = os.path.join('data', xlsx_filename)
-        df.to_excel(xlsx_filepath, index=False)
-        print(f"✅ Сохранено в Excel: {xlsx_filepath}")
-    except Exception as e:
-        print(f"ℹ️  XLSX не сохранен: {e}")
+    for export in exports:
+        try:
+            export.close()
+        except Exception as e:
+            print(f"ℹ️  {os.path.basename(export.path)} не сохранен: {e}")
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
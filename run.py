@@ -1,24 +1,13 @@
 #!/usr/bin/env python3
+import argparse
 import os
+import subprocess
 import sys
 from scrapy.crawler import CrawlerProcess
 from scrapy.utils.project import get_project_settings
 
 
-def main():
-    # Добавляем путь к проекту
-    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-
-    # Устанавливаем переменную окружения
-    os.environ.setdefault('SCRAPY_SETTINGS_MODULE', 'fiveka_scrapy.settings')
-
-    # Получаем настройки
-    settings = get_project_settings()
-
-    # Создаем процесс
-    process = CrawlerProcess(settings)
-
-    print("""
+BANNER = """
     ╔══════════════════════════════════════════════╗
     ║          ПАРСЕР 5KA.RU                       ║
     ╚══════════════════════════════════════════════╝
@@ -28,6 +17,10 @@ def main():
     ✅ Сохранение в SQLite базу данных
     ✅ Автоматическая пагинация
     ✅ Дата парсинга в формате ISO 8601
+    ✅ Продолжение после падения: python run.py --resume
+    ✅ Снимки страниц: python run.py --snapshots record|replay
+    ✅ Несколько процессов: python run.py --shards 4
+    ✅ Несколько машин: python run.py --broker [--broker-reset]
 
     Данные сохраняются в:
     • data/fiveka_products.db - база данных
@@ -39,20 +32,141 @@ def main():
     • python read_database.py - чтение базы данных
 
     Запускаю...
-    """)
+    """
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Парсер 5ka.ru')
+    parser.add_argument('--resume', action='store_true',
+                        help='продолжить прерванный обход из фронтира')
+    parser.add_argument('--snapshots', choices=['record', 'replay'],
+                        help='сохранять страницы в хранилище снимков или обходить по снимкам')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='число процессов, между которыми делятся категории каталога')
+    parser.add_argument('--broker', action='store_true',
+                        help='брать запросы из общей очереди брокера (несколько узлов)')
+    parser.add_argument('--broker-reset', action='store_true',
+                        help='очистить очередь брокера и начать новый обход')
+    # Служебные аргументы дочерних процессов шардированного запуска
+    parser.add_argument('--discover', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--shard', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def child_command(args, *extra):
+    """Команда запуска дочернего процесса с теми же режимами"""
+    command = [sys.executable, os.path.abspath(__file__), '--shards', str(args.shards), *extra]
+    if args.resume:
+        command.append('--resume')
+    if args.snapshots:
+        command += ['--snapshots', args.snapshots]
+    if args.broker:
+        command.append('--broker')
+    return command
+
+
+def run_sharded(args, settings):
+    """Собирает категории, запускает по процессу на шард и сливает их базы,
+    возвращает код выхода"""
+    from fiveka_scrapy.sharding import merge_shard_databases, shard_path
+
+    if args.broker_reset:
+        # Очередь общая для всех шардов, очищаем ее один раз здесь
+        from fiveka_scrapy.broker import open_broker
+
+        broker = open_broker(settings)
+        broker.reset()
+        broker.close()
+
+    categories_file = settings.get('SHARD_CATEGORIES_PATH')
+    if args.resume and os.path.exists(categories_file):
+        print(f"Категории из прошлого запуска: {categories_file}")
+    else:
+        print("Собираю список категорий...")
+        if subprocess.call(child_command(args, '--discover')) != 0 or not os.path.exists(categories_file):
+            print("Не удалось получить список категорий")
+            return 1
+
+    print(f"Запускаю шардов: {args.shards}")
+    workers = [subprocess.Popen(child_command(args, '--shard', str(shard))) for shard in range(args.shards)]
+    failed = [shard for shard, worker in enumerate(workers) if worker.wait() != 0]
+
+    # Базы шардов сливаются и после сбоя: собранное не должно потеряться
+    db_path = settings.get('DATABASE_PATH')
+    products, observations = merge_shard_databases(
+        db_path, [shard_path(db_path, shard) for shard in range(args.shards)]
+    )
+    print(f"Базы шардов слиты в {db_path}: товаров {products}, новых наблюдений {observations}")
+
+    if failed:
+        print(f"Шарды завершились с ошибкой: {failed}")
+        return 1
+    print("Все шарды завершены")
+    return 0
+
+
+def main():
+    args = parse_args()
+
+    # Добавляем путь к проекту
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from fiveka_scrapy.sharding import shard_settings
+
+    # Устанавливаем переменную окружения
+    os.environ.setdefault('SCRAPY_SETTINGS_MODULE', 'fiveka_scrapy.settings')
+
+    # Получаем настройки
+    settings = get_project_settings()
+    if args.resume:
+        settings.set('FRONTIER_RESUME', True, priority='cmdline')
+    if args.snapshots:
+        settings.set('SNAPSHOT_MODE', args.snapshots, priority='cmdline')
+    if args.snapshots == 'replay':
+        # Старые страницы не должны попасть в историю цен и фронтир основного обхода
+        settings.set('DATABASE_PATH', settings.get('SNAPSHOT_REPLAY_DATABASE'), priority='cmdline')
+        settings.set('FRONTIER_ENABLED', False, priority='cmdline')
+
+    if args.broker:
+        # Очередь брокера сама переживает падения, локальный фронтир не нужен
+        settings.set('BROKER_ENABLED', True, priority='cmdline')
+        settings.set('SCHEDULER', 'fiveka_scrapy.broker.BrokerScheduler', priority='cmdline')
+        settings.set('FRONTIER_ENABLED', False, priority='cmdline')
+        settings.set('BROKER_RESET', args.broker_reset, priority='cmdline')
+
+    spider_args = {}
+    categories_file = settings.get('SHARD_CATEGORIES_PATH')
+    if args.discover:
+        # Только список категорий: без товаров, выгрузки и фронтира
+        settings.set('ITEM_PIPELINES', {}, priority='cmdline')
+        settings.set('FEEDS', {}, priority='cmdline')
+        settings.set('FRONTIER_ENABLED', False, priority='cmdline')
+        spider_args = {'discover_file': categories_file}
+    elif args.shard is not None:
+        for name, value in shard_settings(settings, args.shard).items():
+            settings.set(name, value, priority='cmdline')
+        spider_args = {'categories_file': categories_file, 'shard': args.shard, 'shards': args.shards}
+
+    if args.shard is None and not args.discover:
+        print(BANNER)
+
+    if args.shards > 1 and args.shard is None and not args.discover:
+        return run_sharded(args, settings)
 
     # Запускаем паука
-    process.crawl('fiveka')
+    process = CrawlerProcess(settings)
+    process.crawl('fiveka', **spider_args)
     process.start()
+    return 0
 
 
 if __name__ == '__main__':
     try:
-        main()
+        sys.exit(main())
     except KeyboardInterrupt:
         print("\n\nПарсер остановлен пользователем")
     except Exception as e:
         print(f"\nОшибка запуска: {e}")
         import traceback
 
-        traceback.print_exc()
\ No newline at end of file
+        traceback.print_exc()
+        sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,94 @@
+from fiveka_scrapy.broker import DONE, FAILED, LEASED, QUEUED, SqliteBroker
+
+
+def make_broker(path, **kwargs):
+    kwargs.setdefault('reclaim_interval', 0)
+    return SqliteBroker(path, **kwargs)
+
+
+def state(broker, fp):
+    return broker.conn.execute('SELECT state, owner FROM queue WHERE fp = ?', (fp,)).fetchone()
+
+
+def test_lease_ack(db_path):
+    broker = make_broker(db_path)
+    assert broker.push('a', 'http://x/a', 0, b'A')
+    assert not broker.push('a', 'http://x/a', 0, b'A')
+    assert broker.push('b', 'http://x/b', 10, b'B')
+
+    # Сначала высокий приоритет
+    assert broker.lease('w1') == ('b', b'B')
+    assert broker.lease('w2') == ('a', b'A')
+    assert broker.lease('w3') is None
+    assert state(broker, 'b') == (LEASED, 'w1')
+
+    broker.ack('b', 'w1')
+    assert state(broker, 'b') == (DONE, None)
+    assert broker.pending() == 1
+    assert broker.pending(exclude_owner='w2') == 0
+    broker.close()
+
+
+def test_expired_lease_is_reclaimed(db_path):
+    # Аренда истекает сразу после выдачи
+    broker = make_broker(db_path, visibility_timeout=-1)
+    broker.push('a', 'http://x/a', 0, b'A')
+    assert broker.lease('w1') == ('a', b'A')
+
+    # Другой узел забирает запрос, подтверждение старого владельца игнорируется
+    assert broker.lease('w2') == ('a', b'A')
+    broker.ack('a', 'w1')
+    assert state(broker, 'a') == (LEASED, 'w2')
+    broker.ack('a', 'w2')
+    assert state(broker, 'a') == (DONE, None)
+    broker.close()
+
+
+def test_live_lease_is_not_reclaimed(db_path):
+    broker = make_broker(db_path, visibility_timeout=300)
+    broker.push('a', 'http://x/a', 0, b'A')
+    assert broker.lease('w1') == ('a', b'A')
+    assert broker.lease('w2') is None
+    assert state(broker, 'a') == (LEASED, 'w1')
+    broker.close()
+
+
+def test_extend_keeps_lease(db_path):
+    broker = make_broker(db_path, visibility_timeout=300)
+    broker.push('a', 'http://x/a', 0, b'A')
+    broker.lease('w1')
+    broker.conn.execute('UPDATE queue SET lease_expires = 0')
+    broker.conn.commit()
+    broker.extend('w1', ['a'])
+    assert broker.lease('w2') is None
+    broker.close()
+
+
+def test_redelivery_limit_fails_request(db_path):
+    broker = make_broker(db_path, visibility_timeout=-1, max_deliveries=2)
+    broker.push('a', 'http://x/a', 0, b'A')
+    assert broker.lease('w1') == ('a', b'A')
+    assert broker.lease('w2') == ('a', b'A')
+    assert broker.lease('w3') is None
+    assert state(broker, 'a') == (FAILED, None)
+    broker.close()
+
+
+def test_release_returns_leases(db_path):
+    broker = make_broker(db_path)
+    broker.push('a', 'http://x/a', 0, b'A')
+    broker.lease('w1')
+    broker.release('w1')
+    assert state(broker, 'a') == (QUEUED, None)
+    assert broker.counts() == {QUEUED: 1}
+    broker.close()
+
+
+def test_shared_between_connections(db_path):
+    first = make_broker(db_path)
+    second = make_broker(db_path)
+    first.push('a', 'http://x/a', 0, b'A')
+    assert second.lease('w2') == ('a', b'A')
+    assert first.lease('w1') is None
+    first.close()
+    second.close()
@@ -0,0 +1,58 @@
+import random
+
+from fiveka_scrapy.dupefilters import FingerprintSet, url_fingerprint
+
+
+def test_add_and_contains():
+    fps = FingerprintSet()
+    assert fps.add(42) is True
+    assert fps.add(42) is False
+    assert fps.contains(42)
+    assert not fps.contains(43)
+    assert len(fps) == 1
+
+
+def test_colliding_slots_are_probed():
+    fps = FingerprintSet(capacity=8)
+    size = fps.mask + 1
+    # Одинаковые младшие биты: все отпечатки претендуют на одну ячейку
+    colliding = [size * k + 3 for k in range(1, 6)]
+    for fp in colliding:
+        assert fps.add(fp)
+    for fp in colliding:
+        assert fps.contains(fp)
+        assert not fps.add(fp)
+    assert not fps.contains(size * 10 + 3)
+    assert len(fps) == len(colliding)
+
+
+def test_grows_and_keeps_members():
+    fps = FingerprintSet(capacity=1)
+    initial = len(fps.slots)
+    rng = random.Random(1)
+    values = {rng.getrandbits(64) or 1 for _ in range(10_000)}
+    for fp in values:
+        assert fps.add(fp)
+
+    assert len(fps) == len(values)
+    assert len(fps.slots) > initial
+    # Заполнение не больше половины после каждого роста
+    assert len(fps) * 2 <= len(fps.slots)
+    assert fps.nbytes == len(fps.slots) * 8
+    assert all(fps.contains(fp) for fp in values)
+    missing = {rng.getrandbits(64) or 1 for _ in range(1000)} - values
+    assert not any(fps.contains(fp) for fp in missing)
+
+
+def test_max_fingerprint_fits():
+    fps = FingerprintSet()
+    assert fps.add(2 ** 64 - 1)
+    assert fps.contains(2 ** 64 - 1)
+
+
+def test_url_fingerprint_ignores_tracking_and_separates_stores():
+    url = 'https://5ka.ru/product/granat--79085/'
+    assert url_fingerprint(url) == url_fingerprint(url + '?utm_source=x&from=main#reviews')
+    assert url_fingerprint(url) != url_fingerprint(url, store='31Z6')
+    assert url_fingerprint(url, store='31Z6') != url_fingerprint(url, store='35XY')
+    assert url_fingerprint(url) != 0
@@ -0,0 +1,80 @@
+from scrapy.http import Request
+from scrapy.utils.request import RequestFingerprinter, request_from_dict
+
+from fiveka_scrapy.frontier import DONE, FAILED, PENDING, CrawlFrontier
+
+fingerprinter = RequestFingerprinter()
+
+
+def add(frontier, url, priority=0):
+    request = Request(url, priority=priority)
+    fp = fingerprinter.fingerprint(request).hex()
+    frontier.add_pending(fp, request.to_dict(), url, priority)
+    return fp
+
+
+def test_pending_done_resume(db_path):
+    frontier = CrawlFrontier(db_path)
+    first = add(frontier, 'https://5ka.ru/catalog/1/')
+    second = add(frontier, 'https://5ka.ru/catalog/2/', priority=5)
+    third = add(frontier, 'https://5ka.ru/catalog/3/')
+    frontier.commit()
+    assert frontier.counts() == {PENDING: 3}
+
+    frontier.mark_done(first, 'https://5ka.ru/catalog/1/')
+    frontier.mark_failed(third, 'https://5ka.ru/catalog/3/')
+    assert frontier.is_done(first)
+    frontier.close()
+
+    # Новый запуск: выполненные - в памяти, ожидающие - по приоритету
+    resumed = CrawlFrontier(db_path)
+    assert resumed.counts() == {DONE: 1, PENDING: 1, FAILED: 1}
+    assert resumed.is_done(first)
+    assert not resumed.is_done(second)
+    restored = [request_from_dict(d) for d in resumed.pending_requests()]
+    assert [r.url for r in restored] == ['https://5ka.ru/catalog/2/']
+    assert restored[0].priority == 5
+
+    # Повторная выдача выполненного или сбойного запроса статус не меняет
+    add(resumed, 'https://5ka.ru/catalog/1/')
+    add(resumed, 'https://5ka.ru/catalog/3/')
+    resumed.mark_done(second, 'https://5ka.ru/catalog/2/')
+    resumed.commit()
+    assert resumed.counts() == {DONE: 2, FAILED: 1}
+    assert list(resumed.pending_requests()) == []
+    resumed.close()
+
+
+def test_done_is_not_overridden_by_failure(db_path):
+    frontier = CrawlFrontier(db_path)
+    fp = add(frontier, 'https://5ka.ru/product/a--1/')
+    frontier.mark_done(fp, 'https://5ka.ru/product/a--1/')
+    frontier.commit()
+    frontier.mark_failed(fp, 'https://5ka.ru/product/a--1/')
+    frontier.commit()
+    assert frontier.counts() == {DONE: 1}
+    frontier.close()
+
+
+def test_category_progress_per_store(db_path):
+    frontier = CrawlFrontier(db_path)
+    frontier.record_category_page('Фрукты', 'u1', 'u2')
+    frontier.record_category_page('Фрукты', 'u2', 'u3')
+    frontier.record_category_page('Фрукты', 's1', None, store='31Z6')
+    frontier.commit()
+    rows = frontier.conn.execute(
+        'SELECT store, pages_done, last_page_url, next_page_url FROM category_progress ORDER BY store'
+    ).fetchall()
+    assert rows == [('', 2, 'u2', 'u3'), ('31Z6', 1, 's1', None)]
+    frontier.close()
+
+
+def test_reset(db_path):
+    frontier = CrawlFrontier(db_path)
+    fp = add(frontier, 'https://5ka.ru/catalog/1/')
+    frontier.mark_done(fp, 'https://5ka.ru/catalog/1/')
+    frontier.commit()
+    frontier.reset()
+    assert not frontier.is_done(fp)
+    assert frontier.counts() == {}
+    frontier.close()
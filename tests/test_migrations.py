@@ -0,0 +1,98 @@
+import json
+import sqlite3
+
+from fiveka_scrapy.database import SCHEMA_VERSION, connect, ensure_schema
+
+
+def make_legacy_db(path):
+    """База первой версии парсера: одна таблица products с url UNIQUE"""
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT, price TEXT, old_price TEXT, article TEXT, url TEXT UNIQUE,
+            category TEXT, description TEXT, characteristics TEXT, composition TEXT,
+            nutritional_info TEXT, image_url TEXT, brand TEXT, weight TEXT,
+            country TEXT, rating TEXT, reviews_count TEXT, date_scraped TEXT
+        )
+    ''')
+    rows = [
+        ('Гранат', '189,99', '249,99', None, 'https://5ka.ru/product/granat--79085/',
+         'Фрукты', 'Сладкий', None, None, None, None, None, '1 кг', 'Турция',
+         '4,8', '1 234 отзыва', '2025-01-10T10:00:00'),
+        ('Молоко', '89.90 ₽', '', 'A-1', 'https://5ka.ru/product/moloko--111/',
+         'Молочное', None, None, None, None, None, None, None, None,
+         'нет', '', '2025-01-11T10:00:00'),
+        ('Без ключа', '10', None, None, None, None, None, None, None, None,
+         None, None, None, None, None, None, '2025-01-12T10:00:00'),
+    ]
+    conn.executemany('''
+        INSERT INTO products (name, price, old_price, article, url, category, description,
+            characteristics, composition, nutritional_info, image_url, brand, weight,
+            country, rating, reviews_count, date_scraped)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    conn.commit()
+    conn.close()
+
+
+def test_legacy_db_migrates_to_current_schema(db_path):
+    make_legacy_db(db_path)
+    conn = connect(db_path)
+    ensure_schema(conn)
+
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {'runs', 'products', 'price_observations', 'latest_products', 'dead_letters'} <= tables
+    assert 'products_legacy' not in tables
+
+    # Ключ - ID из ссылки, иначе артикул; строка без ключа пропускается
+    products = dict(conn.execute('SELECT product_id, name FROM products'))
+    assert products == {'79085': 'Гранат', 'A-1': 'Молоко'}
+    assert conn.execute(
+        'SELECT detail_scraped_at, first_seen_at FROM products WHERE product_id = ?', ('79085',)
+    ).fetchone() == ('2025-01-10T10:00:00', '2025-01-10T10:00:00')
+
+    observations = {
+        row[0]: row[1:] for row in conn.execute('''
+            SELECT product_id, store_id, price_kopecks, old_price_kopecks,
+                   rating, reviews_count, parse_errors
+            FROM price_observations
+        ''')
+    }
+    assert observations['79085'] == ('', 18999, 24999, 4.8, 1234, None)
+    store_id, price, old_price, rating, reviews, errors = observations['A-1']
+    assert (store_id, price, old_price, rating, reviews) == ('', 8990, None, None, None)
+    assert set(json.loads(errors)) == {'rating'}
+
+    latest = conn.execute(
+        'SELECT product_id, store_id, price_kopecks, observed_at FROM latest_products ORDER BY product_id'
+    ).fetchall()
+    assert latest == [
+        ('79085', '', 18999, '2025-01-10T10:00:00'),
+        ('A-1', '', 8990, '2025-01-11T10:00:00'),
+    ]
+    conn.close()
+
+
+def test_migration_is_idempotent(db_path):
+    make_legacy_db(db_path)
+    for _ in range(2):
+        conn = connect(db_path)
+        ensure_schema(conn)
+        conn.close()
+
+    conn = connect(db_path)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+    assert conn.execute('SELECT COUNT(*) FROM price_observations').fetchone()[0] == 2
+    assert conn.execute('SELECT COUNT(*) FROM runs').fetchone()[0] == 1
+    conn.close()
+
+
+def test_new_db_gets_current_schema(db_path):
+    conn = connect(db_path)
+    ensure_schema(conn)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(latest_products)')]
+    assert 'store_id' in columns and 'price_kopecks' in columns
+    conn.close()
@@ -0,0 +1,45 @@
+from decimal import Decimal
+
+import pytest
+
+from fiveka_scrapy.normalize import parse_price_kopecks
+
+
+@pytest.mark.parametrize('value', [None, '', '   ', '\n'])
+def test_empty_is_none(value):
+    assert parse_price_kopecks(value) is None
+
+
+@pytest.mark.parametrize('value, expected', [
+    (0, 0),
+    (100, 10000),
+    (99.99, 9999),
+    (0.1, 10),
+    ('0', 0),
+    ('89.90', 8990),
+    ('89,90', 8990),
+    ('1 299,50 ₽', 129950),
+    ('1\xa0299,50\xa0₽', 129950),
+    (' 15 ', 1500),
+    ('.5', 50),
+    ('12.', 1200),
+])
+def test_parses_numbers_and_text(value, expected):
+    result = parse_price_kopecks(value)
+    assert result == expected
+    assert type(result) is int
+
+
+def test_float_without_binary_error():
+    # 0.29 * 100 = 28.999999999999996 в float
+    assert parse_price_kopecks(0.29) == 29
+    assert parse_price_kopecks(Decimal('0.29')) == 29
+
+
+@pytest.mark.parametrize('value', [
+    'нет в наличии', '₽', '1.2.3', True, False,
+    float('nan'), float('inf'), -5, -0.01,
+])
+def test_invalid_raises(value):
+    with pytest.raises(ValueError):
+        parse_price_kopecks(value)
@@ -0,0 +1,92 @@
+from fiveka_scrapy.database import connect, ensure_schema
+from fiveka_scrapy.pipelines import FivekaPipeline
+
+URL = 'https://5ka.ru/product/granat--79085/'
+
+
+def upsert(conn, pipeline, item, run_id):
+    row = pipeline.item_to_row(item)
+    row['run_id'] = run_id
+    conn.execute(FivekaPipeline.UPSERT_PRODUCT_SQL, row)
+    return row
+
+
+def product(conn, *fields):
+    return conn.execute(
+        f'SELECT {", ".join(fields)} FROM products WHERE product_id = ?', ('79085',)
+    ).fetchone()
+
+
+def detail_item(**fields):
+    """Товар со страницы товара (как после process_item: JSON уже в строках)"""
+    item = {
+        'url': URL, 'product_id': '79085', 'name': 'Гранат Турция',
+        'category': 'Фрукты', 'description': 'Сладкий', 'characteristics': '{"Вес": "1 кг"}',
+        'image_url': '["https://img/1.jpg"]', 'brand': 'Сады', 'price_kopecks': 18999,
+        'date_scraped': '2025-01-10T10:00:00',
+    }
+    item.update(fields)
+    return item
+
+
+def listing_item(**fields):
+    """Частичный товар с карточки категории"""
+    item = {
+        'url': URL, 'product_id': '79085', 'name': 'Гранат', 'category': 'Фрукты',
+        'image_url': '["https://img/small.jpg"]', 'price_kopecks': 17999, 'partial': True,
+        'date_scraped': '2025-01-11T10:00:00',
+    }
+    item.update(fields)
+    return item
+
+
+def test_partial_row_keeps_detail_fields(db_path):
+    conn = connect(db_path)
+    ensure_schema(conn)
+    pipeline = FivekaPipeline(db_path)
+
+    upsert(conn, pipeline, detail_item(), run_id=1)
+    row = upsert(conn, pipeline, listing_item(), run_id=2)
+    assert row['detail_scraped_at'] is None
+
+    assert product(conn, 'name', 'description', 'characteristics', 'brand', 'image_url') == (
+        'Гранат Турция', 'Сладкий', '{"Вес": "1 кг"}', 'Сады', '["https://img/1.jpg"]',
+    )
+    # Увиден в новом запуске, но детальные поля собраны в первом
+    assert product(conn, 'first_seen_at', 'last_seen_at', 'last_seen_run_id', 'detail_scraped_at') == (
+        '2025-01-10T10:00:00', '2025-01-11T10:00:00', 2, '2025-01-10T10:00:00',
+    )
+    conn.close()
+
+
+def test_partial_row_creates_product(db_path):
+    conn = connect(db_path)
+    ensure_schema(conn)
+    pipeline = FivekaPipeline(db_path)
+
+    upsert(conn, pipeline, listing_item(), run_id=1)
+    assert product(conn, 'name', 'image_url', 'description', 'detail_scraped_at') == (
+        'Гранат', '["https://img/small.jpg"]', None, None,
+    )
+
+    # Страница товара дополняет и перезаписывает данные карточки
+    upsert(conn, pipeline, detail_item(date_scraped='2025-01-12T10:00:00', description=None), run_id=2)
+    assert product(conn, 'name', 'image_url', 'characteristics', 'detail_scraped_at') == (
+        'Гранат Турция', '["https://img/1.jpg"]', '{"Вес": "1 кг"}', '2025-01-12T10:00:00',
+    )
+    conn.close()
+
+
+def test_detail_row_does_not_erase_known_fields(db_path):
+    conn = connect(db_path)
+    ensure_schema(conn)
+    pipeline = FivekaPipeline(db_path)
+
+    upsert(conn, pipeline, detail_item(), run_id=1)
+    upsert(conn, pipeline, detail_item(
+        date_scraped='2025-01-12T10:00:00', description=None, brand=None, name='Гранат отборный',
+    ), run_id=2)
+    assert product(conn, 'name', 'description', 'brand', 'detail_scraped_at') == (
+        'Гранат отборный', 'Сладкий', 'Сады', '2025-01-12T10:00:00',
+    )
+    conn.close()